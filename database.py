@@ -5,10 +5,23 @@
 支持：Bot配置、用户验证、消息映射
 """
 import sqlite3
+import asyncio
+import atexit
+import glob
+import gzip
 import json
 import logging
 import os
+import shutil
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
+from functools import partial
 from typing import Dict, List, Optional, Tuple
 from threading import Lock
 logger = logging.getLogger(__name__)
@@ -18,170 +31,739 @@ logger = logging.getLogger(__name__)
 DB_DIR = os.environ.get('TG_BOT_DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
 DB_FILE = os.path.join(DB_DIR, 'bot_data.db')
 
-# 线程锁，防止并发写入冲突
-db_lock = Lock()
-def get_connection():
-    """获取数据库连接"""
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row  # 支持字典访问
+# 存储后端：sqlite（默认，本地文件）或 postgres（多进程/多节点共享，见 storage_pg.py）
+STORAGE_BACKEND = os.environ.get('TG_BOT_STORAGE', 'sqlite').strip().lower()
+
+# 连接参数（可通过环境变量调整）
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('TG_BOT_DB_BUSY_TIMEOUT_MS', '5000'))
+DB_CACHE_SIZE_KB = int(os.environ.get('TG_BOT_DB_CACHE_KB', '16384'))
+DB_MMAP_SIZE_MB = int(os.environ.get('TG_BOT_DB_MMAP_MB', '64'))
+# 空闲多少秒后在后台执行 WAL checkpoint（0 表示关闭）
+DB_CHECKPOINT_IDLE_SECONDS = float(os.environ.get('TG_BOT_DB_CHECKPOINT_IDLE', '30'))
+# 消息映射写缓冲：最多攒多少毫秒 / 多少行提交一次
+MAPPING_FLUSH_INTERVAL_MS = int(os.environ.get('TG_BOT_MAPPING_FLUSH_MS', '50'))
+MAPPING_FLUSH_MAX_ROWS = int(os.environ.get('TG_BOT_MAPPING_FLUSH_ROWS', '500'))
+# 维护任务每个事务最多删除的行数
+MAINTENANCE_CHUNK_ROWS = int(os.environ.get('TG_BOT_MAINTENANCE_CHUNK', '5000'))
+# 在线备份：快照目录 / 保留份数 / 每步复制的页数 / 每步之间的间隔
+BACKUP_DIR = os.environ.get('TG_BOT_BACKUP_DIR', os.path.join(DB_DIR, 'backups'))
+BACKUP_KEEP = int(os.environ.get('TG_BOT_BACKUP_KEEP', '7'))
+BACKUP_STEP_PAGES = int(os.environ.get('TG_BOT_BACKUP_STEP_PAGES', '256'))
+BACKUP_STEP_SLEEP_MS = int(os.environ.get('TG_BOT_BACKUP_STEP_SLEEP_MS', '10'))
+# 已验证用户缓存最多保存的用户数（0 表示不限制）
+VERIFIED_CACHE_MAX_ENTRIES = int(os.environ.get('TG_BOT_VERIFIED_CACHE_SIZE', '0'))
+# 分片数：按 Bot 用户名哈希把按 Bot 存储的数据分散到多个 SQLite 文件（0 表示不分片）
+DB_SHARDS = int(os.environ.get('TG_BOT_DB_SHARDS', '0'))
+# 读线程数：读操作在线程池中并发执行，不经过写线程排队
+DB_READ_THREADS = int(os.environ.get('TG_BOT_DB_READ_THREADS', '4'))
+# 单次等待写锁超过多少毫秒时输出警告
+DB_LOCK_WARN_MS = float(os.environ.get('TG_BOT_DB_LOCK_WARN_MS', '500'))
+
+# 每个线程对每个数据库文件持有一个长连接，只在创建时配置一次
+_local = threading.local()
+# 最近一次访问：_last_activity 包括维护线程（checkpoint 线程据此判断是否有新写入），
+# _last_app_activity 只算业务访问（增量回收据此判断是否空闲，不把自己的访问当作流量）
+_last_activity = time.monotonic()
+_last_app_activity = _last_activity
+_checkpoint_thread = None
+_checkpoint_start_lock = Lock()
+
+
+def _configure_connection(conn: sqlite3.Connection):
+    """为新连接设置 PRAGMA（每个连接只执行一次）"""
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE_MB * 1024 * 1024}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+
+def get_connection(path: str = None):
+    """获取当前线程到某个数据库文件的连接（长连接，首次使用时创建；默认为主库）"""
+    global _last_activity, _last_app_activity
+    _last_activity = time.monotonic()
+    if not getattr(_local, 'maintenance', False):
+        _last_app_activity = _last_activity
+    path = path or DB_FILE
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row  # 支持字典访问
+        _configure_connection(conn)
+        conns[path] = conn
+        _start_checkpoint_thread()
     return conn
-def init_database():
-    """初始化数据库表结构"""
-    with db_lock:
-        # 打印数据库文件路径（用于诊断）
-        logger.info(f"📂 数据库文件路径: {DB_FILE}")
-        logger.info(f"📂 数据库文件是否存在: {os.path.exists(DB_FILE)}")
-        
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # 1. Bot配置表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bots (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT UNIQUE NOT NULL,
-                token TEXT NOT NULL,
-                owner INTEGER NOT NULL,
-                welcome_msg TEXT DEFAULT '',
-                mode TEXT DEFAULT 'direct',
-                forum_group_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 1.1 添加新字段（兼容旧数据库）
-        try:
-            cursor.execute('ALTER TABLE bots ADD COLUMN mode TEXT DEFAULT "direct"')
-        except sqlite3.OperationalError:
-            pass  # 字段已存在
-        
+
+
+def rollback_quietly():
+    """出错后回滚当前线程所有未完成的事务，避免长连接一直持有写锁"""
+    for conn in getattr(_local, 'conns', {}).values():
         try:
-            cursor.execute('ALTER TABLE bots ADD COLUMN forum_group_id INTEGER')
-        except sqlite3.OperationalError:
-            pass  # 字段已存在
-        
-        # 2. 已验证用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS verified_users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                user_name TEXT DEFAULT '',
-                user_username TEXT DEFAULT '',
-                verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
-        ''')
-        
-        # 3. 消息映射表（重新设计，支持完整映射）
-        # 先检查表是否存在以及结构
-        cursor.execute('''
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='message_mappings'
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            pass
+
+
+def close_connection():
+    """关闭当前线程的所有连接（线程退出或进程关闭时调用）"""
+    conns = getattr(_local, 'conns', None)
+    if conns:
+        rollback_quietly()
+        for conn in conns.values():
+            conn.close()
+        conns.clear()
+
+
+def seconds_since_last_activity() -> float:
+    """距离上一次数据库访问的秒数"""
+    return time.monotonic() - _last_activity
+
+
+def seconds_since_last_app_activity() -> float:
+    """距离上一次业务访问（不含维护线程）的秒数"""
+    return time.monotonic() - _last_app_activity
+
+
+def _checkpoint_worker():
+    """后台线程：数据库空闲时把 WAL 合并回主文件，防止 -wal 文件无限增长"""
+    conns = {}
+    last_checkpoint = 0.0
+    while True:
+        time.sleep(DB_CHECKPOINT_IDLE_SECONDS)
+        if _last_activity <= last_checkpoint:
+            continue  # 上次 checkpoint 之后没有新的访问
+        if seconds_since_last_activity() < DB_CHECKPOINT_IDLE_SECONDS:
+            continue  # 仍在繁忙，等下一轮
+        last_checkpoint = time.monotonic()
+        for shard in _all_shards:
+            try:
+                conn = conns.get(shard.path)
+                if conn is None:
+                    conn = sqlite3.connect(shard.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+                    conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+                    conns[shard.path] = conn
+                busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                if log_frames > 0:
+                    logger.debug(f"🧾 WAL checkpoint {shard.name}: {checkpointed}/{log_frames} 帧")
+            except Exception as e:
+                logger.warning(f"⚠️ WAL checkpoint 失败 ({shard.name}): {e}")
+
+
+def _start_checkpoint_thread():
+    """启动后台 checkpoint 线程（仅一次）"""
+    global _checkpoint_thread
+    if _checkpoint_thread is not None or DB_CHECKPOINT_IDLE_SECONDS <= 0:
+        return
+    with _checkpoint_start_lock:
+        if _checkpoint_thread is None:
+            _checkpoint_thread = threading.Thread(target=_checkpoint_worker, name='db-checkpoint', daemon=True)
+            _checkpoint_thread.start()
+
+
+# ================== 写锁 ==================
+class InstrumentedLock:
+    """
+    带等待时间统计的互斥锁（用法同 threading.Lock）
+    
+    记录获取次数、发生等待的次数、累计/最长等待时间，
+    单次等待超过 DB_LOCK_WARN_MS 时输出警告。统计字段只在持有锁时更新。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self) -> bool:
+        if not self._lock.acquire(blocking=False):
+            started = time.monotonic()
+            self._lock.acquire()
+            waited = time.monotonic() - started
+            self.contended += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if waited * 1000 >= DB_LOCK_WARN_MS:
+                logger.warning(f"⏳ 等待数据库写锁 {self.name} {waited * 1000:.0f}ms")
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self) -> Dict:
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'total_wait_ms': round(self.total_wait * 1000, 1),
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+        }
+
+
+# 写操作按表族串行：同一族的写入排队执行，不同族互不等待。
+# 同一个文件上的两个写事务仍由 SQLite 在提交时串行（busy_timeout），但只在写事务期间，
+# 而不是整个排队过程。需要多个锁时按本元组的顺序获取，避免死锁。
+#   catalog    bots、global_settings（只在主库）
+#   membership verified_users、blacklist
+#   pending    pending_verifications
+#   mapping    message_map
+WRITE_FAMILIES = ('catalog', 'membership', 'pending', 'mapping')
+
+
+# ================== 分片 ==================
+class Shard:
+    """
+    一个 SQLite 文件：按表族划分的写锁和写线程、消息映射写缓冲
+    
+    不分片时只有主库一个分片。分片后 bots、global_settings 留在主库（目录库），
+    verified_users、blacklist、pending_verifications、message_map 按 Bot 用户名哈希
+    分散到各个分片文件，不同分片的写入互不等待。
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.locks = {family: InstrumentedLock(f'{name}.{family}') for family in WRITE_FAMILIES}
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._executors_lock = Lock()
+        self.writer = None  # MappingWriter，在其定义之后创建
+
+    def connection(self) -> sqlite3.Connection:
+        """当前线程到该分片文件的连接"""
+        return get_connection(self.path)
+
+    def executor(self, family: str) -> ThreadPoolExecutor:
+        """某个表族的写线程（首次使用时创建），同一族的写入按提交顺序执行"""
+        executor = self._executors.get(family)
+        if executor is None:
+            with self._executors_lock:
+                executor = self._executors.get(family)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'db-{self.name}-{family}')
+                    self._executors[family] = executor
+        return executor
+
+    def executors(self) -> List[ThreadPoolExecutor]:
+        with self._executors_lock:
+            return list(self._executors.values())
+
+    @contextmanager
+    def lock_all(self):
+        """按固定顺序获取全部写锁（迁移、搬迁数据、回收空闲页时使用）"""
+        with ExitStack() as stack:
+            for family in WRITE_FAMILIES:
+                stack.enter_context(self.locks[family])
+            yield
+
+
+def _shard_path(index: int, count: int) -> str:
+    """分片文件名带上分片总数，调整分片数后旧文件不会被误用"""
+    return os.path.join(DB_DIR, f'bot_data.shard{index}of{count}.db')
+
+
+_catalog = Shard('main', DB_FILE)
+# 主库目录表（bots、global_settings）的写锁
+db_lock = _catalog.locks['catalog']
+# 按 Bot 存储的数据所在的分片（不分片时就是主库）
+_shards = [Shard(f'shard{i}', _shard_path(i, DB_SHARDS)) for i in range(DB_SHARDS)] or [_catalog]
+# 主库 + 所有分片（维护、备份、迁移时遍历）
+_all_shards = [_catalog] + [shard for shard in _shards if shard is not _catalog]
+
+
+def shard_for(bot_username: str) -> Shard:
+    """Bot 的数据所在分片（crc32 哈希，跨进程、跨重启稳定）"""
+    if len(_shards) == 1:
+        return _shards[0]
+    return _shards[zlib.crc32(bot_username.encode('utf-8')) % len(_shards)]
+
+
+# PRAGMA auto_vacuum 的取值：0=NONE, 1=FULL, 2=INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+# ================== 数据库结构迁移 ==================
+def _table_columns(cursor, table: str) -> List[str]:
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _migration_base_tables(cursor):
+    """基础表：Bot 配置、已验证用户、黑名单、全局设置、待验证用户"""
+    # Bot配置表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT UNIQUE NOT NULL,
+            token TEXT NOT NULL,
+            owner INTEGER NOT NULL,
+            welcome_msg TEXT DEFAULT '',
+            mode TEXT DEFAULT 'direct',
+            forum_group_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # 兼容旧数据库：补充后来新增的字段
+    columns = _table_columns(cursor, 'bots')
+    if 'mode' not in columns:
+        cursor.execute("ALTER TABLE bots ADD COLUMN mode TEXT DEFAULT 'direct'")
+    if 'forum_group_id' not in columns:
+        cursor.execute('ALTER TABLE bots ADD COLUMN forum_group_id INTEGER')
+    
+    # 已验证用户表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS verified_users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_name TEXT DEFAULT '',
+            user_username TEXT DEFAULT '',
+            verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+    
+    # 黑名单表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blacklist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            reason TEXT DEFAULT '',
+            blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+    
+    # 全局设置表（管理员设置）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS global_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # 待验证用户表（验证码答案）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_verifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            bot_username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            captcha_answer TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(bot_username, user_id)
+        )
+    ''')
+
+
+def _migration_message_map(cursor):
+    """消息映射表（紧凑格式：整数键 + WITHOUT ROWID），并迁移旧版 message_mappings"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_map (
+            bot_id INTEGER NOT NULL,
+            map_type INTEGER NOT NULL,
+            key_chat INTEGER NOT NULL,
+            key_msg INTEGER NOT NULL,
+            value_chat INTEGER NOT NULL,
+            value_msg INTEGER NOT NULL,
+            user_id INTEGER,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (bot_id, map_type, key_chat, key_msg)
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('''
+        SELECT name FROM sqlite_master 
+        WHERE type='table' AND name='message_mappings'
+    ''')
+    if cursor.fetchone() is not None:
+        migrate_message_mappings(cursor)
+
+
+def _migration_indexes(cursor):
+    """查询索引"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_verified_users_bot 
+        ON verified_users(bot_username, user_id)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_map_cleanup 
+        ON message_map(updated_at)
+    ''')
+    
+    # 话题反向查找：topic_id -> 用户（只索引 topic 类型的行）
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_message_map_topic_user 
+        ON message_map(bot_id, value_msg) WHERE map_type = {MAP_TYPE_CODES['topic']}
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_blacklist_bot 
+        ON blacklist(bot_username, user_id)
+    ''')
+
+
+# 由触发器维护行数的表：表名 -> 按 Bot 区分的列（None 表示只记总数）
+# row_counts 中 bot = '' 的行是整张表的总数；message_map 按 bot_id 记录
+COUNTED_TABLES = {
+    'bots': None,
+    'verified_users': 'bot_username',
+    'blacklist': 'bot_username',
+    'message_map': 'bot_id',
+}
+
+
+def _recount(cursor, table: str, column: Optional[str]):
+    """按实际数据重新计算一张表的计数（调用方负责事务）"""
+    cursor.execute('DELETE FROM row_counts WHERE table_name = ?', (table,))
+    cursor.execute(
+        "INSERT INTO row_counts (table_name, bot, count) SELECT ?, '', COUNT(*) FROM " + table,
+        (table,)
+    )
+    if column:
+        cursor.execute(
+            f'INSERT INTO row_counts (table_name, bot, count) '
+            f'SELECT ?, {column}, COUNT(*) FROM {table} GROUP BY {column}',
+            (table,)
+        )
+
+
+def _migration_row_counts(cursor):
+    """行数计数表：插入/删除触发器实时维护按 Bot 和全局的行数，统计时不再全表 COUNT(*)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS row_counts (
+            table_name TEXT NOT NULL,
+            bot TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (table_name, bot)
+        ) WITHOUT ROWID
+    ''')
+    
+    for table, column in COUNTED_TABLES.items():
+        new_rows = f"('{table}', NEW.{column}, 1), ('{table}', '', 1)" if column else f"('{table}', '', 1)"
+        old_bots = f"(OLD.{column}, '')" if column else "('')"
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO row_counts (table_name, bot, count) VALUES {new_rows}
+                ON CONFLICT(table_name, bot) DO UPDATE SET count = count + 1;
+            END
         ''')
-        table_exists = cursor.fetchone() is not None
-        
-        if table_exists:
-            # 检查是否有 map_type 列
-            cursor.execute('PRAGMA table_info(message_mappings)')
-            columns = [row[1] for row in cursor.fetchall()]
-            
-            if 'map_type' not in columns:
-                # 旧表结构，需要迁移
-                logger.info("🔄 检测到旧的 message_mappings 表，正在迁移...")
-                
-                # 备份旧数据
-                cursor.execute('ALTER TABLE message_mappings RENAME TO message_mappings_old')
-                
-                # 创建新表
-                cursor.execute('''
-                    CREATE TABLE message_mappings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        bot_username TEXT NOT NULL,
-                        map_type TEXT NOT NULL CHECK(map_type IN ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')),
-                        key TEXT NOT NULL,
-                        value TEXT NOT NULL,
-                        user_id INTEGER,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
-                
-                # 尝试迁移旧数据（如果有的话）
-                try:
-                    cursor.execute('''
-                        INSERT INTO message_mappings (bot_username, map_type, key, value, user_id, created_at)
-                        SELECT bot_username, 'direct', key, value, user_id, created_at
-                        FROM message_mappings_old
-                    ''')
-                    logger.info("✅ 旧数据已迁移到新表")
-                except Exception as e:
-                    logger.warning(f"⚠️ 迁移旧数据失败（可能旧表为空）: {e}")
-                
-                # 删除旧表
-                cursor.execute('DROP TABLE IF EXISTS message_mappings_old')
-                logger.info("✅ message_mappings 表结构升级完成")
-        else:
-            # 表不存在，直接创建新表
-            cursor.execute('''
-                CREATE TABLE message_mappings (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_username TEXT NOT NULL,
-                    map_type TEXT NOT NULL CHECK(map_type IN ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')),
-                    key TEXT NOT NULL,
-                    value TEXT NOT NULL,
-                    user_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-        
-        # 4. 黑名单表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blacklist (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                reason TEXT DEFAULT '',
-                blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete
+            AFTER DELETE ON {table}
+            BEGIN
+                UPDATE row_counts SET count = count - 1
+                WHERE table_name = '{table}' AND bot IN {old_bots};
+            END
         ''')
-        
-        # 5. 全局设置表（管理员设置）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS global_settings (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        _recount(cursor, table, column)
+
+
+def _migration_page_indexes(cursor):
+    """分页覆盖索引：按验证/拉黑时间翻页时只读索引区间，不回表"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_verified_users_page 
+        ON verified_users(bot_username, verified_at, user_id, user_name, user_username)
+    ''')
+    
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_blacklist_page 
+        ON blacklist(bot_username, blocked_at, user_id)
+    ''')
+
+
+def _migration_pending_deletions(cursor):
+    """定时删除的消息（自动删除的提示消息），重启后继续删除"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            bot_username TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            due_at INTEGER NOT NULL,
+            PRIMARY KEY (bot_username, chat_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+
+
+# 数据库结构迁移：(版本号, 说明, 迁移函数)
+# 按 PRAGMA user_version 记录已执行到的版本，每个迁移只执行一次。
+# 只能在末尾追加新迁移，已发布的迁移不要修改。
+# 主库和每个分片文件执行同一套迁移（分片中的 bots 等目录表保持为空）。
+MIGRATIONS = [
+    (1, '基础表结构', _migration_base_tables),
+    (2, '紧凑消息映射表', _migration_message_map),
+    (3, '查询索引', _migration_indexes),
+    (4, '行数计数器', _migration_row_counts),
+    (5, '分页索引', _migration_page_indexes),
+    (6, '定时删除队列', _migration_pending_deletions),
+]
+
+
+def _stored_count(shard: Shard, table: str, bot: str) -> int:
+    row = shard.connection().execute(
+        'SELECT count FROM row_counts WHERE table_name = ? AND bot = ?', (table, bot)
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def read_row_count(table: str, bot_username: str = None) -> int:
+    """
+    读取触发器维护的行数（O(1)，不扫描表）
+    
+    不传 bot_username 时返回全表总数（分片时为各分片合计）。
+    """
+    if table == 'bots':
+        return _stored_count(_catalog, table, '')
+    if bot_username is None:
+        return sum(_stored_count(shard, table, '') for shard in _shards)
+    key = bot_username
+    if table == 'message_map':
+        bot_id = _get_bot_id(bot_username)
+        if bot_id is None:
+            return 0
+        key = str(bot_id)
+    return _stored_count(shard_for(bot_username), table, key)
+
+
+def repair_counters() -> int:
+    """
+    按实际数据重新计算所有计数，返回修正的计数行数
+    
+    正常情况下触发器保证计数准确；手工改库、从旧快照恢复部分表等情况可能造成偏差，
+    由维护任务定期调用修正。每个文件在一个写事务中完成，期间持有该分片的全部写锁。
+    """
+    repaired = 0
+    for shard in _all_shards:
+        with shard.lock_all():
+            conn = shard.connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('SELECT table_name, bot, count FROM row_counts WHERE count != 0')
+                before = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+                for table, column in COUNTED_TABLES.items():
+                    _recount(cursor, table, column)
+                # 计数为 0 的按 Bot 行没有意义，顺便清掉（总数行保留）
+                cursor.execute("DELETE FROM row_counts WHERE count = 0 AND bot != ''")
+                cursor.execute('SELECT table_name, bot, count FROM row_counts WHERE count != 0')
+                after = {(row[0], row[1]): row[2] for row in cursor.fetchall()}
+                conn.commit()
+            except Exception as e:
+                rollback_quietly()
+                logger.error(f"❌ 修正计数失败 ({shard.path}): {e}")
+                continue
+        drifted = [key for key in before.keys() | after.keys() if before.get(key, 0) != after.get(key, 0)]
+        for table, bot in drifted[:10]:
+            logger.warning(
+                f"⚠️ 计数偏差已修正: {table}[{bot or '总数'}] "
+                f"{before.get((table, bot), 0)} -> {after.get((table, bot), 0)}"
             )
-        ''')
-        
-        # 6. 创建索引加速查询（独立语句）
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_verified_users_bot 
-            ON verified_users(bot_username, user_id)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_message_mappings_lookup 
-            ON message_mappings(bot_username, map_type, key)
-        ''')
-        
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_message_mappings_cleanup 
-            ON message_mappings(created_at)
-        ''')
+        repaired += len(drifted)
+    if repaired:
+        logger.info(f"🔢 计数修正完成，共修正 {repaired} 项")
+    return repaired
+
+
+def get_schema_version(path: str = None) -> int:
+    """当前数据库结构版本（PRAGMA user_version），默认为主库"""
+    return get_connection(path).execute('PRAGMA user_version').fetchone()[0]
+
+
+def apply_migrations(path: str = None) -> int:
+    """
+    对某个数据库文件执行尚未应用的迁移，返回本次执行的迁移数量
+    
+    每个迁移和它的版本号更新在同一个事务中提交，失败时整体回滚，
+    下次启动会从失败的迁移重新开始。调用方需持有该文件所在分片的锁。
+    """
+    conn = get_connection(path)
+    cursor = conn.cursor()
+    current = get_schema_version(path)
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"🔧 执行数据库迁移 v{version}: {description}")
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            migrate(cursor)
+            cursor.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            rollback_quietly()
+            logger.error(f"❌ 数据库迁移 v{version} 失败")
+            raise
+        applied += 1
+    return applied
+
+
+def _prepare_file(path: str) -> int:
+    """切换 auto_vacuum 并执行结构迁移，返回本次执行的迁移数量"""
+    conn = get_connection(path)
+    
+    # 增量 auto_vacuum：空闲页由维护任务分批回收；已有数据库需要一次 VACUUM 才能切换
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        logger.info(f"🗜️ 数据库已切换为增量 auto_vacuum: {path}")
+    
+    return apply_migrations(path)
+
+
+def init_database():
+    """初始化数据库（主库和各分片：切换 auto_vacuum 并执行结构迁移，然后搬迁错位的数据）"""
+    # 打印数据库文件路径（用于诊断）
+    logger.info(f"📂 数据库文件路径: {DB_FILE}")
+    logger.info(f"📂 数据库文件是否存在: {os.path.exists(DB_FILE)}")
+    
+    for shard in _all_shards:
+        with shard.lock_all():
+            applied = _prepare_file(shard.path)
+            logger.info(f"✅ 数据库初始化完成: {shard.path}（结构版本 v{get_schema_version(shard.path)}，本次迁移 {applied} 个）")
+    
+    rebalance_shards()
+    purge_deleted_bot_data()
+
+
+# 按 Bot 存储的表及搬迁时复制的列（自增 id 在目标文件中重新分配）
+SHARDED_TABLE_COLUMNS = {
+    'verified_users': 'bot_username, user_id, user_name, user_username, verified_at',
+    'blacklist': 'bot_username, user_id, reason, blocked_at',
+    'pending_verifications': 'bot_username, user_id, captcha_answer, created_at',
+}
+MESSAGE_MAP_COLUMNS = 'bot_id, map_type, key_chat, key_msg, value_chat, value_msg, user_id, updated_at'
+
+
+def _stale_shard_files() -> List[str]:
+    """分片数调整前留下的旧分片文件"""
+    current = {shard.path for shard in _all_shards}
+    pattern = os.path.join(DB_DIR, 'bot_data.shard*of*.db')
+    return [path for path in sorted(glob.glob(pattern)) if path not in current]
+
+
+def rebalance_shards() -> int:
+    """
+    把不在所属分片中的按 Bot 数据搬到 shard_for() 指定的文件，返回搬迁的行数
+    
+    来源是启用分片前的主库，以及调整分片数之前的旧分片文件（搬空后重命名为 .migrated）。
+    每个 (来源, 目标) 一个事务；跨文件的提交不是原子的，但 INSERT OR IGNORE + DELETE
+    可以重复执行，中途失败时下次启动会继续搬迁。已删除 Bot 的残留映射直接丢弃。
+    """
+    sources = _stale_shard_files()
+    if _catalog not in _shards:
+        sources.insert(0, DB_FILE)
+    if not sources:
+        return 0
+    
+    bot_paths = {row[0]: shard_for(row[1]).path
+                 for row in get_connection().execute('SELECT id, bot_username FROM bots')}
+    moved = 0
+    for source in sources:
+        if source != DB_FILE:
+            _prepare_file(source)
+        conn = get_connection(source)
+        conn.create_function('tg_shard_path', 1, lambda name: shard_for(name).path, deterministic=True)
+        conn.create_function('tg_bot_shard_path', 1, bot_paths.get, deterministic=True)
         
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_blacklist_bot 
-            ON blacklist(bot_username, user_id)
-        ''')
+        for dest in _shards:
+            if dest.path == source:
+                continue
+            with dest.lock_all():
+                conn.execute('ATTACH DATABASE ? AS dest', (dest.path,))
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    for table, columns in SHARDED_TABLE_COLUMNS.items():
+                        conn.execute(f'''
+                            INSERT OR IGNORE INTO dest.{table} ({columns})
+                            SELECT {columns} FROM main.{table} WHERE tg_shard_path(bot_username) = ?
+                        ''', (dest.path,))
+                        moved += conn.execute(
+                            f'DELETE FROM main.{table} WHERE tg_shard_path(bot_username) = ?', (dest.path,)
+                        ).rowcount
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO dest.message_map ({MESSAGE_MAP_COLUMNS})
+                        SELECT {MESSAGE_MAP_COLUMNS} FROM main.message_map WHERE tg_bot_shard_path(bot_id) = ?
+                    ''', (dest.path,))
+                    moved += conn.execute(
+                        'DELETE FROM main.message_map WHERE tg_bot_shard_path(bot_id) = ?', (dest.path,)
+                    ).rowcount
+                    conn.commit()
+                except Exception:
+                    rollback_quietly()
+                    logger.error(f"❌ 分片数据搬迁失败: {source} -> {dest.path}")
+                    raise
+                finally:
+                    conn.execute('DETACH DATABASE dest')
         
+        conn.execute('DELETE FROM message_map WHERE tg_bot_shard_path(bot_id) IS NULL')
         conn.commit()
-        conn.close()
-        logger.info(f"✅ 数据库初始化完成: {DB_FILE}")
+        if source != DB_FILE:
+            conn.close()
+            _local.conns.pop(source, None)
+            os.replace(source, source + '.migrated')
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(source + suffix):
+                    os.remove(source + suffix)
+            logger.info(f"📦 旧分片文件已搬空: {source} -> {source}.migrated")
+    
+    if moved:
+        logger.info(f"📦 分片数据搬迁完成：{moved} 行")
+    return moved
+
+
+def purge_deleted_bot_data() -> int:
+    """
+    删除目录库中已不存在的 Bot 在各分片里残留的已验证用户和消息映射，返回删除的行数
+    
+    delete_bot 先删目录库中的 Bot，再删分片中的数据；两步不在同一个事务里，
+    第二步失败时留下的数据由启动时的这一步清理（与 delete_bot 一样保留黑名单）。
+    残留的 Bot 通过 row_counts 找出（不扫描数据表），再按索引删除。
+    """
+    rows = get_connection().execute('SELECT id, bot_username FROM bots').fetchall()
+    # 表 -> (row_counts 中该表的 bot 取值, 删除语句)
+    targets = {
+        'verified_users': ({row[1] for row in rows}, 'DELETE FROM verified_users WHERE bot_username = ?'),
+        'message_map': ({str(row[0]) for row in rows}, 'DELETE FROM message_map WHERE bot_id = ?'),
+    }
+    purged = 0
+    for shard in _shards:
+        with shard.lock_all():
+            conn = shard.connection()
+            try:
+                for table, bot in conn.execute(
+                    "SELECT table_name, bot FROM row_counts WHERE bot != '' AND count > 0"
+                ).fetchall():
+                    if table in targets and bot not in targets[table][0]:
+                        key = int(bot) if table == 'message_map' else bot
+                        purged += conn.execute(targets[table][1], (key,)).rowcount
+                conn.commit()
+            except Exception:
+                rollback_quietly()
+                logger.error(f"❌ 清理已删除 Bot 的残留数据失败 ({shard.name})")
+                raise
+    if purged:
+        logger.info(f"🧹 清理已删除 Bot 的残留数据：{purged} 行")
+    return purged
+
+
 # ================== Bot 配置管理 ==================
 def add_bot(bot_username: str, token: str, owner: int, welcome_msg: str = '') -> bool:
     """添加新机器人"""
@@ -194,14 +776,16 @@ def add_bot(bot_username: str, token: str, owner: int, welcome_msg: str = '') ->
                 VALUES (?, ?, ?, ?)
             ''', (bot_username, token, owner, welcome_msg))
             conn.commit()
-            conn.close()
+            invalidate_welcome(bot_username)
             logger.info(f"✅ 数据库操作成功 - 添加 Bot: {bot_username} (Owner: {owner})")
             logger.info(f"📂 数据已写入: {DB_FILE}")
             return True
     except sqlite3.IntegrityError:
+        rollback_quietly()
         logger.warning(f"⚠️ Bot 已存在: {bot_username}")
         return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 添加 Bot 失败: {e}")
         import traceback
         traceback.print_exc()
@@ -213,7 +797,6 @@ def get_bot(bot_username: str) -> Optional[Dict]:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM bots WHERE bot_username = ?', (bot_username,))
         row = cursor.fetchone()
-        conn.close()
         
         if row:
             return {
@@ -235,7 +818,6 @@ def get_all_bots() -> Dict[str, Dict]:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM bots ORDER BY created_at')
         rows = cursor.fetchall()
-        conn.close()
         
         bots = {}
         for row in rows:
@@ -267,13 +849,14 @@ def update_bot_welcome(bot_username: str, welcome_msg: str) -> bool:
             ''', (welcome_msg, bot_username))
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
+            invalidate_welcome(bot_username)
             
             if affected > 0:
                 logger.info(f"✅ 更新欢迎消息: {bot_username}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 更新欢迎消息失败: {e}")
         return False
 
@@ -291,13 +874,13 @@ def update_bot_mode(bot_username: str, mode: str) -> bool:
             ''', (mode, bot_username))
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
             if affected > 0:
                 logger.info(f"✅ 更新模式: {bot_username} -> {mode}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 更新模式失败: {e}")
         return False
 
@@ -315,42 +898,69 @@ def update_bot_forum_id(bot_username: str, forum_group_id: int) -> bool:
             ''', (forum_group_id, bot_username))
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
             if affected > 0:
                 logger.info(f"✅ 更新话题群ID: {bot_username} -> {forum_group_id}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 更新话题群ID失败: {e}")
         return False
 def delete_bot(bot_username: str) -> bool:
-    """删除机器人及其关联数据"""
+    """
+    删除机器人及其关联数据
+    
+    先在目录库中删除 Bot（之后它就不存在了），再删除分片中的已验证用户和映射。
+    两步分别提交：第二步失败只会留下无主的数据，由启动时的
+    purge_deleted_bot_data() 清理，不会出现 Bot 还在而数据已被删掉的情况。
+    """
+    shard = shard_for(bot_username)
     try:
+        bot_id = _get_bot_id(bot_username)
         with db_lock:
             conn = get_connection()
             cursor = conn.cursor()
             
-            # 删除关联的已验证用户
-            cursor.execute('DELETE FROM verified_users WHERE bot_username = ?', (bot_username,))
-            
-            # 删除关联的消息映射
-            cursor.execute('DELETE FROM message_mappings WHERE bot_username = ?', (bot_username,))
-            
             # 删除 Bot
             cursor.execute('DELETE FROM bots WHERE bot_username = ?', (bot_username,))
-            
-            conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
-            if affected > 0:
-                logger.info(f"✅ 删除 Bot: {bot_username}")
-                return True
-            return False
+            # 删除尚未执行的定时删除
+            cursor.execute('DELETE FROM pending_deletions WHERE bot_username = ?', (bot_username,))
+            
+            conn.commit()
+            _bot_ids.pop(bot_username, None)
+            verified_cache.drop(bot_username)
+            blacklist_cache.drop(bot_username)
+            invalidate_welcome(bot_username)
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 删除 Bot 失败: {e}")
         return False
+    
+    try:
+        with shard.locks['membership'], shard.locks['mapping']:
+            shard.writer.discard_bot(bot_username)
+            conn = shard.connection()
+            cursor = conn.cursor()
+            
+            # 删除关联的已验证用户
+            cursor.execute('DELETE FROM verified_users WHERE bot_username = ?', (bot_username,))
+            
+            # 删除关联的消息映射
+            if bot_id is not None:
+                cursor.execute('DELETE FROM message_map WHERE bot_id = ?', (bot_id,))
+            
+            conn.commit()
+    except Exception as e:
+        rollback_quietly()
+        logger.warning(f"⚠️ 删除 {bot_username} 的关联数据失败，将在下次启动时清理: {e}")
+    
+    if affected > 0:
+        logger.info(f"✅ 删除 Bot: {bot_username}")
+        return True
+    return False
 def get_bots_by_owner(owner: int) -> List[Dict]:
     """获取某个用户的所有机器人"""
     try:
@@ -358,7 +968,6 @@ def get_bots_by_owner(owner: int) -> List[Dict]:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM bots WHERE owner = ? ORDER BY created_at', (owner,))
         rows = cursor.fetchall()
-        conn.close()
         
         bots = []
         for row in rows:
@@ -372,45 +981,162 @@ def get_bots_by_owner(owner: int) -> List[Dict]:
     except Exception as e:
         logger.error(f"❌ 查询用户 Bot 失败: {e}")
         return []
+# ================== 内存缓存 ==================
+class MembershipCache:
+    """
+    按 Bot 分组的用户ID集合缓存（已验证用户、黑名单等）
+    
+    某个 Bot 第一次被查询时，从数据库一次性加载它的全部用户ID；
+    之后的写入函数同步更新集合，命中时不再访问磁盘。
+    max_entries > 0 时限制缓存的用户总数，按 Bot 维度做 LRU 淘汰；
+    单个 Bot 的用户数超过上限时不缓存，直接查库。
+    """
+
+    def __init__(self, table: str, max_entries: int = 0):
+        self.table = table
+        self.max_entries = max_entries
+        self._sets: "OrderedDict[str, set]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._size = 0
+        self._lock = Lock()
+
+    def peek(self, bot_username: str, user_id: int) -> Optional[bool]:
+        """只查内存：已加载时返回 True/False，未加载返回 None"""
+        with self._lock:
+            ids = self._sets.get(bot_username)
+            if ids is None:
+                return None
+            self._sets.move_to_end(bot_username)
+            return user_id in ids
+
+    def count(self, bot_username: str) -> Optional[int]:
+        """已加载时返回用户数，否则返回 None"""
+        with self._lock:
+            ids = self._sets.get(bot_username)
+            return len(ids) if ids is not None else None
+
+    def ids(self, bot_username: str) -> Optional[set]:
+        """已加载时返回用户ID集合的副本"""
+        with self._lock:
+            ids = self._sets.get(bot_username)
+            return set(ids) if ids is not None else None
+
+    def contains(self, bot_username: str, user_id: int) -> bool:
+        """查询成员关系，未加载时先从数据库加载"""
+        cached = self.peek(bot_username, user_id)
+        if cached is None:
+            self.load(bot_username)
+            cached = self.peek(bot_username, user_id)
+        if cached is None:
+            # 无法缓存（超出上限或加载期间有并发写入），直接查库
+            cursor = shard_for(bot_username).connection().cursor()
+            cursor.execute(
+                f'SELECT 1 FROM {self.table} WHERE bot_username = ? AND user_id = ?',
+                (bot_username, user_id)
+            )
+            cached = cursor.fetchone() is not None
+        return cached
+
+    def load(self, bot_username: str):
+        """从数据库加载某个 Bot 的全部用户ID"""
+        with self._lock:
+            if bot_username in self._sets:
+                return
+            version = self._versions.get(bot_username, 0)
+        cursor = shard_for(bot_username).connection().cursor()
+        cursor.execute(f'SELECT user_id FROM {self.table} WHERE bot_username = ?', (bot_username,))
+        ids = {row[0] for row in cursor}
+        with self._lock:
+            # 加载期间发生了写入，结果可能已过期，放弃本次缓存
+            if self._versions.get(bot_username, 0) != version or bot_username in self._sets:
+                return
+            if self.max_entries and len(ids) > self.max_entries:
+                return
+            self._sets[bot_username] = ids
+            self._size += len(ids)
+            self._evict(keep=bot_username)
+
+    def add(self, bot_username: str, user_id: int):
+        with self._lock:
+            self._versions[bot_username] = self._versions.get(bot_username, 0) + 1
+            ids = self._sets.get(bot_username)
+            if ids is not None and user_id not in ids:
+                ids.add(user_id)
+                self._size += 1
+                self._evict(keep=bot_username)
+
+    def discard(self, bot_username: str, user_id: int):
+        with self._lock:
+            self._versions[bot_username] = self._versions.get(bot_username, 0) + 1
+            ids = self._sets.get(bot_username)
+            if ids is not None and user_id in ids:
+                ids.remove(user_id)
+                self._size -= 1
+
+    def drop(self, bot_username: str):
+        """移除某个 Bot 的全部缓存（删除 Bot 时调用）"""
+        with self._lock:
+            self._versions[bot_username] = self._versions.get(bot_username, 0) + 1
+            ids = self._sets.pop(bot_username, None)
+            if ids is not None:
+                self._size -= len(ids)
+
+    def _evict(self, keep: str):
+        """超出上限时淘汰最久未使用的 Bot（调用方持有锁）"""
+        if not self.max_entries:
+            return
+        while self._size > self.max_entries and len(self._sets) > 1:
+            oldest = next(iter(self._sets))
+            if oldest == keep:
+                self._sets.move_to_end(oldest)
+                continue
+            self._size -= len(self._sets.pop(oldest))
+
+
+verified_cache = MembershipCache('verified_users', VERIFIED_CACHE_MAX_ENTRIES)
+# 黑名单通常很小，整表常驻内存
+blacklist_cache = MembershipCache('blacklist')
+
+
 # ================== 用户验证管理 ==================
 def is_verified(bot_username: str, user_id: int) -> bool:
-    """检查用户是否已验证"""
+    """检查用户是否已验证（优先查内存缓存）"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 1 FROM verified_users 
-            WHERE bot_username = ? AND user_id = ?
-        ''', (bot_username, user_id))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+        return verified_cache.contains(bot_username, user_id)
     except Exception as e:
         logger.error(f"❌ 检查验证状态失败: {e}")
         return False
 def add_verified_user(bot_username: str, user_id: int, user_name: str = '', user_username: str = '') -> bool:
     """添加已验证用户"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['membership']:
+            conn = shard.connection()
             cursor = conn.cursor()
+            # 用 UPSERT 而不是 INSERT OR REPLACE：REPLACE 删除旧行时不触发删除触发器，会让计数偏大
             cursor.execute('''
-                INSERT OR REPLACE INTO verified_users 
+                INSERT INTO verified_users 
                 (bot_username, user_id, user_name, user_username, verified_at)
                 VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_username, user_id) DO UPDATE SET
+                    user_name = excluded.user_name,
+                    user_username = excluded.user_username,
+                    verified_at = excluded.verified_at
             ''', (bot_username, user_id, user_name, user_username))
             conn.commit()
-            conn.close()
+            verified_cache.add(bot_username, user_id)
             logger.info(f"✅ 添加验证用户: {bot_username} - {user_id}")
             return True
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 添加验证用户失败: {e}")
         return False
 def remove_verified_user(bot_username: str, user_id: int) -> bool:
     """移除验证用户"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['membership']:
+            conn = shard.connection()
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM verified_users 
@@ -418,19 +1144,20 @@ def remove_verified_user(bot_username: str, user_id: int) -> bool:
             ''', (bot_username, user_id))
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
+            verified_cache.discard(bot_username, user_id)
             
             if affected > 0:
                 logger.info(f"✅ 移除验证用户: {bot_username} - {user_id}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 移除验证用户失败: {e}")
         return False
 def get_verified_users(bot_username: str) -> List[Dict]:
     """获取某个 Bot 的所有已验证用户"""
     try:
-        conn = get_connection()
+        conn = shard_for(bot_username).connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT user_id, user_name, user_username, verified_at
@@ -439,7 +1166,6 @@ def get_verified_users(bot_username: str) -> List[Dict]:
             ORDER BY verified_at DESC
         ''', (bot_username,))
         rows = cursor.fetchall()
-        conn.close()
         
         users = []
         for row in rows:
@@ -454,37 +1180,69 @@ def get_verified_users(bot_username: str) -> List[Dict]:
     except Exception as e:
         logger.error(f"❌ 查询验证用户失败: {e}")
         return []
-def get_verified_count(bot_username: str) -> int:
-    """获取已验证用户数量"""
+def _keyset_page(bot_username: str, table: str, ts_column: str, columns: str,
+                 limit: int, cursor: Optional[Tuple[str, int]], backward: bool) -> Tuple[List, bool]:
+    """
+    按 (时间, user_id) 倒序做游标分页，每页只读取一段索引区间
+    
+    cursor 为上一页边界行的 (时间, user_id)；backward=False 取更早的一页，
+    backward=True 取更新的一页。返回 (本页行（始终按时间倒序）, 该方向是否还有更多)。
+    """
+    conn = shard_for(bot_username).connection()
+    where = 'bot_username = ?'
+    params = [bot_username]
+    if cursor is not None:
+        where += f" AND ({ts_column}, user_id) {'>' if backward else '<'} (?, ?)"
+        params.extend(cursor)
+    order = 'ASC' if backward else 'DESC'
+    # 多取一行用于判断是否还有下一页
+    rows = conn.execute(f'''
+        SELECT {columns} FROM {table}
+        WHERE {where}
+        ORDER BY {ts_column} {order}, user_id {order}
+        LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+
+def get_verified_users_page(bot_username: str, limit: int = 20,
+                            cursor: Optional[Tuple[str, int]] = None,
+                            backward: bool = False) -> Tuple[List[Dict], bool]:
+    """
+    分页获取已验证用户（按验证时间倒序）
+    
+    cursor 传上一页第一行/最后一行的 (verified_at, user_id)，参见 _keyset_page。
+    """
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM verified_users 
-            WHERE bot_username = ?
-        ''', (bot_username,))
-        count = cursor.fetchone()['count']
-        conn.close()
-        return count
+        rows, has_more = _keyset_page(
+            bot_username, 'verified_users', 'verified_at',
+            'user_id, user_name, user_username, verified_at', limit, cursor, backward
+        )
+        return [dict(row) for row in rows], has_more
     except Exception as e:
-        logger.error(f"❌ 统计验证用户失败: {e}")
-        return 0
+        logger.error(f"❌ 分页查询验证用户失败: {e}")
+        return [], False
+
+
+def get_verified_count(bot_username: str) -> int:
+    """获取已验证用户数量（读取触发器维护的计数）"""
+    try:
+        return read_row_count('verified_users', bot_username)
+    except Exception as e:
+        logger.error(f"❌ 统计验证用户失败: {e}")
+        return 0
 
 
 # ================== 黑名单管理 ==================
 
 def is_blacklisted(bot_username: str, user_id: int) -> bool:
-    """检查用户是否在黑名单中"""
+    """检查用户是否在黑名单中（首次查询时加载该 Bot 的整个黑名单）"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 1 FROM blacklist 
-            WHERE bot_username = ? AND user_id = ?
-        ''', (bot_username, user_id))
-        exists = cursor.fetchone() is not None
-        conn.close()
-        return exists
+        return blacklist_cache.contains(bot_username, user_id)
     except Exception as e:
         logger.error(f"❌ 检查黑名单状态失败: {e}")
         return False
@@ -493,19 +1251,24 @@ def is_blacklisted(bot_username: str, user_id: int) -> bool:
 def add_to_blacklist(bot_username: str, user_id: int, reason: str = '') -> bool:
     """添加用户到黑名单"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['membership']:
+            conn = shard.connection()
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT OR REPLACE INTO blacklist 
+                INSERT INTO blacklist 
                 (bot_username, user_id, reason, blocked_at)
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(bot_username, user_id) DO UPDATE SET
+                    reason = excluded.reason,
+                    blocked_at = excluded.blocked_at
             ''', (bot_username, user_id, reason))
             conn.commit()
-            conn.close()
+            blacklist_cache.add(bot_username, user_id)
             logger.info(f"✅ 添加黑名单用户: {bot_username} - {user_id}")
             return True
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 添加黑名单用户失败: {e}")
         return False
 
@@ -513,8 +1276,9 @@ def add_to_blacklist(bot_username: str, user_id: int, reason: str = '') -> bool:
 def remove_from_blacklist(bot_username: str, user_id: int) -> bool:
     """从黑名单移除用户"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['membership']:
+            conn = shard.connection()
             cursor = conn.cursor()
             cursor.execute('''
                 DELETE FROM blacklist 
@@ -522,13 +1286,14 @@ def remove_from_blacklist(bot_username: str, user_id: int) -> bool:
             ''', (bot_username, user_id))
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
+            blacklist_cache.discard(bot_username, user_id)
             
             if affected > 0:
                 logger.info(f"✅ 移除黑名单用户: {bot_username} - {user_id}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 移除黑名单用户失败: {e}")
         return False
 
@@ -536,7 +1301,7 @@ def remove_from_blacklist(bot_username: str, user_id: int) -> bool:
 def get_blacklist(bot_username: str) -> List[int]:
     """获取某个 Bot 的黑名单用户ID列表"""
     try:
-        conn = get_connection()
+        conn = shard_for(bot_username).connection()
         cursor = conn.cursor()
         cursor.execute('''
             SELECT user_id FROM blacklist 
@@ -544,7 +1309,6 @@ def get_blacklist(bot_username: str) -> List[int]:
             ORDER BY blocked_at DESC
         ''', (bot_username,))
         rows = cursor.fetchall()
-        conn.close()
         
         return [row['user_id'] for row in rows]
     except Exception as e:
@@ -552,24 +1316,145 @@ def get_blacklist(bot_username: str) -> List[int]:
         return []
 
 
+def get_blacklist_page(bot_username: str, limit: int = 20,
+                       cursor: Optional[Tuple[str, int]] = None,
+                       backward: bool = False) -> Tuple[List[Dict], bool]:
+    """分页获取黑名单（按拉黑时间倒序），cursor 为边界行的 (blocked_at, user_id)"""
+    try:
+        rows, has_more = _keyset_page(
+            bot_username, 'blacklist', 'blocked_at', 'user_id, blocked_at', limit, cursor, backward
+        )
+        return [dict(row) for row in rows], has_more
+    except Exception as e:
+        logger.error(f"❌ 分页查询黑名单失败: {e}")
+        return [], False
+
+
 def get_blacklist_count(bot_username: str) -> int:
-    """获取黑名单用户数量"""
+    """获取黑名单用户数量（优先从内存集合统计）"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM blacklist 
-            WHERE bot_username = ?
-        ''', (bot_username,))
-        count = cursor.fetchone()['count']
-        conn.close()
-        return count
+        count = blacklist_cache.count(bot_username)
+        if count is None:
+            blacklist_cache.load(bot_username)
+            count = blacklist_cache.count(bot_username)
+        if count is not None:
+            return count
+        return read_row_count('blacklist', bot_username)
     except Exception as e:
         logger.error(f"❌ 统计黑名单用户失败: {e}")
         return 0
 
 
 # ================== 消息映射管理（新版：支持完整映射结构）==================
+#
+# 存储格式（message_map 表）：
+# - bot_id 引用 bots.id，不再每行重复 bot_username
+# - map_type 使用小整数编码
+# - 键和值统一拆成 (chat_id, message_id) 两个整数："chatid_msgid" -> (chatid, msgid)，
+#   纯数字 "n" -> (0, n)
+# 对外接口仍然使用字符串键值，编码/解码只在本模块内部进行。
+
+MAP_TYPE_CODES = {
+    'direct': 1,
+    'topic': 2,
+    'user_forward': 3,
+    'forward_user': 4,
+    'owner_user': 5,
+    'plain_forward': 6,
+}
+
+MAPPING_UPSERT_SQL = '''
+    INSERT INTO message_map 
+    (bot_id, map_type, key_chat, key_msg, value_chat, value_msg, user_id, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(bot_id, map_type, key_chat, key_msg) DO UPDATE SET
+        value_chat = excluded.value_chat,
+        value_msg = excluded.value_msg,
+        user_id = excluded.user_id,
+        updated_at = excluded.updated_at
+'''
+
+# bot_username -> bots.id 缓存（delete_bot 时失效）
+_bot_ids: Dict[str, int] = {}
+
+
+def _encode_ref(text) -> Tuple[int, int]:
+    """把映射键/值编码为 (chat_id, message_id)"""
+    chat, sep, msg = str(text).rpartition('_')
+    if sep:
+        return int(chat), int(msg)
+    return 0, int(msg)
+
+
+def _decode_ref(chat: int, msg: int) -> str:
+    """把 (chat_id, message_id) 还原为映射键/值字符串"""
+    return f"{chat}_{msg}" if chat else str(msg)
+
+
+def _get_bot_id(bot_username: str) -> Optional[int]:
+    """查询 Bot 的整数 ID（带缓存；bots 表始终在主库中）"""
+    bot_id = _bot_ids.get(bot_username)
+    if bot_id is None:
+        row = get_connection().execute('SELECT id FROM bots WHERE bot_username = ?', (bot_username,)).fetchone()
+        if row is None:
+            return None
+        bot_id = _bot_ids[bot_username] = row[0]
+    return bot_id
+
+
+def _mapping_row(bot_username: str, map_type: str, key: str, value: str, user_id: int = None, now: int = None):
+    """把一条字符串映射转换为 message_map 的行；Bot 不存在时返回 None"""
+    bot_id = _get_bot_id(bot_username)
+    if bot_id is None:
+        return None
+    key_chat, key_msg = _encode_ref(key)
+    value_chat, value_msg = _encode_ref(value)
+    return (bot_id, MAP_TYPE_CODES[map_type], key_chat, key_msg, value_chat, value_msg,
+            user_id, now if now is not None else int(time.time()))
+
+
+def migrate_message_mappings(cursor) -> int:
+    """
+    一次性把旧版 message_mappings（全 TEXT）迁移到 message_map，然后删除旧表
+    
+    无法解析的键值、已删除 Bot 的映射会被丢弃。返回迁移的行数。
+    """
+    logger.info("🔄 检测到旧的 message_mappings 表，正在迁移到紧凑格式...")
+    cursor.execute('PRAGMA table_info(message_mappings)')
+    columns = [row[1] for row in cursor.fetchall()]
+    # 最早的版本没有 map_type 列，全部视为直连映射
+    type_column = 'map_type' if 'map_type' in columns else "'direct'"
+    
+    source = cursor.connection.execute(f'''
+        SELECT bot_username, {type_column} AS map_type, key, value, user_id,
+               CAST(strftime('%s', COALESCE(created_at, CURRENT_TIMESTAMP)) AS INTEGER) AS ts
+        FROM message_mappings 
+        ORDER BY id
+    ''')
+    migrated = skipped = 0
+    while True:
+        batch = source.fetchmany(5000)
+        if not batch:
+            break
+        rows = []
+        for row in batch:
+            try:
+                mapped = _mapping_row(row['bot_username'], row['map_type'], row['key'], row['value'],
+                                      row['user_id'], row['ts'])
+            except (KeyError, ValueError):
+                mapped = None
+            if mapped is None:
+                skipped += 1
+            else:
+                rows.append(mapped)
+        # 按 id 顺序写入，同一个键以最后一次写入为准
+        cursor.executemany(MAPPING_UPSERT_SQL, rows)
+        migrated += len(rows)
+    
+    cursor.execute('DROP TABLE message_mappings')
+    logger.info(f"✅ 映射迁移完成：{migrated} 条已迁移，{skipped} 条无法解析已丢弃")
+    return migrated
+
 
 def set_mapping(bot_username: str, map_type: str, key: str, value: str, user_id: int = None) -> bool:
     """
@@ -577,7 +1462,7 @@ def set_mapping(bot_username: str, map_type: str, key: str, value: str, user_id:
     
     Args:
         bot_username: Bot用户名
-        map_type: 映射类型 ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user')
+        map_type: 映射类型 ('direct', 'topic', 'user_forward', 'forward_user', 'owner_user', 'plain_forward')
         key: 映射键
         value: 映射值（对于 topic 类型，这里是 topic_id 的字符串形式）
         user_id: 关联的用户ID（可选，用于清理）
@@ -590,27 +1475,22 @@ def set_mapping(bot_username: str, map_type: str, key: str, value: str, user_id:
     - owner_user: 主人消息ID -> 发送给用户的消息ID
     """
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['mapping']:
+            conn = shard.connection()
             cursor = conn.cursor()
             
-            # 先删除旧记录（确保唯一性）
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ? AND map_type = ? AND key = ?
-            ''', (bot_username, map_type, key))
-            
-            # 插入新记录
-            cursor.execute('''
-                INSERT INTO message_mappings 
-                (bot_username, map_type, key, value, user_id, updated_at)
-                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (bot_username, map_type, key, value, user_id))
+            row = _mapping_row(bot_username, map_type, key, value, user_id)
+            if row is None:
+                logger.warning(f"⚠️ 未知 Bot，忽略映射: {bot_username}")
+                return False
+            # 键已存在则覆盖（主键冲突时更新）
+            cursor.execute(MAPPING_UPSERT_SQL, row)
             
             conn.commit()
-            conn.close()
             return True
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 设置映射失败: {e}")
         return False
 
@@ -627,20 +1507,27 @@ def get_mapping(bot_username: str, map_type: str, key: str) -> Optional[str]:
     Returns:
         映射值，如果不存在返回 None
     """
+    # 尚未落盘的写入优先
+    pending = shard_for(bot_username).writer.get(bot_username, map_type, key)
+    if pending is not None:
+        return pending
+    
     try:
-        conn = get_connection()
+        conn = shard_for(bot_username).connection()
         cursor = conn.cursor()
         
+        bot_id = _get_bot_id(bot_username)
+        if bot_id is None:
+            return None
+        key_chat, key_msg = _encode_ref(key)
         cursor.execute('''
-            SELECT value FROM message_mappings 
-            WHERE bot_username = ? AND map_type = ? AND key = ?
-            ORDER BY updated_at DESC LIMIT 1
-        ''', (bot_username, map_type, key))
+            SELECT value_chat, value_msg FROM message_map 
+            WHERE bot_id = ? AND map_type = ? AND key_chat = ? AND key_msg = ?
+        ''', (bot_id, MAP_TYPE_CODES[map_type], key_chat, key_msg))
         
         row = cursor.fetchone()
-        conn.close()
         
-        return row['value'] if row else None
+        return _decode_ref(row[0], row[1]) if row else None
     except Exception as e:
         logger.error(f"❌ 查询映射失败: {e}")
         return None
@@ -658,44 +1545,72 @@ def get_all_mappings(bot_username: str, map_type: str) -> Dict[str, str]:
         映射字典 {key: value}
     """
     try:
-        conn = get_connection()
+        conn = shard_for(bot_username).connection()
         cursor = conn.cursor()
         
+        bot_id = _get_bot_id(bot_username)
+        if bot_id is None:
+            return {}
         cursor.execute('''
-            SELECT key, value FROM message_mappings 
-            WHERE bot_username = ? AND map_type = ?
-            ORDER BY updated_at DESC
-        ''', (bot_username, map_type))
-        
-        rows = cursor.fetchall()
-        conn.close()
+            SELECT key_chat, key_msg, value_chat, value_msg FROM message_map 
+            WHERE bot_id = ? AND map_type = ?
+        ''', (bot_id, MAP_TYPE_CODES[map_type]))
         
         # 转换为字典
-        mappings = {row['key']: row['value'] for row in rows}
+        mappings = {_decode_ref(row[0], row[1]): _decode_ref(row[2], row[3]) for row in cursor}
         return mappings
     except Exception as e:
         logger.error(f"❌ 查询所有映射失败: {e}")
         return {}
 
 
+def get_topic_user(bot_username: str, topic_id: int) -> Optional[int]:
+    """根据话题ID反查用户ID（走 idx_message_map_topic_user 索引）"""
+    try:
+        conn = shard_for(bot_username).connection()
+        cursor = conn.cursor()
+        
+        bot_id = _get_bot_id(bot_username)
+        if bot_id is None:
+            return None
+        # map_type 必须是字面量，查询规划器才能使用部分索引
+        cursor.execute(f'''
+            SELECT key_msg FROM message_map 
+            WHERE bot_id = ? AND map_type = {MAP_TYPE_CODES['topic']} AND value_msg = ?
+            LIMIT 1
+        ''', (bot_id, topic_id))
+        
+        row = cursor.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"❌ 反查话题用户失败: {e}")
+        return None
+
+
 def delete_mapping(bot_username: str, map_type: str, key: str) -> bool:
     """删除指定映射"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['mapping']:
+            shard.writer.discard(bot_username, map_type, key)
+            conn = shard.connection()
             cursor = conn.cursor()
             
+            bot_id = _get_bot_id(bot_username)
+            if bot_id is None:
+                return False
+            key_chat, key_msg = _encode_ref(key)
             cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ? AND map_type = ? AND key = ?
-            ''', (bot_username, map_type, key))
+                DELETE FROM message_map 
+                WHERE bot_id = ? AND map_type = ? AND key_chat = ? AND key_msg = ?
+            ''', (bot_id, MAP_TYPE_CODES[map_type], key_chat, key_msg))
             
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
             return affected > 0
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 删除映射失败: {e}")
         return False
 
@@ -703,47 +1618,226 @@ def delete_mapping(bot_username: str, map_type: str, key: str) -> bool:
 def clear_bot_mappings(bot_username: str) -> int:
     """清空某个Bot的所有映射"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['mapping']:
+            shard.writer.discard_bot(bot_username)
+            conn = shard.connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE bot_username = ?
-            ''', (bot_username,))
+            bot_id = _get_bot_id(bot_username)
+            if bot_id is None:
+                return 0
+            cursor.execute('DELETE FROM message_map WHERE bot_id = ?', (bot_id,))
             
             deleted = cursor.rowcount
             conn.commit()
-            conn.close()
             
             if deleted > 0:
                 logger.info(f"🧹 清空 {bot_username} 的 {deleted} 条映射")
             return deleted
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 清空映射失败: {e}")
         return 0
 
 
-def cleanup_old_mappings(days: int = 7) -> int:
-    """清理旧的消息映射（防止数据库过大）"""
+def _delete_in_chunks(family: str, delete_chunk, limit: Optional[int]) -> int:
+    """
+    在每个分片上分批删除：每批一个事务，批与批之间释放该分片对应表族的写锁
+    
+    limit 不为空时每个分片只执行一批（由调用方自行调度下一批），
+    返回值小于 limit 说明所有分片都已删完。
+    """
+    chunk = limit or MAINTENANCE_CHUNK_ROWS
+    total = 0
+    for shard in _shards:
+        while True:
+            with shard.locks[family]:
+                conn = shard.connection()
+                deleted = delete_chunk(conn.cursor(), chunk)
+                conn.commit()
+            total += deleted
+            if limit or deleted < chunk:
+                break
+    return total
+
+
+def cleanup_old_mappings(days: int = 7, limit: Optional[int] = None) -> int:
+    """
+    清理旧的消息映射（防止数据库过大）
+    
+    话题映射（用户 -> 话题）每个用户只有一行，且删除后用户会被分配新话题，因此不参与清理。
+    limit 指定时只删除一批，返回本批删除的行数。
+    """
+    cutoff = int(time.time()) - days * 86400
+    
+    def delete_chunk(cursor, chunk):
+        # message_map 是 WITHOUT ROWID 表，按主键分批删除
+        cursor.execute(f'''
+            DELETE FROM message_map 
+            WHERE (bot_id, map_type, key_chat, key_msg) IN (
+                SELECT bot_id, map_type, key_chat, key_msg FROM message_map 
+                WHERE updated_at < ? AND map_type != {MAP_TYPE_CODES['topic']}
+                LIMIT ?
+            )
+        ''', (cutoff, chunk))
+        return cursor.rowcount
+    
     try:
-        with db_lock:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                DELETE FROM message_mappings 
-                WHERE created_at < datetime('now', '-' || ? || ' days')
-            ''', (days,))
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
-            
-            if deleted > 0:
-                logger.info(f"🧹 清理 {deleted} 条旧消息映射")
-            return deleted
+        deleted = _delete_in_chunks('mapping', delete_chunk, limit)
+        if deleted > 0 and not limit:
+            logger.info(f"🧹 清理 {deleted} 条旧消息映射")
+        return deleted
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 清理消息映射失败: {e}")
         return 0
+
+
+# ================== 消息映射写缓冲 ==================
+class MappingWriter:
+    """
+    消息映射写缓冲（write-behind）
+    
+    映射写入先放进缓冲区，由后台线程每隔几十毫秒或攒够 N 行后
+    在一个事务里批量提交。同一个键的多次写入只保留最后一次。
+    提交之前，get_mapping 从本缓冲区（含正在提交的批次）读取这些映射；
+    提交之后数据库是权威数据，上层的 LRU 缓存未命中时回查数据库。
+    每个分片一个写缓冲和后台线程，不同分片的提交互不等待。
+    """
+
+    def __init__(self, interval_ms: int, max_rows: int, shard: Shard):
+        self.shard = shard
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._pending: Dict[Tuple[str, str, str], Tuple[str, Optional[int]]] = {}
+        self._inflight: Dict[Tuple[str, str, str], Tuple[str, Optional[int]]] = {}
+        self._cond = threading.Condition()
+        self._flush_lock = Lock()
+        self._thread = None
+        self._closed = False
+
+    def put(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None):
+        """加入写缓冲（不阻塞）"""
+        with self._cond:
+            self._pending[(bot_username, map_type, key)] = (value, user_id)
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name=f'db-mapping-writer-{self.shard.name}', daemon=True)
+                self._thread.start()
+            if len(self._pending) == 1 or len(self._pending) >= self.max_rows:
+                self._cond.notify()
+
+    def get(self, bot_username: str, map_type: str, key: str) -> Optional[str]:
+        """查询尚未落盘的映射值"""
+        item_key = (bot_username, map_type, key)
+        with self._cond:
+            item = self._pending.get(item_key) or self._inflight.get(item_key)
+        return item[0] if item else None
+
+    def discard(self, bot_username: str, map_type: str, key: str):
+        """
+        丢弃某个键尚未落盘的写入
+        
+        调用方须持有分片的 mapping 写锁：flush 只在该锁内取出缓冲区，
+        这样丢弃后紧接着执行的 DELETE 不会被正在提交的批次重新写回。
+        """
+        with self._cond:
+            self._pending.pop((bot_username, map_type, key), None)
+
+    def discard_bot(self, bot_username: str):
+        """丢弃某个 Bot 尚未落盘的全部写入（调用方须持有分片的 mapping 写锁）"""
+        with self._cond:
+            for item_key in [k for k in self._pending if k[0] == bot_username]:
+                del self._pending[item_key]
+
+    def flush(self) -> int:
+        """立即把缓冲区写入数据库，返回写入行数"""
+        if not self._pending:
+            return 0
+        with self._flush_lock, self.shard.locks['mapping']:
+            # 在写锁内取出缓冲区：删除映射的一方同样在写锁内 discard + DELETE，
+            # 两者互斥，取出的批次中不会包含已被删除的键
+            with self._cond:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+            now = int(time.time())
+            try:
+                conn = self.shard.connection()
+                cursor = conn.cursor()
+                rows = []
+                for (bot_username, map_type, key), (value, user_id) in batch.items():
+                    row = _mapping_row(bot_username, map_type, key, value, user_id, now)
+                    if row is not None:
+                        rows.append(row)
+                if len(rows) < len(batch):
+                    logger.warning(f"⚠️ 忽略 {len(batch) - len(rows)} 条未知 Bot 的映射")
+                cursor.executemany(MAPPING_UPSERT_SQL, rows)
+                conn.commit()
+                return len(rows)
+            except Exception as e:
+                rollback_quietly()
+                logger.error(f"❌ 批量写入映射失败（{len(batch)} 条，将重试）: {e}")
+                with self._cond:
+                    # 放回缓冲区（仍在写锁内），但不覆盖期间产生的更新写入
+                    for item_key, item in batch.items():
+                        self._pending.setdefault(item_key, item)
+                return 0
+            finally:
+                with self._cond:
+                    self._inflight = {}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # 第一条写入到达后再等一个周期，让同一批消息合并提交
+                deadline = time.monotonic() + self.interval
+                while len(self._pending) < self.max_rows and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if self.flush() == 0 and self._pending:
+                time.sleep(1)  # 写入失败，稍后重试
+
+    def close(self):
+        """停止后台线程并写入剩余数据"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        written = self.flush()
+        if written:
+            logger.info(f"💾 关闭前写入 {written} 条缓冲映射")
+
+
+for _shard in _shards:
+    _shard.writer = MappingWriter(MAPPING_FLUSH_INTERVAL_MS, MAPPING_FLUSH_MAX_ROWS, _shard)
+    atexit.register(_shard.writer.close)
+
+
+def queue_mapping(bot_username: str, map_type: str, key: str, value: str, user_id: int = None):
+    """
+    异步写入消息映射（write-behind，不阻塞调用方）
+    
+    参数同 set_mapping。数据会在几十毫秒内与其它映射合并成一个事务提交。
+    """
+    shard_for(bot_username).writer.put(bot_username, map_type, key, value, user_id)
+
+
+def flush_mappings() -> int:
+    """立即提交所有分片缓冲中的消息映射，返回写入行数"""
+    return sum(shard.writer.flush() for shard in _shards)
+
+
 # ================== JSON 数据迁移 ==================
 def migrate_from_json():
     """从旧版 JSON 文件迁移数据到数据库"""
@@ -794,46 +1888,80 @@ def migrate_from_json():
         raise
 
 # ================== 数据库维护 ==================
+def _file_size_kb(path: str) -> float:
+    return round(os.path.getsize(path) / 1024, 2) if os.path.exists(path) else 0
+
+
+def get_storage_stats() -> Dict:
+    """数据库文件大小与空闲页统计（主库和所有分片合计）"""
+    try:
+        page_count = freelist_count = 0
+        for shard in _all_shards:
+            conn = shard.connection()
+            page_count += conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count += conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return {
+            'page_size': get_connection().execute('PRAGMA page_size').fetchone()[0],
+            'page_count': page_count,
+            'freelist_count': freelist_count,
+            'file_size_kb': round(sum(_file_size_kb(shard.path) for shard in _all_shards), 2)
+        }
+    except Exception as e:
+        logger.error(f"❌ 获取存储统计失败: {e}")
+        return {}
+
+
+def incremental_vacuum(pages: int = 200) -> int:
+    """每个文件回收最多 pages 个空闲页（只短暂持有各自的写锁），返回剩余空闲页数"""
+    remaining = 0
+    for shard in _all_shards:
+        try:
+            with shard.lock_all():
+                conn = shard.connection()
+                conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+                remaining += conn.execute('PRAGMA freelist_count').fetchone()[0]
+        except Exception as e:
+            rollback_quietly()
+            logger.error(f"❌ 增量回收失败 ({shard.name}): {e}")
+    return remaining
+
+
+def checkpoint_wal() -> bool:
+    """执行一次 PASSIVE checkpoint，使增量回收后的文件截断落到主文件上"""
+    try:
+        for shard in _all_shards:
+            shard.connection().execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ WAL checkpoint 失败: {e}")
+        return False
+
+
 def vacuum_database():
-    """压缩数据库（释放空间）"""
+    """完整压缩数据库（重写整个文件并阻塞所有写入，日常请使用 incremental_vacuum）"""
     try:
-        conn = get_connection()
-        conn.execute('VACUUM')
-        conn.close()
+        for shard in _all_shards:
+            shard.connection().execute('VACUUM')
         logger.info("✅ 数据库压缩完成")
     except Exception as e:
         logger.error(f"❌ 数据库压缩失败: {e}")
 def get_database_stats() -> Dict:
     """获取数据库统计信息"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
         stats = {}
         
-        # Bot 数量
-        cursor.execute('SELECT COUNT(*) as count FROM bots')
-        stats['total_bots'] = cursor.fetchone()['count']
-        
-        # 验证用户数量
-        cursor.execute('SELECT COUNT(*) as count FROM verified_users')
-        stats['total_verified_users'] = cursor.fetchone()['count']
-        
-        # 黑名单用户数量
-        cursor.execute('SELECT COUNT(*) as count FROM blacklist')
-        stats['total_blacklisted_users'] = cursor.fetchone()['count']
-        
-        # 消息映射数量
-        cursor.execute('SELECT COUNT(*) as count FROM message_mappings')
-        stats['total_message_mappings'] = cursor.fetchone()['count']
+        # Bot、验证用户、黑名单用户、消息映射数量（读取计数表，各分片合计）
+        stats['total_bots'] = read_row_count('bots')
+        for key, table in (('total_verified_users', 'verified_users'),
+                           ('total_blacklisted_users', 'blacklist'),
+                           ('total_message_mappings', 'message_map')):
+            stats[key] = read_row_count(table)
         
         # 数据库文件大小
-        if os.path.exists(DB_FILE):
-            stats['db_size_kb'] = round(os.path.getsize(DB_FILE) / 1024, 2)
-        else:
-            stats['db_size_kb'] = 0
+        stats['db_size_kb'] = round(sum(_file_size_kb(shard.path) for shard in _all_shards), 2)
+        if len(_shards) > 1:
+            stats['shards'] = len(_shards)
         
-        conn.close()
         return stats
     except Exception as e:
         logger.error(f"❌ 获取数据库统计失败: {e}")
@@ -843,22 +1971,11 @@ def get_database_stats() -> Dict:
 def add_pending_verification(bot_username: str, user_id: int, captcha_answer: str) -> bool:
     """添加待验证用户"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['pending']:
+            conn = shard.connection()
             cursor = conn.cursor()
             
-            # 检查表是否存在，不存在则创建
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_verifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_username TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    captcha_answer TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(bot_username, user_id)
-                )
-            ''')
-            
             # 删除旧记录（如果存在）
             cursor.execute('''
                 DELETE FROM pending_verifications 
@@ -873,9 +1990,9 @@ def add_pending_verification(bot_username: str, user_id: int, captcha_answer: st
             ''', (bot_username, user_id, captcha_answer))
             
             conn.commit()
-            conn.close()
             return True
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 添加待验证用户失败: {e}")
         return False
 
@@ -883,28 +2000,15 @@ def add_pending_verification(bot_username: str, user_id: int, captcha_answer: st
 def get_pending_verification(bot_username: str, user_id: int) -> Optional[str]:
     """获取待验证用户的验证码答案"""
     try:
-        conn = get_connection()
+        conn = shard_for(bot_username).connection()
         cursor = conn.cursor()
         
-        # 确保表存在
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS pending_verifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bot_username TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                captcha_answer TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(bot_username, user_id)
-            )
-        ''')
-        
         cursor.execute('''
             SELECT captcha_answer FROM pending_verifications 
             WHERE bot_username = ? AND user_id = ?
         ''', (bot_username, user_id))
         
         row = cursor.fetchone()
-        conn.close()
         
         return row['captcha_answer'] if row else None
     except Exception as e:
@@ -915,8 +2019,9 @@ def get_pending_verification(bot_username: str, user_id: int) -> Optional[str]:
 def remove_pending_verification(bot_username: str, user_id: int) -> bool:
     """移除待验证用户"""
     try:
-        with db_lock:
-            conn = get_connection()
+        shard = shard_for(bot_username)
+        with shard.locks['pending']:
+            conn = shard.connection()
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -926,46 +2031,38 @@ def remove_pending_verification(bot_username: str, user_id: int) -> bool:
             
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
             return affected > 0
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 移除待验证用户失败: {e}")
         return False
 
 
-def cleanup_old_pending_verifications(hours: int = 24) -> int:
-    """清理过期的待验证记录（默认24小时）"""
-    try:
-        with db_lock:
-            conn = get_connection()
-            cursor = conn.cursor()
-            
-            # 确保表存在
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_verifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    bot_username TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    captcha_answer TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(bot_username, user_id)
-                )
-            ''')
-            
-            cursor.execute('''
-                DELETE FROM pending_verifications 
+def cleanup_old_pending_verifications(hours: int = 24, limit: Optional[int] = None) -> int:
+    """
+    清理过期的待验证记录（默认24小时）
+    
+    limit 指定时只删除一批，返回本批删除的行数。
+    """
+    def delete_chunk(cursor, chunk):
+        cursor.execute('''
+            DELETE FROM pending_verifications 
+            WHERE id IN (
+                SELECT id FROM pending_verifications 
                 WHERE created_at < datetime('now', '-' || ? || ' hours')
-            ''', (hours,))
-            
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
-            
-            if deleted > 0:
-                logger.info(f"🧹 清理 {deleted} 条过期的待验证记录")
-            return deleted
+                LIMIT ?
+            )
+        ''', (hours, chunk))
+        return cursor.rowcount
+    
+    try:
+        deleted = _delete_in_chunks('pending', delete_chunk, limit)
+        if deleted > 0 and not limit:
+            logger.info(f"🧹 清理 {deleted} 条过期的待验证记录")
+        return deleted
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 清理待验证记录失败: {e}")
         return 0
 
@@ -985,7 +2082,6 @@ def get_global_setting(key: str) -> Optional[str]:
         ''', (key,))
         
         row = cursor.fetchone()
-        conn.close()
         
         return row['value'] if row else None
     except Exception as e:
@@ -1007,10 +2103,10 @@ def set_global_setting(key: str, value: str) -> bool:
             ''', (key, value))
             
             conn.commit()
-            conn.close()
             logger.info(f"✅ 设置全局配置: {key}")
             return True
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 设置全局配置失败: {e}")
         return False
 
@@ -1029,13 +2125,13 @@ def delete_global_setting(key: str) -> bool:
             
             conn.commit()
             affected = cursor.rowcount
-            conn.close()
             
             if affected > 0:
                 logger.info(f"✅ 删除全局配置: {key}")
                 return True
             return False
     except Exception as e:
+        rollback_quietly()
         logger.error(f"❌ 删除全局配置失败: {e}")
         return False
 
@@ -1047,24 +2143,629 @@ def get_global_welcome() -> Optional[str]:
 
 def set_global_welcome(welcome_msg: str) -> bool:
     """设置管理员的全局欢迎语"""
-    return set_global_setting('global_welcome_msg', welcome_msg)
+    try:
+        return set_global_setting('global_welcome_msg', welcome_msg)
+    finally:
+        invalidate_welcome()
 
 
 def delete_global_welcome() -> bool:
     """删除管理员的全局欢迎语"""
-    return delete_global_setting('global_welcome_msg')
+    try:
+        return delete_global_setting('global_welcome_msg')
+    finally:
+        invalidate_welcome()
+
+
+# ================== 定时删除队列 ==================
+# 只是调度器（host_bot.DeletionScheduler）的持久化副本：调度在内存堆中进行，
+# 这里按批写入/删除，进程重启后由 get_pending_deletions 恢复
+
+def add_pending_deletions(rows: List[Tuple[str, int, int, int]]) -> int:
+    """批量登记定时删除，rows 为 (bot_username, chat_id, message_id, due_at 秒级时间戳)"""
+    if not rows:
+        return 0
+    try:
+        with db_lock:
+            conn = get_connection()
+            conn.executemany('''
+                INSERT INTO pending_deletions (bot_username, chat_id, message_id, due_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(bot_username, chat_id, message_id) DO UPDATE SET due_at = excluded.due_at
+            ''', rows)
+            conn.commit()
+            return len(rows)
+    except Exception as e:
+        rollback_quietly()
+        logger.error(f"❌ 登记定时删除失败: {e}")
+        return 0
+
+
+def remove_pending_deletions(keys: List[Tuple[str, int, int]]) -> int:
+    """批量移除已执行的定时删除，keys 为 (bot_username, chat_id, message_id)"""
+    if not keys:
+        return 0
+    try:
+        with db_lock:
+            conn = get_connection()
+            conn.executemany('''
+                DELETE FROM pending_deletions 
+                WHERE bot_username = ? AND chat_id = ? AND message_id = ?
+            ''', keys)
+            conn.commit()
+            return len(keys)
+    except Exception as e:
+        rollback_quietly()
+        logger.error(f"❌ 移除定时删除失败: {e}")
+        return 0
+
+
+def get_pending_deletions() -> List[Dict]:
+    """全部尚未执行的定时删除（按到期时间排序）"""
+    try:
+        rows = get_connection().execute('''
+            SELECT bot_username, chat_id, message_id, due_at 
+            FROM pending_deletions ORDER BY due_at
+        ''').fetchall()
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"❌ 查询定时删除失败: {e}")
+        return []
+
+
+# ================== 欢迎语缓存 ==================
+# bot_username -> (全局版本号, 解析后的欢迎语)；空字符串表示使用系统默认欢迎语
+_welcome_cache: Dict[str, Tuple[int, str]] = {}
+# 全局欢迎语每变更一次加一，旧版本的缓存条目全部失效
+_welcome_version = 0
+# 任意失效操作都会加一，用于丢弃解析期间已过期的结果
+_welcome_changes = 0
+_welcome_lock = Lock()
+
+
+def invalidate_welcome(bot_username: Optional[str] = None):
+    """使欢迎语缓存失效；不指定 Bot 时表示全局欢迎语发生了变化"""
+    global _welcome_version, _welcome_changes
+    with _welcome_lock:
+        _welcome_changes += 1
+        if bot_username is None:
+            _welcome_version += 1
+        else:
+            _welcome_cache.pop(bot_username, None)
+
+
+def peek_welcome_message(bot_username: str) -> Optional[str]:
+    """只查缓存：命中时返回解析后的欢迎语（可能为空字符串），未命中返回 None"""
+    with _welcome_lock:
+        entry = _welcome_cache.get(bot_username)
+        if entry is not None and entry[0] == _welcome_version:
+            return entry[1]
+        return None
+
+
+def resolve_welcome_message(bot_username: str) -> str:
+    """
+    解析某个 Bot 实际使用的欢迎语：自定义欢迎语 → 全局欢迎语
+    
+    两者都未设置时返回空字符串，由调用方回退到系统默认欢迎语。
+    """
+    cached = peek_welcome_message(bot_username)
+    if cached is not None:
+        return cached
+    
+    with _welcome_lock:
+        changes = _welcome_changes
+        version = _welcome_version
+    
+    # 直接查询而不是经由 get_bot / get_global_welcome：它们出错时返回 None，
+    # 会被当成"未设置"，把回退结果一直缓存到下次失效
+    try:
+        row = get_connection().execute('''
+            SELECT (SELECT welcome_msg FROM bots WHERE bot_username = ?),
+                   (SELECT value FROM global_settings WHERE key = 'global_welcome_msg')
+        ''', (bot_username,)).fetchone()
+    except Exception as e:
+        logger.error(f"❌ 查询欢迎语失败: {e}")
+        return ''  # 不缓存，下次重新查询
+    text = row[0] or row[1] or ''
+    
+    with _welcome_lock:
+        if _welcome_changes == changes:
+            _welcome_cache[bot_username] = (version, text)
+    return text
+
+
+# ================== 在线备份 ==================
+class _BackupRestarted(Exception):
+    """分步备份期间源库被反复修改，改为一次性复制"""
+
+
+# 分步备份最多允许重新开始的次数（源库被其它连接修改时 SQLite 会从头复制）
+BACKUP_MAX_RESTARTS = 3
+
+
+def _snapshot_file(source_path: str, dest_dir: str, timestamp: str, keep: int) -> str:
+    """把一个数据库文件备份为 gzip 快照，并只保留最新的 keep 份"""
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    tmp_path = os.path.join(dest_dir, f'.{stem}-{timestamp}.db.tmp')
+    snapshot_path = os.path.join(dest_dir, f'{stem}-{timestamp}.db.gz')
+    
+    source = sqlite3.connect(source_path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    target = sqlite3.connect(tmp_path)
+    try:
+        progress_state = {'remaining': None, 'restarts': 0}
+        
+        def progress(status, remaining, total):
+            last = progress_state['remaining']
+            if last is not None and remaining > last:
+                progress_state['restarts'] += 1
+                if progress_state['restarts'] > BACKUP_MAX_RESTARTS:
+                    raise _BackupRestarted()
+            progress_state['remaining'] = remaining
+        
+        try:
+            source.backup(target, pages=BACKUP_STEP_PAGES, progress=progress,
+                          sleep=BACKUP_STEP_SLEEP_MS / 1000)
+        except _BackupRestarted:
+            logger.info(f"🔁 备份期间 {stem} 频繁写入，改为一次性复制")
+            source.backup(target, pages=-1)
+        target.close()
+        target = None
+        
+        with open(tmp_path, 'rb') as raw, gzip.open(snapshot_path, 'wb') as packed:
+            shutil.copyfileobj(raw, packed)
+    finally:
+        source.close()
+        if target is not None:
+            target.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    # 清理超出保留份数的旧快照（文件名带时间戳，按名称排序即按时间排序）
+    snapshots = sorted(glob.glob(os.path.join(dest_dir, f'{stem}-*.db.gz')))
+    for old in snapshots[:-keep] if keep > 0 else []:
+        os.remove(old)
+    return snapshot_path
+
+
+def backup_database(dest_dir: str = None, keep: int = None) -> Optional[str]:
+    """
+    使用 SQLite 在线备份 API 生成一致性快照（gzip 压缩），返回主库快照路径
+    
+    按 BACKUP_STEP_PAGES 页分步复制，步与步之间短暂休眠，不阻塞写入；
+    如果期间源库被频繁修改导致复制反复重来，退化为在一个读事务内一次性复制
+    （WAL 模式下读事务同样不阻塞写入）。只保留最新的 keep 份快照。
+    分片时每个分片文件生成一份同一时间戳的快照，与主库快照放在同一目录。
+    """
+    dest_dir = dest_dir or BACKUP_DIR
+    keep = BACKUP_KEEP if keep is None else keep
+    os.makedirs(dest_dir, exist_ok=True)
+    
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    started = time.monotonic()
+    snapshots = [_snapshot_file(shard.path, dest_dir, timestamp, keep) for shard in _all_shards]
+    
+    size_kb = round(sum(os.path.getsize(path) for path in snapshots) / 1024, 2)
+    logger.info(f"💾 备份完成: {snapshots[0]}（{len(snapshots)} 个文件，{size_kb}KB，耗时 {time.monotonic() - started:.2f}s）")
+    return snapshots[0]
+
+
+class BackupService:
+    """
+    后台备份服务
+    
+    request() 只是登记一次备份请求并立即返回；后台线程执行备份。
+    备份进行中收到的多次请求合并为结束后的一次补充备份。
+    post_step(snapshot_path, silent) 在每次备份成功后调用（如推送到 GitHub）。
+    """
+
+    def __init__(self, post_step=None):
+        self.post_step = post_step
+        self._lock = Lock()
+        self._pending = False
+        self._silent = True
+        self._thread = None
+
+    def request(self, silent: bool = True):
+        with self._lock:
+            # 合并的请求中只要有一个需要通知，就发送通知
+            self._silent = (self._silent if self._pending else True) and silent
+            self._pending = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-backup', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+                silent = self._silent
+            try:
+                snapshot = backup_database()
+                if snapshot and self.post_step:
+                    self.post_step(snapshot, silent)
+            except Exception as e:
+                logger.error(f"❌ 备份失败: {e}")
+
+
+backup_service = BackupService()
+
+
+def request_backup(silent: bool = True):
+    """请求一次在线备份（合并并发请求，不阻塞调用方）"""
+    backup_service.request(silent)
+
+
+# ================== 异步访问 ==================
+# 数据库操作在专用线程中执行，事件循环只等待结果，某个 Bot 的慢提交不会阻塞其它 Bot。
+# - 写操作：每个 (分片, 表族) 一个写线程，同一族按提交顺序执行，不同族、不同分片并行
+# - 读操作：读线程池并发执行，不获取写锁，也不在写线程后面排队
+# - 维护操作（清理、回收、初始化）：单独的维护线程，不占用写线程
+_db_executor = _catalog.executor('catalog')
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_THREADS, thread_name_prefix='db-reader')
+
+
+def _mark_maintenance_thread():
+    """维护线程的访问不计入业务访问时间"""
+    _local.maintenance = True
+
+
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-maintenance',
+                                           initializer=_mark_maintenance_thread)
+
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """在主库写线程中执行同步函数并等待结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(func, *args, **kwargs))
+
+
+def get_lock_stats() -> Dict[str, Dict]:
+    """各写锁的等待统计（只包含使用过的锁），键为 “分片.表族”"""
+    return {lock.name: lock.stats()
+            for shard in _all_shards for lock in shard.locks.values() if lock.acquisitions}
+
+
+# ================== 存储后端 ==================
+class StorageBackend(ABC):
+    """
+    存储后端接口，用法：await db.aio.get_bot(bot_username)
+    
+    数据操作都是协程；queue_mapping 和 peek_* 是同步的快路径，不能阻塞事件循环。
+    SQLiteStorage 为默认实现，PostgresStorage（storage_pg.py）供多个宿主进程共享状态，
+    由环境变量 TG_BOT_STORAGE 选择。返回值格式与本模块的同名函数一致。
+    """
+    name = 'base'
+
+    # ---- 生命周期 ----
+    @abstractmethod
+    async def init_database(self): ...
+
+    @abstractmethod
+    async def close(self): ...
+
+    # ---- Bot 配置 ----
+    @abstractmethod
+    async def add_bot(self, bot_username: str, token: str, owner: int, welcome_msg: str = '') -> bool: ...
+
+    @abstractmethod
+    async def get_bot(self, bot_username: str) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def get_all_bots(self) -> Dict[str, Dict]: ...
+
+    @abstractmethod
+    async def get_bots_by_owner(self, owner: int) -> List[Dict]: ...
+
+    @abstractmethod
+    async def update_bot_welcome(self, bot_username: str, welcome_msg: str) -> bool: ...
+
+    @abstractmethod
+    async def update_bot_mode(self, bot_username: str, mode: str) -> bool: ...
+
+    @abstractmethod
+    async def update_bot_forum_id(self, bot_username: str, forum_group_id: int) -> bool: ...
+
+    @abstractmethod
+    async def delete_bot(self, bot_username: str) -> bool: ...
+
+    # ---- 已验证用户 ----
+    @abstractmethod
+    async def is_verified(self, bot_username: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def add_verified_user(self, bot_username: str, user_id: int, user_name: str = '', user_username: str = '') -> bool: ...
+
+    @abstractmethod
+    async def remove_verified_user(self, bot_username: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def get_verified_users(self, bot_username: str) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_verified_users_page(self, bot_username: str, limit: int = 20,
+                                      cursor: Optional[Tuple[str, int]] = None,
+                                      backward: bool = False) -> Tuple[List[Dict], bool]: ...
+
+    @abstractmethod
+    async def get_verified_count(self, bot_username: str) -> int: ...
+
+    # ---- 黑名单 ----
+    @abstractmethod
+    async def is_blacklisted(self, bot_username: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def add_to_blacklist(self, bot_username: str, user_id: int, reason: str = '') -> bool: ...
+
+    @abstractmethod
+    async def remove_from_blacklist(self, bot_username: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def get_blacklist(self, bot_username: str) -> List[int]: ...
+
+    @abstractmethod
+    async def get_blacklist_page(self, bot_username: str, limit: int = 20,
+                                 cursor: Optional[Tuple[str, int]] = None,
+                                 backward: bool = False) -> Tuple[List[Dict], bool]: ...
+
+    @abstractmethod
+    async def get_blacklist_count(self, bot_username: str) -> int: ...
+
+    # ---- 消息映射 ----
+    @abstractmethod
+    def queue_mapping(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None): ...
+
+    @abstractmethod
+    async def flush_mappings(self) -> int: ...
+
+    @abstractmethod
+    async def set_mapping(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None) -> bool: ...
+
+    @abstractmethod
+    async def get_mapping(self, bot_username: str, map_type: str, key: str) -> Optional[str]: ...
+
+    @abstractmethod
+    async def get_topic_user(self, bot_username: str, topic_id: int) -> Optional[int]: ...
+
+    @abstractmethod
+    async def delete_mapping(self, bot_username: str, map_type: str, key: str) -> bool: ...
+
+    @abstractmethod
+    async def clear_bot_mappings(self, bot_username: str) -> int: ...
+
+    @abstractmethod
+    async def cleanup_old_mappings(self, days: int = 7, limit: Optional[int] = None) -> int: ...
+
+    # ---- 待验证用户 ----
+    @abstractmethod
+    async def add_pending_verification(self, bot_username: str, user_id: int, captcha_answer: str) -> bool: ...
+
+    @abstractmethod
+    async def get_pending_verification(self, bot_username: str, user_id: int) -> Optional[str]: ...
+
+    @abstractmethod
+    async def remove_pending_verification(self, bot_username: str, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def cleanup_old_pending_verifications(self, hours: int = 24, limit: Optional[int] = None) -> int: ...
+
+    # ---- 全局设置 ----
+    @abstractmethod
+    async def get_global_setting(self, key: str) -> Optional[str]: ...
+
+    @abstractmethod
+    async def set_global_setting(self, key: str, value: str) -> bool: ...
+
+    @abstractmethod
+    async def delete_global_setting(self, key: str) -> bool: ...
+
+    @abstractmethod
+    async def get_global_welcome(self) -> Optional[str]: ...
+
+    @abstractmethod
+    async def set_global_welcome(self, welcome_msg: str) -> bool: ...
+
+    @abstractmethod
+    async def delete_global_welcome(self) -> bool: ...
+
+    @abstractmethod
+    async def resolve_welcome_message(self, bot_username: str) -> str: ...
+
+    # ---- 定时删除队列 ----
+    @abstractmethod
+    async def add_pending_deletions(self, rows: List[Tuple[str, int, int, int]]) -> int: ...
+
+    @abstractmethod
+    async def remove_pending_deletions(self, keys: List[Tuple[str, int, int]]) -> int: ...
+
+    @abstractmethod
+    async def get_pending_deletions(self) -> List[Dict]: ...
+
+    @abstractmethod
+    async def get_database_stats(self) -> Dict: ...
+
+    # ---- 本地缓存快路径（默认不缓存：多进程共享时本地缓存无法及时失效）----
+    def peek_verified(self, bot_username: str, user_id: int) -> Optional[bool]:
+        return None
+
+    def peek_blacklisted(self, bot_username: str, user_id: int) -> Optional[bool]:
+        return None
+
+    def peek_welcome_message(self, bot_username: str) -> Optional[str]:
+        return None
+
+    # ---- 维护（默认无操作，由数据库服务自身负责）----
+    async def get_storage_stats(self) -> Dict:
+        return {}
+
+    async def incremental_vacuum(self, pages: int = 200) -> int:
+        return 0
+
+    async def checkpoint_wal(self) -> bool:
+        return True
+
+    async def repair_counters(self) -> int:
+        return 0
+
+    def seconds_since_last_activity(self) -> float:
+        return float('inf')
+
+    def get_lock_stats(self) -> Dict[str, Dict]:
+        return {}
+
+    def request_backup(self, silent: bool = True):
+        logger.info(f"⏭️ 存储后端 {self.name} 不支持在线备份，请使用数据库自带的备份工具")
+
+
+def _async_method(func, pick_executor):
+    """把本模块的同步函数包装为异步方法，pick_executor(*args) 决定在哪个线程执行"""
+    async def method(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pick_executor(*args), partial(func, *args, **kwargs))
+
+    method.__name__ = func.__name__
+    method.__doc__ = func.__doc__
+    return method
+
+
+def _in_db_thread(func):
+    """主库写线程（bots、global_settings）"""
+    return _async_method(func, lambda *args: _db_executor)
+
+
+def _in_read_thread(func):
+    """读线程池"""
+    return _async_method(func, lambda *args: _read_executor)
+
+
+def _in_maintenance_thread(func):
+    """维护线程"""
+    return _async_method(func, lambda *args: _maintenance_executor)
+
+
+def _in_shard_thread(family: str, func):
+    """按第一个参数 bot_username，在所属分片该表族的写线程中执行"""
+    return _async_method(func, lambda bot_username, *args: shard_for(bot_username).executor(family))
+
+
+class SQLiteStorage(StorageBackend):
+    """本地 SQLite 文件（默认后端），读写分别在读线程池和各表族的写线程中执行"""
+    name = 'sqlite'
+
+    init_database = _in_maintenance_thread(init_database)
+
+    async def close(self):
+        await run_in_db_thread(flush_mappings)
+
+    add_bot = _in_db_thread(add_bot)
+    get_bot = _in_read_thread(get_bot)
+    get_all_bots = _in_read_thread(get_all_bots)
+    get_bots_by_owner = _in_read_thread(get_bots_by_owner)
+    update_bot_welcome = _in_db_thread(update_bot_welcome)
+    update_bot_mode = _in_db_thread(update_bot_mode)
+    update_bot_forum_id = _in_db_thread(update_bot_forum_id)
+    delete_bot = _in_db_thread(delete_bot)
+
+    is_verified = _in_read_thread(is_verified)
+    add_verified_user = _in_shard_thread('membership', add_verified_user)
+    remove_verified_user = _in_shard_thread('membership', remove_verified_user)
+    get_verified_users = _in_read_thread(get_verified_users)
+    get_verified_users_page = _in_read_thread(get_verified_users_page)
+    get_verified_count = _in_read_thread(get_verified_count)
+
+    is_blacklisted = _in_read_thread(is_blacklisted)
+    add_to_blacklist = _in_shard_thread('membership', add_to_blacklist)
+    remove_from_blacklist = _in_shard_thread('membership', remove_from_blacklist)
+    get_blacklist = _in_read_thread(get_blacklist)
+    get_blacklist_page = _in_read_thread(get_blacklist_page)
+    get_blacklist_count = _in_read_thread(get_blacklist_count)
+
+    def queue_mapping(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None):
+        queue_mapping(bot_username, map_type, key, value, user_id)
+
+    flush_mappings = _in_maintenance_thread(flush_mappings)
+    set_mapping = _in_shard_thread('mapping', set_mapping)
+    get_mapping = _in_read_thread(get_mapping)
+    get_topic_user = _in_read_thread(get_topic_user)
+    delete_mapping = _in_shard_thread('mapping', delete_mapping)
+    clear_bot_mappings = _in_shard_thread('mapping', clear_bot_mappings)
+    cleanup_old_mappings = _in_maintenance_thread(cleanup_old_mappings)
+
+    add_pending_verification = _in_shard_thread('pending', add_pending_verification)
+    get_pending_verification = _in_read_thread(get_pending_verification)
+    remove_pending_verification = _in_shard_thread('pending', remove_pending_verification)
+    cleanup_old_pending_verifications = _in_maintenance_thread(cleanup_old_pending_verifications)
+
+    get_global_setting = _in_read_thread(get_global_setting)
+    set_global_setting = _in_db_thread(set_global_setting)
+    delete_global_setting = _in_db_thread(delete_global_setting)
+    get_global_welcome = _in_read_thread(get_global_welcome)
+    set_global_welcome = _in_db_thread(set_global_welcome)
+    delete_global_welcome = _in_db_thread(delete_global_welcome)
+    resolve_welcome_message = _in_read_thread(resolve_welcome_message)
+    add_pending_deletions = _in_db_thread(add_pending_deletions)
+    remove_pending_deletions = _in_db_thread(remove_pending_deletions)
+    get_pending_deletions = _in_read_thread(get_pending_deletions)
+    get_database_stats = _in_read_thread(get_database_stats)
+
+    def peek_verified(self, bot_username: str, user_id: int) -> Optional[bool]:
+        return verified_cache.peek(bot_username, user_id)
+
+    def peek_blacklisted(self, bot_username: str, user_id: int) -> Optional[bool]:
+        return blacklist_cache.peek(bot_username, user_id)
+
+    def peek_welcome_message(self, bot_username: str) -> Optional[str]:
+        return peek_welcome_message(bot_username)
+
+    get_storage_stats = _in_maintenance_thread(get_storage_stats)
+    incremental_vacuum = _in_maintenance_thread(incremental_vacuum)
+    checkpoint_wal = _in_maintenance_thread(checkpoint_wal)
+    repair_counters = _in_maintenance_thread(repair_counters)
+
+    def seconds_since_last_activity(self) -> float:
+        return seconds_since_last_app_activity()
+
+    def get_lock_stats(self) -> Dict[str, Dict]:
+        return get_lock_stats()
+
+    def request_backup(self, silent: bool = True):
+        request_backup(silent)
+
+
+def create_storage() -> StorageBackend:
+    """按 TG_BOT_STORAGE 创建存储后端"""
+    if STORAGE_BACKEND in ('postgres', 'postgresql', 'pg'):
+        from storage_pg import PostgresStorage
+        return PostgresStorage()
+    if STORAGE_BACKEND != 'sqlite':
+        logger.warning(f"⚠️ 未知的存储后端 {STORAGE_BACKEND}，使用 SQLite")
+    return SQLiteStorage()
+
+
+aio = create_storage()
+
+
+def shutdown():
+    """关闭数据库线程（进程退出前调用）"""
+    for shard in _shards:
+        shard.writer.close()
+    writers = [executor for shard in _all_shards for executor in shard.executors()]
+    for executor in writers + [_maintenance_executor]:
+        executor.submit(close_connection)
+        executor.shutdown(wait=True)
+    _read_executor.shutdown(wait=True)
+    close_connection()
 
 
 # ================== 启动时初始化 ==================
-# 模块导入时自动初始化数据库
-init_database()
-
-# 清理过期数据（可选）
-try:
-    cleanup_old_pending_verifications(24)  # 清理24小时前的待验证记录
-    cleanup_old_mappings(7)  # 清理7天前的消息映射
-except Exception as e:
-    logger.error(f"清理过期数据失败: {e}")
+# 模块导入时自动初始化数据库（仅 SQLite 后端；PostgreSQL 在 await aio.init_database() 时初始化）
+# 过期数据由 host_bot 的后台维护任务定期分批清理
+if isinstance(aio, SQLiteStorage):
+    init_database()
+
 if __name__ == '__main__':
     # 测试代码
     print("数据库测试模式")
@@ -2,17 +2,25 @@
 import os
 import logging
 import asyncio
+import bisect
+import contextvars
+import heapq
+import itertools
 import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
 from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat,
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 )
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -22,33 +30,843 @@ import database as db
 # ================== 配置 ==================
 ADMIN_CHANNEL = os.environ.get("ADMIN_CHANNEL")      # 宿主通知群/频道（可选）
 MANAGER_TOKEN = os.environ.get("MANAGER_TOKEN")      # 管理机器人 Token（必须）
+MSG_MAP_CACHE_SIZE = int(os.environ.get("TG_BOT_MSG_MAP_CACHE_SIZE", "20000"))  # 内存中最多缓存的消息映射条数
+MAINTENANCE_INTERVAL = int(os.environ.get("TG_BOT_MAINTENANCE_INTERVAL", "3600"))   # 后台维护间隔（秒，0 表示关闭）
+MAPPING_RETENTION_DAYS = int(os.environ.get("TG_BOT_MAPPING_RETENTION_DAYS", "7"))  # 消息映射保留天数
+PENDING_RETENTION_HOURS = int(os.environ.get("TG_BOT_PENDING_RETENTION_HOURS", "24"))  # 待验证记录保留小时数
+VACUUM_PAGES = int(os.environ.get("TG_BOT_VACUUM_PAGES", "200"))                  # 每次增量回收的页数
+VACUUM_IDLE_SECONDS = float(os.environ.get("TG_BOT_VACUUM_IDLE", "2"))            # 数据库空闲多少秒后才回收下一批
+VACUUM_MAX_SECONDS = float(os.environ.get("TG_BOT_VACUUM_MAX_SECONDS", "300"))    # 每轮维护回收的最长时间
+LIST_PAGE_SIZE = int(os.environ.get("TG_BOT_LIST_PAGE_SIZE", "20"))               # 黑名单/已验证用户列表每页条数
+CONCURRENT_UPDATES = int(os.environ.get("TG_BOT_CONCURRENT_UPDATES", "16"))      # 每个子 Bot 同时处理的更新数（1 表示逐条处理）
+# 按 Bot 覆盖并发数，格式：bot1=32,bot2=4
+CONCURRENT_UPDATES_PER_BOT = {
+    name.strip().lstrip("@"): int(limit)
+    for name, _, limit in (
+        item.partition("=") for item in os.environ.get("TG_BOT_CONCURRENT_UPDATES_PER_BOT", "").split(",")
+    )
+    if name.strip() and limit.strip().isdigit()
+}
+# 发送限速（每个 Bot 独立计算）：全局每秒条数 / 单个私聊每秒条数 / 单个群组每分钟条数 / 单个会话可突发的条数
+RATE_GLOBAL_PER_SECOND = float(os.environ.get("TG_BOT_RATE_GLOBAL", "30"))
+RATE_CHAT_PER_SECOND = float(os.environ.get("TG_BOT_RATE_PER_CHAT", "1"))
+RATE_GROUP_PER_MINUTE = float(os.environ.get("TG_BOT_RATE_GROUP_PER_MINUTE", "20"))
+RATE_CHAT_BURST = int(os.environ.get("TG_BOT_RATE_CHAT_BURST", "3"))
+RATE_MAX_RETRIES = int(os.environ.get("TG_BOT_RATE_MAX_RETRIES", "3"))           # 遇到 RetryAfter 时最多重试次数
+HEADER_IDLE_SECONDS = float(os.environ.get("TG_BOT_HEADER_IDLE_SECONDS", "300"))  # 直连模式同一用户隔多久重新显示用户信息表头（0 表示每条都显示）
+ALBUM_WINDOW_SECONDS = int(os.environ.get("TG_BOT_ALBUM_WINDOW_MS", "800")) / 1000  # 相册消息合并等待时间
+AUTO_DELETE_BATCH = int(os.environ.get("TG_BOT_AUTO_DELETE_BATCH", "50"))        # 自动删除每批最多删除的消息数
+AUTO_DELETE_SAVE_DELAY = float(os.environ.get("TG_BOT_AUTO_DELETE_SAVE_DELAY", "15"))  # 登记多少秒后仍未删除才写入数据库
+COUNTER_REPAIR_INTERVAL = int(os.environ.get("TG_BOT_COUNTER_REPAIR_INTERVAL", "86400"))  # 计数校正间隔（秒，0 表示关闭）
 
-bots_data = {}
-msg_map = {}
 pending_verifications = {}  # 待验证用户（内存临时数据）
 running_apps = {}
+last_counter_repair = 0.0   # 上次校正计数的时间（time.monotonic）
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# ================== 工具函数 ==================
-def load_bots():
-    """从数据库加载 Bot 配置"""
-    global bots_data
-    all_bots = db.get_all_bots()
+# ================== Bot 配置索引 ==================
+class BotRegistry:
+    """
+    托管 Bot 配置的内存索引
     
-    bots_data = {}
-    for bot_username, bot_info in all_bots.items():
-        owner_id = str(bot_info['owner'])
-        if owner_id not in bots_data:
-            bots_data[owner_id] = {"bots": []}
-        bots_data[owner_id]["bots"].append({
+    同时按 bot_username、owner 和 token 建立索引，查询都是 O(1)；
+    增删改只更新受影响的条目，不再整表重载。
+    """
+
+    def __init__(self):
+        self._by_name = {}    # bot_username -> cfg
+        self._by_owner = {}   # owner_id(str) -> {bot_username: cfg}（保持添加顺序）
+        self._tokens = {}     # token -> bot_username
+
+    def load(self, all_bots: dict):
+        """用数据库中的全部 Bot 重建索引（仅启动时调用）"""
+        self._by_name.clear()
+        self._by_owner.clear()
+        self._tokens.clear()
+        for bot_username, bot_info in all_bots.items():
+            self.add(
+                bot_info['owner'], bot_username, bot_info['token'],
+                welcome_msg=bot_info.get('welcome_msg', ''),
+                mode=bot_info.get('mode') or 'direct',
+                forum_group_id=bot_info.get('forum_group_id')
+            )
+
+    def add(self, owner_id, bot_username: str, token: str, welcome_msg: str = '',
+            mode: str = 'direct', forum_group_id=None, created_at: str = None) -> dict:
+        """登记一个 Bot（同名 Bot 会被替换）"""
+        self.remove(bot_username)
+        owner_id = str(owner_id)
+        cfg = {
             "bot_username": bot_username,
-            "token": bot_info['token'],
-            "welcome_msg": bot_info.get('welcome_msg', ''),
-            "mode": bot_info.get('mode', 'direct'),
-            "forum_group_id": bot_info.get('forum_group_id')
-        })
+            "token": token,
+            "owner": owner_id,
+            "welcome_msg": welcome_msg,
+            "mode": mode,
+            "forum_group_id": forum_group_id
+        }
+        if created_at:
+            cfg["created_at"] = created_at
+        self._by_name[bot_username] = cfg
+        self._by_owner.setdefault(owner_id, {})[bot_username] = cfg
+        self._tokens[token] = bot_username
+        return cfg
+
+    def remove(self, bot_username: str):
+        """移除一个 Bot，返回被移除的配置"""
+        cfg = self._by_name.pop(bot_username, None)
+        if cfg is None:
+            return None
+        owned = self._by_owner.get(cfg["owner"])
+        if owned is not None:
+            owned.pop(bot_username, None)
+            if not owned:
+                del self._by_owner[cfg["owner"]]
+        if self._tokens.get(cfg["token"]) == bot_username:
+            del self._tokens[cfg["token"]]
+        return cfg
+
+    def update(self, bot_username: str, **fields) -> bool:
+        """更新 Bot 的可变字段（mode / forum_group_id / welcome_msg）"""
+        cfg = self._by_name.get(bot_username)
+        if cfg is None:
+            return False
+        cfg.update(fields)
+        return True
+
+    def get(self, bot_username: str):
+        return self._by_name.get(bot_username)
+
+    def get_owned(self, owner_id, bot_username: str):
+        """获取属于某个 owner 的 Bot 配置，不属于该 owner 时返回 None"""
+        return self._by_owner.get(str(owner_id), {}).get(bot_username)
+
+    def by_owner(self, owner_id) -> list:
+        """某个 owner 的全部 Bot（按添加顺序）"""
+        return list(self._by_owner.get(str(owner_id), {}).values())
+
+    def owners(self) -> list:
+        return list(self._by_owner.keys())
+
+    def has_token(self, token: str) -> bool:
+        return token in self._tokens
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(list(self._by_name.values()))
+
+
+bots_data = BotRegistry()
+
+# ================== 消息映射缓存 ==================
+class MessageMapCache:
+    """
+    消息映射的 LRU 缓存
+    
+    按 (bot_username, 映射类型, key) 缓存最近用到的映射，超出容量时淘汰
+    最久未使用的条目；未命中时由调用方回查数据库（主键/索引查询）。
+    启动时不再预加载，内存占用与历史消息总量无关。
+    
+    映射类型与数据库一致，另有仅存在于内存的 "topic_user"（话题ID -> 用户ID）。
+    只在事件循环线程中访问，无需加锁。
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+
+    def get(self, bot_username: str, map_type: str, key):
+        entry_key = (bot_username, map_type, key)
+        value = self._entries.get(entry_key)
+        if value is not None:
+            self._entries.move_to_end(entry_key)
+        return value
+
+    def put(self, bot_username: str, map_type: str, key, value):
+        entry_key = (bot_username, map_type, key)
+        self._entries[entry_key] = value
+        self._entries.move_to_end(entry_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, bot_username: str, map_type: str, key):
+        self._entries.pop((bot_username, map_type, key), None)
+
+    def drop_bot(self, bot_username: str):
+        """移除某个 Bot 的全部缓存映射（删除 Bot 时调用）"""
+        for entry_key in [k for k in self._entries if k[0] == bot_username]:
+            del self._entries[entry_key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+msg_map = MessageMapCache(MSG_MAP_CACHE_SIZE)
+
+# ================== 更新并发处理 ==================
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    子 Bot 的更新处理器：不同会话并发处理，同一会话严格按到达顺序处理
+    
+    每个会话（私聊；话题群中按话题区分）一把 FIFO 锁，保证同一用户的
+    消息和随后的编辑按顺序转发；慢调用（建话题、get_chat 等）只阻塞该会话。
+    max_running 限制同时执行的处理器数量，只由 _running 控制。PTB 为每条
+    更新建一个任务，并在调用 do_process_update 前先占用基类的信号量，
+    所以基类的名额设得足够大：在会话锁上排队的更新既不占执行名额，也不
+    占基类名额，一个用户连发很多条消息不会挤占其他用户。
+    """
+
+    # 基类信号量的名额（PTB 取更新不会因此暂停，这里只是让它不起限制作用）
+    ADMISSION_LIMIT = 1 << 30
+
+    def __init__(self, max_running: int):
+        max_running = max(1, max_running)
+        # 并发数为 1 时 PTB 逐条 await 处理，保持原来的串行行为
+        super().__init__(self.ADMISSION_LIMIT if max_running > 1 else 1)
+        self.max_running = max_running
+        self._running = asyncio.BoundedSemaphore(max_running)
+        self._chats = {}   # 会话键 -> [锁, 持有或等待该锁的更新数]
+
+    @staticmethod
+    def chat_key(update):
+        """会话键：(chat_id, 话题ID)；没有会话的更新（如内联查询）按用户区分"""
+        if not isinstance(update, Update):
+            return None
+        message = update.effective_message
+        if message is not None:
+            thread_id = message.message_thread_id if message.is_topic_message else None
+            return (message.chat_id, thread_id)
+        if update.effective_chat is not None:
+            return (update.effective_chat.id, None)
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.chat_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chats.pop(key, None)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def concurrent_updates_for(bot_username: str) -> int:
+    """某个子 Bot 的更新并发数（TG_BOT_CONCURRENT_UPDATES_PER_BOT 优先）"""
+    return CONCURRENT_UPDATES_PER_BOT.get(bot_username, CONCURRENT_UPDATES)
+
+def build_subbot_app(token: str, owner_id: int, bot_username: str) -> Application:
+    """创建子 Bot 的 Application 并注册处理器（按会话并发处理更新）"""
+    app = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates_for(bot_username)))
+        .rate_limiter(PriorityRateLimiter())
+        .build()
+    )
+    app.add_handler(CommandHandler("start", subbot_start))
+    # 处理普通消息
+    app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
+    # 处理编辑消息 - 使用 filters.UpdateType.EDITED_MESSAGE
+    app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
+    # 💡 添加回调处理器（处理 /id 命令的按钮）
+    app.add_handler(CallbackQueryHandler(callback_handler))
+    return app
+
+# ================== 发送限速 ==================
+# 发送优先级（数值越小越先发送）：主人回复、验证码 > 普通转发 > 提示消息、管理日志
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+_send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_NORMAL)
+
+@contextmanager
+def send_priority(priority: int):
+    """在 with 块内发出的请求使用指定的优先级（对 message.reply_text 等快捷方法同样有效）"""
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+_wait_on_flood = contextvars.ContextVar("wait_on_flood", default=True)
+
+@contextmanager
+def fail_on_flood():
+    """
+    在 with 块内发出的请求不等待限流：目标会话因 RetryAfter 暂停时立即抛出 RetryAfter
+    
+    用于持有锁期间的发送，调用方捕获后先释放锁再按普通方式重发。
+    """
+    token = _wait_on_flood.set(False)
+    try:
+        yield
+    finally:
+        _wait_on_flood.reset(token)
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多存 capacity 个；blocked_until 之前不发放（RetryAfter）"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """还要等多少秒才能取到一个令牌（0 表示现在就可以）"""
+        self.refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def is_idle(self, now: float) -> bool:
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Bot 的发送限速器（每个 Application 一个）
+    
+    发送类请求（send*/copy/forward/edit）先排队，由后台任务按优先级发放令牌：
+    同时受全局令牌桶和目标会话令牌桶限制。某个会话的令牌用完时跳过它，
+    先发其他会话的请求；同一会话同一优先级保持先后顺序。
+    遇到 RetryAfter 时暂停该会话，按原来的顺序重新排队，不再直接丢弃
+    （fail_on_flood 块内的请求改为直接抛出 RetryAfter）。
+    其他请求（get_chat、删除消息、回调应答等）不排队。
+    """
+
+    __slots__ = ("_global", "_chats", "_queue", "_seq", "_wakeup", "_task")
+
+    LIMITED_ENDPOINTS = ("send", "copyMessage", "forwardMessage", "editMessage")
+    # 会话令牌桶超过这个数量时清理空闲的桶
+    MAX_IDLE_BUCKETS = 1024
+
+    def __init__(self):
+        self._global = TokenBucket(RATE_GLOBAL_PER_SECOND, RATE_GLOBAL_PER_SECOND)
+        self._chats = {}        # chat_id(str) -> TokenBucket
+        self._queue = []        # 按 (优先级, 序号) 排序的 [(优先级, 序号, chat_id, future)]
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, _, _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(self.LIMITED_ENDPOINTS) or "chat_id" not in data:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else _send_priority.get()
+        chat = str(data["chat_id"])
+        wait_on_flood = _wait_on_flood.get()
+        if not wait_on_flood:
+            blocked = self._bucket(chat).blocked_until - time.monotonic()
+            if blocked > 0:
+                raise RetryAfter(int(blocked) + 1)
+        seq = next(self._seq)
+        for attempt in range(RATE_MAX_RETRIES + 1):
+            await self._acquire(priority, seq, chat)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                self._bucket(chat).blocked_until = time.monotonic() + delay
+                if attempt >= RATE_MAX_RETRIES or not wait_on_flood:
+                    raise
+                logger.warning(f"⏳ 触发限流 {endpoint} chat={chat}，{delay:.0f}s 后重试（第 {attempt + 1} 次）")
+
+    def _bucket(self, chat: str) -> TokenBucket:
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            # 私聊 chat_id 为正数；群组/频道为负数或 @用户名
+            if chat.startswith(("-", "@")):
+                bucket = TokenBucket(RATE_GROUP_PER_MINUTE / 60, RATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(RATE_CHAT_PER_SECOND, RATE_CHAT_BURST)
+            self._chats[chat] = bucket
+        return bucket
+
+    async def _acquire(self, priority: int, seq: int, chat: str):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._queue, (priority, seq, chat, future), key=lambda item: item[:2])
+        self._wakeup.set()
+        await future
+
+    def _grant(self, now: float):
+        """按优先级发放令牌，返回下一次需要检查的等待秒数（None 表示队列已空）"""
+        next_wait = None
+        skipped = set()    # 本轮令牌不足的会话：后面同会话的请求也不能越过前面的
+        i = 0
+        while i < len(self._queue):
+            priority, seq, chat, future = self._queue[i]
+            if future.done():   # 调用方已取消
+                del self._queue[i]
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait
+            if chat in skipped:
+                i += 1
+                continue
+            wait = self._bucket(chat).wait_time(now)
+            if wait > 0:
+                skipped.add(chat)
+                next_wait = wait if next_wait is None else min(next_wait, wait)
+                i += 1
+                continue
+            self._global.tokens -= 1
+            self._chats[chat].tokens -= 1
+            del self._queue[i]
+            future.set_result(None)
+        return next_wait
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            timeout = self._grant(now)
+            if len(self._chats) > self.MAX_IDLE_BUCKETS:
+                waiting = {item[2] for item in self._queue}
+                for chat in [c for c, b in self._chats.items() if c not in waiting and b.is_idle(now)]:
+                    del self._chats[chat]
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self):
+        return len(self._queue)
+
+# ================== 直连模式用户信息表头 ==================
+class HeaderSessions:
+    """
+    直连模式下主人私聊中"当前正在显示的对话"（每个 Bot 一个）
+    
+    同一用户连续发来的消息只在第一条前显示 "👤 昵称 (@用户名)" 表头；主人私聊里
+    最后显示的是其他用户，或距该用户上一条消息超过 idle_seconds 秒时重新显示。
+    Bot 向主人发送其他涉及具体用户的消息（验证通知、编辑提示、用户信息等）后
+    调用 reset，下一条转发重新带表头。只在事件循环线程中访问。
+    """
+
+    def __init__(self, idle_seconds: float):
+        self.idle_seconds = idle_seconds
+        self._last = {}    # bot_username -> (user_id, 最后显示时间 time.monotonic)
+        self._locks = {}   # bot_username -> asyncio.Lock
+
+    def lock(self, bot_username: str) -> asyncio.Lock:
+        lock = self._locks.get(bot_username)
+        if lock is None:
+            lock = self._locks[bot_username] = asyncio.Lock()
+        return lock
+
+    def needs_header(self, bot_username: str, user_id: int) -> bool:
+        last = self._last.get(bot_username)
+        return (
+            last is None
+            or last[0] != user_id
+            or time.monotonic() - last[1] > self.idle_seconds
+        )
+
+    def shown(self, bot_username: str, user_id: int):
+        """记录主人私聊中最后显示的是该用户的消息"""
+        self._last[bot_username] = (user_id, time.monotonic())
+
+    def reset(self, bot_username: str):
+        """主人私聊中插入了其他内容，下一条转发重新显示表头"""
+        self._last.pop(bot_username, None)
+
+    def forget(self, bot_username: str):
+        self._last.pop(bot_username, None)
+        self._locks.pop(bot_username, None)
+
+    async def send(self, bot_username: str, user_id: int, send_body, send_header=None):
+        """
+        把用户的一条消息（或一组相册）发给主人，需要时带上表头，返回 send_body 的结果
+        
+        send_body(with_header) 发送正文（文本消息把表头写在正文里）；
+        send_header() 发送单独的表头消息（转发、相册），为 None 表示不需要。
+        判断、发送和记录在同一把锁内完成，中间不会插入其他用户的消息。
+        主人私聊被限流（RetryAfter）时不在锁内等待：释放锁后带表头按普通方式重发，
+        显示状态重置。
+        """
+        header_sent = False
+        async with self.lock(bot_username):
+            with_header = self.needs_header(bot_username, user_id)
+            try:
+                with fail_on_flood():
+                    if with_header and send_header is not None:
+                        await send_header()
+                        header_sent = True
+                    result = await send_body(with_header)
+                self.shown(bot_username, user_id)
+                return result
+            except RetryAfter:
+                self.reset(bot_username)
+        if send_header is not None and not header_sent:
+            await send_header()
+        try:
+            return await send_body(True)
+        finally:
+            self.reset(bot_username)
+
+
+header_sessions = HeaderSessions(HEADER_IDLE_SECONDS)
+
+# ================== 相册（媒体组）合并转发 ==================
+class AlbumCollector:
+    """
+    按 media_group_id 合并相册
+    
+    相册里的每张图片/视频都是一条独立的更新。第一条到达时登记并启动一个后台任务，
+    之后的追加进去；超过 window 秒没有新消息时按顺序交给 flush 一次性发送
+    （一条表头 + 一次 send_media_group），不再每张图各发一次表头和转发。
+    同一会话的相册按登记顺序依次发送：后一个相册收齐后先等前面的发完，
+    不会和前一个交错或在限速队列里超过它。只在事件循环线程中访问，无需加锁。
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        # (bot_username, chat_id) -> 按登记顺序的相册列表
+        # 相册: {"group": media_group_id, "messages", "last", "task", "sending"}
+        self._chats = {}
+
+    def add(self, bot_username: str, message, flush):
+        """登记一条相册消息；flush(messages) 在相册收齐后调用（第一条消息的 flush 生效）"""
+        chat_key = (bot_username, message.chat_id)
+        albums = self._chats.setdefault(chat_key, [])
+        album = next(
+            (a for a in albums if a["group"] == message.media_group_id and not a["sending"]), None
+        )
+        if album is None:
+            earlier = [a["task"] for a in albums]
+            album = {"group": message.media_group_id, "messages": [], "last": 0.0, "task": None, "sending": False}
+            albums.append(album)
+            album["task"] = asyncio.create_task(self._flush_when_complete(chat_key, album, earlier, flush))
+        album["messages"].append(message)
+        album["last"] = time.monotonic()
+
+    async def drain(self, bot_username: str, chat_id: int):
+        """等待该会话中尚未发出的相册发送完成，保证之后的消息排在相册后面"""
+        tasks = [album["task"] for album in self._chats.get((bot_username, chat_id), ())]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _flush_when_complete(self, chat_key, album, earlier, flush):
+        try:
+            while True:
+                remaining = album["last"] + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+            if earlier:
+                await asyncio.gather(*earlier, return_exceptions=True)
+            album["sending"] = True
+            await flush(sorted(album["messages"], key=lambda m: m.message_id))
+        except Exception as e:
+            logger.error(f"❌ 相册转发失败 @{chat_key[0]} chat={chat_key[1]}: {e}")
+        finally:
+            albums = self._chats.get(chat_key)
+            if albums is not None:
+                albums.remove(album)
+                if not albums:
+                    del self._chats[chat_key]
+
+
+album_collector = AlbumCollector(ALBUM_WINDOW_SECONDS)
+
+def album_input_media(message):
+    """把相册中的一条消息转换为 send_media_group 的 InputMedia（保留说明文字），不支持的类型返回 None"""
+    caption = dict(caption=message.caption, caption_entities=message.caption_entities)
+    if message.photo:
+        return InputMediaPhoto(message.photo[-1].file_id, has_spoiler=message.has_media_spoiler, **caption)
+    if message.video:
+        return InputMediaVideo(message.video.file_id, has_spoiler=message.has_media_spoiler, **caption)
+    if message.document:
+        return InputMediaDocument(message.document.file_id, **caption)
+    if message.audio:
+        return InputMediaAudio(message.audio.file_id, **caption)
+    return None
+
+async def send_album(bot, messages, chat_id, message_thread_id=None) -> list:
+    """
+    把一组相册消息整体发到 chat_id，返回与 messages 一一对应的新消息
+    
+    媒体组每次最多 10 条；含有无法放进媒体组的消息时退回逐条转发。
+    """
+    media = [album_input_media(m) for m in messages]
+    if None in media:
+        return [
+            await bot.forward_message(
+                chat_id=chat_id, from_chat_id=m.chat_id, message_id=m.message_id,
+                message_thread_id=message_thread_id
+            )
+            for m in messages
+        ]
+    sent = []
+    for start in range(0, len(media), 10):
+        sent.extend(await bot.send_media_group(
+            chat_id=chat_id, media=media[start:start + 10], message_thread_id=message_thread_id
+        ))
+    return sent
+
+def remember_album(bot_username: str, chat_id: int, messages, sent, direct: bool):
+    """为相册中的每条消息记录映射（与文本消息相同：用户消息 <-> 转发后的消息）"""
+    for original, copy in zip(messages, sent):
+        user_msg_key = f"{chat_id}_{original.message_id}"
+        if direct:
+            remember_mapping(bot_username, "direct", str(copy.message_id), chat_id, chat_id)
+        remember_mapping(bot_username, "user_forward", user_msg_key, copy.message_id, chat_id)
+        remember_mapping(bot_username, "forward_user", str(copy.message_id), user_msg_key, chat_id)
+
+async def flush_album_direct(bot, bot_username: str, owner_id: int, user_header: str, messages):
+    """直连模式：整组媒体发给主人，需要时先发一条用户信息表头"""
+    chat_id = messages[0].chat_id
+
+    async def send_header():
+        header = await bot.send_message(chat_id=owner_id, text=user_header)
+        remember_mapping(bot_username, "direct", str(header.message_id), chat_id, chat_id)
+
+    sent = await header_sessions.send(
+        bot_username, chat_id,
+        lambda with_header: send_album(bot, messages, owner_id),
+        send_header,
+    )
+    remember_album(bot_username, chat_id, messages, sent, direct=True)
+    logger.info(f"相册已转发 @{bot_username}: 用户 {chat_id}，{len(messages)} 条")
+    await reply_and_auto_delete(messages[0], "✅ 已成功发送", delay=3)
+
+async def flush_album_forum(bot, bot_username: str, forum_group_id, topic_id: int, messages):
+    """话题模式：整组媒体发到用户的话题，话题已被删除时重建一次"""
+    first = messages[0]
+    try:
+        sent = await send_album(bot, messages, forum_group_id, message_thread_id=topic_id)
+        ack = "✅ 已转交客服处理"
+    except BadRequest as e:
+        low = str(e).lower()
+        if ("message thread not found" not in low) and ("topic not found" not in low):
+            logger.error(f"转发相册到话题失败: {e}")
+            await reply_and_auto_delete(first, "❌ 转发到话题失败，请检查权限。", delay=5)
+            return
+        try:
+            topic_id = await create_user_topic(bot, bot_username, forum_group_id, first.from_user)
+            sent = await send_album(bot, messages, forum_group_id, message_thread_id=topic_id)
+            ack = "✅ 已转交客服处理（话题已重建）"
+        except Exception as e2:
+            logger.error(f"重建话题失败: {e2}")
+            await reply_and_auto_delete(first, "❌ 转发失败，重建话题也未成功。", delay=5)
+            return
+    remember_album(bot_username, first.chat_id, messages, sent, direct=False)
+    logger.info(f"[话题模式] 相册已转发到话题 {topic_id}，{len(messages)} 条")
+    await reply_and_auto_delete(first, ack, delay=2)
+
+# ================== 定时删除 ==================
+class DeletionScheduler:
+    """
+    提示消息的自动删除（所有 Bot 共用一个按到期时间排序的最小堆）
+    
+    处理器调用 schedule() 登记后立即返回，不再在处理器里 sleep；后台任务在
+    到期时成批删除。登记后超过 save_delay 秒仍未删除的条目才成批写入
+    pending_deletions 表（重启后继续删除），几秒后就删除的回执不产生数据库写入；
+    代价是进程在 save_delay 秒内崩溃时，这些回执不会被删除。
+    只在事件循环线程中访问，无需加锁。
+    """
+
+    # Telegram 只允许删除 48 小时内的消息，更早的记录直接清理
+    MAX_MESSAGE_AGE = 48 * 3600
+
+    def __init__(self, batch_size: int, save_delay: float):
+        self.batch_size = max(1, batch_size)
+        self.save_delay = max(0.0, save_delay)
+        self._heap = []           # (到期时间戳, bot_username, chat_id, message_id)
+        self._unsaved = {}        # 尚未写入数据库的 (bot_username, chat_id, message_id) -> (到期时间戳, 登记时间戳)
+        self._saved = set()       # 已写入数据库的 (bot_username, chat_id, message_id)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def schedule(self, bot_username: str, chat_id: int, message_id: int, delay: float):
+        now = time.time()
+        entry = (now + delay, bot_username, chat_id, message_id)
+        heapq.heappush(self._heap, entry)
+        self._unsaved[entry[1:]] = (entry[0], now)
+        if self._heap[0] is entry:
+            self._wakeup.set()   # 比当前最早的条目更早到期，重新计算等待时间
+
+    async def restore(self):
+        """
+        载入上次退出前未执行的删除（只接管本进程运行着的 Bot）
+        
+        已不存在的 Bot 和超过 48 小时的记录直接清理；其他 Bot 的记录留给运行它们的进程。
+        """
+        restored = 0
+        stale = []
+        expired_before = time.time() - self.MAX_MESSAGE_AGE
+        for row in await db.aio.get_pending_deletions():
+            key = (row['bot_username'], row['chat_id'], row['message_id'])
+            if find_running_bot(row['bot_username']) is None:
+                if row['due_at'] < expired_before or bots_data.get(row['bot_username']) is None:
+                    stale.append(key)
+                continue
+            heapq.heappush(self._heap, (row['due_at'],) + key)
+            self._saved.add(key)
+            restored += 1
+        if stale:
+            await db.aio.remove_pending_deletions(stale)
+            logger.info(f"🗑️ 清理了 {len(stale)} 条失效的自动删除记录")
+        if restored:
+            logger.info(f"🗑️ 恢复了 {restored} 条待自动删除的消息")
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """停止后台任务，把尚未写入的条目写入数据库（下次启动继续删除）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._save(force=True)
+
+    async def _run(self):
+        while True:
+            try:
+                # 先清除唤醒标志：下面 await 期间新登记的条目会再次唤醒，不会漏掉
+                self._wakeup.clear()
+                await self._save()
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    await self._delete_due(now)
+                    continue
+                timeout = self._heap[0][0] - now if self._heap else None
+                if self._unsaved:
+                    # 最早一条登记的条目到了写入时间也要醒来
+                    earliest = min(registered for _, registered in self._unsaved.values())
+                    save_wait = max(0.0, earliest + self.save_delay - now)
+                    timeout = save_wait if timeout is None else min(timeout, save_wait)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ 自动删除任务出错: {e}")
+                await asyncio.sleep(1)
+
+    async def _save(self, force: bool = False):
+        """把登记超过 save_delay 秒、尚未到期的条目成批写入数据库（force 时全部写入）"""
+        if not self._unsaved:
+            return
+        now = time.time()
+        ready = [
+            key for key, (due, registered) in self._unsaved.items()
+            if force or registered + self.save_delay <= now
+        ]
+        if not ready:
+            return
+        rows = []
+        for key in ready:
+            due, _ = self._unsaved.pop(key)
+            if due > now:
+                rows.append(key + (int(due),))
+        if rows and await db.aio.add_pending_deletions(rows):
+            self._saved.update(row[:3] for row in rows)
+
+    async def _delete_due(self, now: float):
+        """删除一批到期的消息，然后从数据库中移除对应记录"""
+        batch = []
+        while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+            entry = heapq.heappop(self._heap)
+            self._unsaved.pop(entry[1:], None)   # 还没写入数据库就删除了，不再写入
+            batch.append(entry)
+        await asyncio.gather(*(self._delete(bot, chat_id, msg_id) for _, bot, chat_id, msg_id in batch))
+        keys = [entry[1:] for entry in batch if entry[1:] in self._saved]
+        if keys:
+            self._saved.difference_update(keys)
+            await db.aio.remove_pending_deletions(keys)
+
+    async def _delete(self, bot_username: str, chat_id: int, message_id: int):
+        bot = find_running_bot(bot_username)
+        if bot is None:
+            return
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception:
+            # 消息已被手动删除或超过 48 小时无法删除，忽略
+            pass
+
+    def __len__(self):
+        return len(self._heap)
+
+
+deletion_scheduler = DeletionScheduler(AUTO_DELETE_BATCH, AUTO_DELETE_SAVE_DELAY)
+
+def find_running_bot(bot_username: str):
+    """按用户名查找正在运行的 Bot（包括管理 Bot），找不到返回 None"""
+    app = running_apps.get(bot_username)
+    if app is None:
+        manager = running_apps.get("__manager__")
+        if manager is not None and manager.bot.username == bot_username:
+            app = manager
+    return app.bot if app is not None else None
+
+def schedule_delete(sent, delay):
+    """在 delay 秒后删除已发送的消息（不阻塞当前处理器）"""
+    deletion_scheduler.schedule(sent.get_bot().username, sent.chat_id, sent.message_id, delay)
+
+# ================== 工具函数 ==================
+def load_bots(all_bots: dict):
+    """加载 Bot 配置（all_bots 为 await db.aio.get_all_bots() 的结果）"""
+    bots_data.load(all_bots)
     
     logger.info(f"✅ 从数据库加载了 {len(all_bots)} 个 Bot")
     return bots_data
@@ -57,78 +875,70 @@ def save_bots():
     """保存 Bot 配置到数据库"""
     pass
 
-def load_map():
-    """从数据库加载消息映射"""
-    global msg_map
-    msg_map = {}
-    
-    # 从数据库加载所有机器人的映射
-    all_bots = db.get_all_bots()
-    for bot_username in all_bots.keys():
-        ensure_bot_map(bot_username)
-        
-        # 加载各种类型的映射
-        msg_map[bot_username]["direct"] = db.get_all_mappings(bot_username, "direct")
-        
-        # 加载 topic 映射（需要转换为 int）
-        topic_mappings = db.get_all_mappings(bot_username, "topic")
-        msg_map[bot_username]["topics"] = {k: int(v) for k, v in topic_mappings.items() if v.isdigit()}
-        
-        msg_map[bot_username]["user_to_forward"] = db.get_all_mappings(bot_username, "user_forward")
-        msg_map[bot_username]["forward_to_user"] = db.get_all_mappings(bot_username, "forward_user")
-        msg_map[bot_username]["owner_to_user"] = db.get_all_mappings(bot_username, "owner_user")
-    
-    logger.info(f"✅ 从数据库加载了 {len(msg_map)} 个 Bot 的消息映射")
-
 def save_map():
     """保存消息映射到数据库"""
     pass
 
-def trigger_backup(silent=False):
-    """触发自动备份（异步执行，不阻塞主进程）
-
-    Args:
-        silent: 是否静默备份（不推送通知）
-    """
+def run_backup_script(snapshot_path: str, silent: bool):
+    """备份后置步骤：如果存在 backup.sh，则把最新快照交给它推送到 GitHub"""
     import subprocess
     # 使用环境变量配置备份脚本路径，Docker环境下默认使用相对路径
     backup_script = os.environ.get('BACKUP_SCRIPT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup.sh'))
 
     # 检查备份脚本是否存在
     if not os.path.exists(backup_script):
-        logger.info("⏭️  备份脚本不存在，跳过自动备份")
         return
     
     try:
         # 构建环境变量
         env = os.environ.copy()
+        env["BACKUP_SNAPSHOT"] = snapshot_path  # 一致性快照（gzip）
         if silent:
             env["SILENT_BACKUP"] = "1"  # 传递静默标志
         
-        # 异步执行备份脚本（不等待完成）
-        subprocess.Popen(
+        # 在备份线程中执行，不阻塞主进程
+        result = subprocess.run(
             ["/bin/bash", backup_script],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            start_new_session=True,  # 脱离主进程
-            env=env
+            env=env,
+            timeout=300
         )
-        logger.info(f"🔄 已触发{'静默' if silent else ''}备份（后台执行）")
+        if result.returncode == 0:
+            logger.info("☁️ 备份脚本执行完成")
+        else:
+            logger.error(f"❌ 备份脚本执行失败 (exit {result.returncode}): {result.stderr.decode(errors='ignore')[-500:]}")
     except Exception as e:
-        logger.error(f"❌ 触发备份失败: {e}")
+        logger.error(f"❌ 执行备份脚本失败: {e}")
 
-# 使用数据库的验证用户管理
-def is_verified(bot_username: str, user_id: int) -> bool:
-    """检查用户是否已验证"""
-    return db.is_verified(bot_username, user_id)
+db.backup_service.post_step = run_backup_script
+
+def trigger_backup(silent=False):
+    """触发自动备份（后台执行，不阻塞主进程）
+
+    使用 SQLite 在线备份 API 生成一致性快照；备份进行中的多次触发会合并为一次。
 
-def add_verified_user(bot_username: str, user_id: int, user_name: str = "", user_username: str = ""):
+    Args:
+        silent: 是否静默备份（不推送通知）
+    """
+    db.aio.request_backup(silent)
+    logger.info(f"🔄 已触发{'静默' if silent else ''}备份（后台执行）")
+
+# 使用数据库的验证用户管理
+async def is_verified(bot_username: str, user_id: int) -> bool:
+    """检查用户是否已验证（缓存命中时不经过数据库线程）"""
+    cached = db.aio.peek_verified(bot_username, user_id)
+    if cached is not None:
+        return cached
+    return await db.aio.is_verified(bot_username, user_id)
+
+async def add_verified_user(bot_username: str, user_id: int, user_name: str = "", user_username: str = ""):
     """添加已验证用户"""
-    db.add_verified_user(bot_username, user_id, user_name, user_username)
+    await db.aio.add_verified_user(bot_username, user_id, user_name, user_username)
 
-def remove_verified_user(bot_username: str, user_id: int):
+async def remove_verified_user(bot_username: str, user_id: int):
     """取消用户验证"""
-    return db.remove_verified_user(bot_username, user_id)
+    return await db.aio.remove_verified_user(bot_username, user_id)
 
 def generate_captcha() -> dict:
     """生成复杂验证码（多种类型）- 完全免费"""
@@ -313,48 +1123,104 @@ def generate_captcha() -> dict:
         }
 
 # 使用数据库的黑名单管理
-def is_blacklisted(bot_username: str, user_id: int) -> bool:
+async def is_blacklisted(bot_username: str, user_id: int) -> bool:
     """检查用户是否在黑名单中"""
-    return db.is_blacklisted(bot_username, user_id)
+    cached = db.aio.peek_blacklisted(bot_username, user_id)
+    if cached is not None:
+        return cached
+    return await db.aio.is_blacklisted(bot_username, user_id)
 
-def add_to_blacklist(bot_username: str, user_id: int, reason: str = ""):
+async def add_to_blacklist(bot_username: str, user_id: int, reason: str = ""):
     """添加用户到黑名单"""
-    db.add_to_blacklist(bot_username, user_id, reason)
+    await db.aio.add_to_blacklist(bot_username, user_id, reason)
     return True
 
-def remove_from_blacklist(bot_username: str, user_id: int):
+async def remove_from_blacklist(bot_username: str, user_id: int):
     """从黑名单移除用户"""
-    return db.remove_from_blacklist(bot_username, user_id)
-
-def ensure_bot_map(bot_username: str):
-    """保证 msg_map 结构存在"""
-    if bot_username not in msg_map or not isinstance(msg_map[bot_username], dict):
-        msg_map[bot_username] = {}
-    # 直连：主人的被转发消息 msg_id -> 用户ID
-    msg_map[bot_username].setdefault("direct", {})
-    # 话题：用户ID(str) -> topic_id(int)
-    msg_map[bot_username].setdefault("topics", {})
-    # 用户消息ID -> 转发后的消息ID (用于编辑消息)
-    msg_map[bot_username].setdefault("user_to_forward", {})
-    # 转发消息ID -> 用户消息ID (用于反向查找)
-    msg_map[bot_username].setdefault("forward_to_user", {})
-    # 主人消息ID -> 发送给用户的消息ID (用于编辑主人发送的消息)
-    msg_map[bot_username].setdefault("owner_to_user", {})
+    return await db.aio.remove_from_blacklist(bot_username, user_id)
+
+# 映射类型：
+# - direct: 主人的被转发消息ID -> 用户ID
+# - topic: 用户ID -> topic_id
+# - user_forward: 用户消息ID -> 转发后的消息ID (用于编辑消息)
+# - forward_user: 转发消息ID -> 用户消息ID (用于反向查找)
+# - owner_user: 主人消息ID -> 发送给用户的消息ID (用于编辑主人发送的消息)
+# - plain_forward: 用户消息ID -> 未带表头转发的消息ID (直连模式编辑时保持原格式)
+def remember_mapping(bot_username: str, map_type: str, key: str, value, user_id: int = None):
+    """记录一条消息映射：排队写入数据库，整数值同时写入缓存（forward_user 不会被查询，不占缓存）"""
+    if isinstance(value, int):
+        msg_map.put(bot_username, map_type, key, value)
+    db.aio.queue_mapping(bot_username, map_type, key, str(value), user_id)
+
+async def lookup_mapping(bot_username: str, map_type: str, key: str):
+    """查询整数值的消息映射，先查缓存，未命中回查数据库；找不到返回 None"""
+    value = msg_map.get(bot_username, map_type, key)
+    if value is not None:
+        return value
+    stored = await db.aio.get_mapping(bot_username, map_type, key)
+    if stored is None:
+        return None
+    try:
+        value = int(stored)
+    except ValueError:
+        return None
+    msg_map.put(bot_username, map_type, key, value)
+    return value
+
+def set_user_topic(bot_username: str, user_id: int, topic_id: int):
+    """记录用户的话题（新建或重建），同时更新正反两个索引并写入数据库"""
+    uid_key = str(user_id)
+    old_topic_id = msg_map.get(bot_username, "topic", uid_key)
+    if old_topic_id is not None and msg_map.get(bot_username, "topic_user", old_topic_id) == user_id:
+        msg_map.discard(bot_username, "topic_user", old_topic_id)
+    msg_map.put(bot_username, "topic_user", topic_id, user_id)
+    remember_mapping(bot_username, "topic", uid_key, topic_id, user_id)
+
+async def get_user_topic(bot_username: str, user_id: int):
+    """查询用户对应的话题ID，找不到返回 None"""
+    return await lookup_mapping(bot_username, "topic", str(user_id))
+
+async def find_topic_user(bot_username: str, topic_id):
+    """根据话题ID查找对应的用户ID，未命中缓存时走数据库索引；找不到返回 None"""
+    if topic_id is None:
+        return None
+    user_id = msg_map.get(bot_username, "topic_user", topic_id)
+    if user_id is None:
+        user_id = await db.aio.get_topic_user(bot_username, topic_id)
+        if user_id is not None:
+            msg_map.put(bot_username, "topic_user", topic_id, user_id)
+    return user_id
+
+async def create_user_topic(bot, bot_username: str, forum_group_id, user) -> int:
+    """在话题群中为用户新建（或重建）话题并记录映射，返回话题ID"""
+    display_name = (
+        user.full_name
+        or (f"@{user.username}" if user.username else None)
+        or "匿名用户"
+    )
+    topic = await bot.create_forum_topic(
+        chat_id=forum_group_id,
+        name=f"{display_name}"
+    )
+    # 💾 保存到数据库和内存
+    set_user_topic(bot_username, user.id, topic.message_thread_id)
+    return topic.message_thread_id
 
 async def reply_and_auto_delete(message, text, delay=5, **kwargs):
+    """回复消息，delay 秒后自动删除（发送后立即返回）"""
     try:
-        sent = await message.reply_text(text, **kwargs)
-        await asyncio.sleep(delay)
-        await sent.delete()
+        with send_priority(PRIORITY_LOW):
+            sent = await message.reply_text(text, **kwargs)
+        schedule_delete(sent, delay)
     except Exception:
         pass
 
 async def send_and_auto_delete(context, chat_id, text, delay=5, **kwargs):
-    """发送消息并自动删除(不使用reply)"""
+    """发送消息并自动删除(不使用reply，发送后立即返回)"""
     try:
-        sent = await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
-        await asyncio.sleep(delay)
-        await sent.delete()
+        with send_priority(PRIORITY_LOW):
+            sent = await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        schedule_delete(sent, delay)
     except Exception:
         pass
 
@@ -364,18 +1230,13 @@ async def send_admin_log(text: str):
     try:
         app = running_apps.get("__manager__")
         if app:
-            await app.bot.send_message(chat_id=ADMIN_CHANNEL, text=text, parse_mode="HTML")
+            await app.bot.send_message(chat_id=ADMIN_CHANNEL, text=text, parse_mode="HTML", rate_limit_args=PRIORITY_LOW)
     except Exception as e:
         logger.error(f"宿主通知失败: {e}")
 
 def get_bot_cfg(owner_id, bot_username: str):
     """从 bots_data 中找到某个 owner 的某个子机器人配置"""
-    owner_id = str(owner_id)
-    info = bots_data.get(owner_id, {})
-    for b in info.get("bots", []):
-        if b.get("bot_username") == bot_username:
-            return b
-    return None
+    return bots_data.get_owned(owner_id, bot_username)
 
 # 系统默认欢迎语模板
 DEFAULT_WELCOME_MSG = (
@@ -393,7 +1254,7 @@ DEFAULT_WELCOME_MSG = (
     "请直接输入消息，主人收到就会回复你"
 )
 
-def get_welcome_message(bot_username: str) -> str:
+async def get_welcome_message(bot_username: str) -> str:
     """
     获取欢迎语（按优先级）
     1. 用户自定义欢迎语（bot配置中的welcome_msg）
@@ -406,15 +1267,12 @@ def get_welcome_message(bot_username: str) -> str:
     Returns:
         欢迎语文本
     """
-    # 优先级1：用户自定义欢迎语
-    bot_info = db.get_bot(bot_username)
-    if bot_info and bot_info.get('welcome_msg'):
-        return bot_info['welcome_msg']
-    
-    # 优先级2：管理员全局欢迎语
-    global_welcome = db.get_global_welcome()
-    if global_welcome:
-        return global_welcome
+    # 优先级1、2：用户自定义欢迎语 / 管理员全局欢迎语（结果由数据库层缓存）
+    welcome = db.aio.peek_welcome_message(bot_username)
+    if welcome is None:
+        welcome = await db.aio.resolve_welcome_message(bot_username)
+    if welcome:
+        return welcome
     
     # 优先级3：系统默认欢迎语
     return DEFAULT_WELCOME_MSG
@@ -457,15 +1315,15 @@ async def subbot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bot_username = context.bot.username
     
     # 如果用户已验证，显示欢迎信息
-    if is_verified(bot_username, user_id):
+    if await is_verified(bot_username, user_id):
         # 使用优先级欢迎语：用户自定义 > 管理员全局 > 系统默认
-        welcome_msg = get_welcome_message(bot_username)
+        welcome_msg = await get_welcome_message(bot_username)
         await update.message.reply_text(welcome_msg)
     else:
         # 生成验证码并发送
         captcha_data = generate_captcha()
         # 💾 保存到数据库（持久化）
-        db.add_pending_verification(bot_username, user_id, captcha_data['answer'])
+        await db.aio.add_pending_verification(bot_username, user_id, captcha_data['answer'])
         # 内存中也保留（用于快速访问）
         verification_key = f"{bot_username}_{user_id}"
         pending_verifications[verification_key] = captcha_data['answer']
@@ -522,7 +1380,77 @@ async def subbot_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"💡 提示：请输入答案"
             )
         
-        await update.message.reply_text(message_text, parse_mode="HTML")
+        with send_priority(PRIORITY_HIGH):
+            await update.message.reply_text(message_text, parse_mode="HTML")
+
+# ================== 黑名单 / 已验证用户分页列表 ==================
+# 回调数据格式：{kind}page_{n|p}_{user_id}_{时间}，n 向更早翻页，p 向更新翻页；
+# 游标是边界行的 (时间, user_id)，Bot 由收到回调的子机器人确定，不写进回调数据（长度上限 64 字节）
+LIST_KINDS = {
+    'bl': ('📋 黑名单列表', '📋 黑名单为空', 'blocked_at'),
+    'vl': ('✅ 已验证用户', '📋 暂无已验证用户', 'verified_at'),
+}
+
+async def render_list_page(bot, bot_username: str, kind: str, cursor=None, backward: bool = False):
+    """渲染一页列表，返回 (文本, 翻页按钮)；每页只读取一段索引区间"""
+    title, empty_text, ts_key = LIST_KINDS[kind]
+    if kind == 'bl':
+        rows, has_more = await db.aio.get_blacklist_page(bot_username, LIST_PAGE_SIZE, cursor=cursor, backward=backward)
+        total = await db.aio.get_blacklist_count(bot_username)
+    else:
+        rows, has_more = await db.aio.get_verified_users_page(bot_username, LIST_PAGE_SIZE, cursor=cursor, backward=backward)
+        total = await db.aio.get_verified_count(bot_username)
+
+    if not rows:
+        return empty_text, None
+
+    text = f"{title} (@{bot_username})，共 {total} 人：\n\n"
+    for row in rows:
+        uid = row['user_id']
+        if kind == 'bl':
+            try:
+                user = await bot.get_chat(uid)
+                name = user.full_name or (f"@{user.username}" if user.username else "匿名用户")
+                text += f"• {name} (ID: <code>{uid}</code>)\n"
+            except:
+                text += f"• 用户ID: <code>{uid}</code> (已删除账号)\n"
+        else:
+            name = row['user_name'] or "匿名用户"
+            if row['user_username']:
+                name += f" @{row['user_username']}"
+            text += f"• {name} (ID: <code>{uid}</code>) · {(row[ts_key] or '')[:16]}\n"
+
+    # 翻页按钮：沿翻页方向是否还有数据由查询结果判断，反方向一定有数据（刚从那里翻过来）
+    has_newer = has_more if backward else cursor is not None
+    has_older = cursor is not None if backward else has_more
+    nav_buttons = []
+    if has_newer:
+        first = rows[0]
+        nav_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"{kind}page_p_{first['user_id']}_{first[ts_key]}"))
+    if has_older:
+        last = rows[-1]
+        nav_buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"{kind}page_n_{last['user_id']}_{last[ts_key]}"))
+    return text, InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
+
+async def handle_list_page_callback(query, context: ContextTypes.DEFAULT_TYPE):
+    """处理黑名单/已验证用户列表的翻页按钮（仅 Bot 主人可用）"""
+    bot_username = context.bot.username
+    if not bots_data.get_owned(query.from_user.id, bot_username):
+        return
+    try:
+        prefix, direction, user_id, ts = query.data.split("_", 3)
+        kind = prefix[:-len("page")]
+        cursor = (ts, int(user_id))
+    except Exception as e:
+        logger.error(f"[回调] 解析翻页数据失败: {e}, data: {query.data}")
+        return
+    text, markup = await render_list_page(context.bot, bot_username, kind, cursor, backward=(direction == "p"))
+    try:
+        await query.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+    except BadRequest as e:
+        # 内容未变化（例如重复点击）时 Telegram 会报错，忽略即可
+        if "not modified" not in str(e).lower():
+            raise
 
 # ================== 消息转发逻辑（直连/话题 可切换） ==================
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, owner_id: int, bot_username: str):
@@ -538,7 +1466,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
     - /unblock 功能:
       解除拉黑
     - /blocklist 功能:
-      查看黑名单
+      查看黑名单（分页）
+    - /verified 功能:
+      查看已验证用户（分页）
     """
     try:
         # 支持编辑消息
@@ -558,8 +1488,6 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
         mode = bot_cfg.get("mode", "direct")
         forum_group_id = bot_cfg.get("forum_group_id")
 
-        ensure_bot_map(bot_username)
-
         # ---------- /bl (blocklist) 功能 ----------
         cmd = message.text.strip() if message.text else ""
         if cmd and (cmd == "/bl" or cmd.startswith("/bl ") or cmd.startswith("/bl@") or 
@@ -567,21 +1495,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             if message.from_user.id != owner_id:
                 return
 
-            blocked_users = db.get_blacklist(bot_username)
-            if not blocked_users:
-                await message.reply_text("📋 黑名单为空")
-                return
+            text, markup = await render_list_page(context.bot, bot_username, 'bl')
+            await message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+            header_sessions.reset(bot_username)
+            return
 
-            text = f"📋 黑名单列表 (@{bot_username})：\n\n"
-            for idx, uid in enumerate(blocked_users, 1):
-                try:
-                    user = await context.bot.get_chat(uid)
-                    name = user.full_name or f"@{user.username}" if user.username else "匿名用户"
-                    text += f"{idx}. {name} (ID: <code>{uid}</code>)\n"
-                except:
-                    text += f"{idx}. 用户ID: <code>{uid}</code> (已删除账号)\n"
+        # ---------- /vl (verified list) 功能（已验证用户列表）----------
+        if cmd and (cmd == "/vl" or cmd.startswith("/vl ") or cmd.startswith("/vl@") or 
+                    cmd == "/verified" or cmd.startswith("/verified ") or cmd.startswith("/verified@")):
+            if message.from_user.id != owner_id:
+                return
 
-            await message.reply_text(text, parse_mode="HTML")
+            text, markup = await render_list_page(context.bot, bot_username, 'vl')
+            await message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+            header_sessions.reset(bot_username)
             return
 
         # ---------- /b (block) 功能（拉黑用户）----------
@@ -601,19 +1528,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             elif message.reply_to_message:
                 # 直连模式：主人私聊里，回复转发消息
                 if mode == "direct" and message.chat.type == "private" and chat_id == owner_id:
-                    direct_map = msg_map[bot_username]["direct"]
-                    target_user = direct_map.get(str(message.reply_to_message.message_id))
+                    target_user = await lookup_mapping(bot_username, "direct", str(message.reply_to_message.message_id))
 
                 # 话题模式：群里，回复话题消息
                 elif mode == "forum" and message.chat.id == forum_group_id:
-                    topic_id = message.reply_to_message.message_thread_id
-                    for uid_str, t_id in msg_map[bot_username]["topics"].items():
-                        if t_id == topic_id:
-                            target_user = int(uid_str)
-                            break
+                    target_user = await find_topic_user(bot_username, message.reply_to_message.message_thread_id)
 
             if target_user:
-                if add_to_blacklist(bot_username, target_user):
+                if await add_to_blacklist(bot_username, target_user):
                     await message.reply_text(f"🚫 已将用户 {target_user} 加入黑名单")
                     
                     # 通知到管理频道 - 获取用户信息
@@ -656,19 +1578,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             elif message.reply_to_message:
                 # 直连模式
                 if mode == "direct" and message.chat.type == "private" and chat_id == owner_id:
-                    direct_map = msg_map[bot_username]["direct"]
-                    target_user = direct_map.get(str(message.reply_to_message.message_id))
+                    target_user = await lookup_mapping(bot_username, "direct", str(message.reply_to_message.message_id))
 
                 # 话题模式
                 elif mode == "forum" and message.chat.id == forum_group_id:
-                    topic_id = message.reply_to_message.message_thread_id
-                    for uid_str, t_id in msg_map[bot_username]["topics"].items():
-                        if t_id == topic_id:
-                            target_user = int(uid_str)
-                            break
+                    target_user = await find_topic_user(bot_username, message.reply_to_message.message_thread_id)
 
             if target_user:
-                if remove_from_blacklist(bot_username, target_user):
+                if await remove_from_blacklist(bot_username, target_user):
                     await message.reply_text(f"✅ 已将用户 {target_user} 从黑名单移除")
                     
                     # 通知到管理频道 - 获取用户信息
@@ -711,19 +1628,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             elif message.reply_to_message:
                 # 直连模式
                 if mode == "direct" and message.chat.type == "private" and chat_id == owner_id:
-                    direct_map = msg_map[bot_username]["direct"]
-                    target_user = direct_map.get(str(message.reply_to_message.message_id))
+                    target_user = await lookup_mapping(bot_username, "direct", str(message.reply_to_message.message_id))
 
                 # 话题模式
                 elif mode == "forum" and message.chat.id == forum_group_id:
-                    topic_id = message.reply_to_message.message_thread_id
-                    for uid_str, t_id in msg_map[bot_username]["topics"].items():
-                        if t_id == topic_id:
-                            target_user = int(uid_str)
-                            break
+                    target_user = await find_topic_user(bot_username, message.reply_to_message.message_thread_id)
 
             if target_user:
-                if remove_verified_user(bot_username, target_user):
+                if await remove_verified_user(bot_username, target_user):
                     await message.reply_text(f"🔓 已取消用户 {target_user} 的验证\n下次发送消息时需要重新验证")
                     
                     # 通知到管理频道 - 获取用户信息
@@ -759,23 +1671,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
 
             # 直连模式：主人私聊里，必须回复一条转发消息
             if mode == "direct" and message.chat.type == "private" and chat_id == owner_id and message.reply_to_message:
-                direct_map = msg_map[bot_username]["direct"]
-                target_user = direct_map.get(str(message.reply_to_message.message_id))
+                target_user = await lookup_mapping(bot_username, "direct", str(message.reply_to_message.message_id))
 
             # 话题模式：群里，必须回复某条消息
             elif mode == "forum" and message.chat.id == forum_group_id and message.reply_to_message:
-                topic_id = message.reply_to_message.message_thread_id
-                for uid_str, t_id in msg_map[bot_username]["topics"].items():
-                    if t_id == topic_id:
-                        target_user = int(uid_str)
-                        break
+                target_user = await find_topic_user(bot_username, message.reply_to_message.message_thread_id)
 
             # 如果找到了用户，展示信息；否则静默忽略
             if target_user:
                 try:
                     user = await context.bot.get_chat(target_user)
-                    is_blocked = is_blacklisted(bot_username, user.id)
-                    user_verified = is_verified(bot_username, user.id)
+                    is_blocked = await is_blacklisted(bot_username, user.id)
+                    user_verified = await is_verified(bot_username, user.id)
                     
                     # 状态显示
                     status_parts = []
@@ -824,6 +1731,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         disable_web_page_preview=True,
                         reply_markup=keyboard
                     )
+                    header_sessions.reset(bot_username)
                 except Exception as e:
                     await message.reply_text(f"❌ 获取用户信息失败: {e}")
 
@@ -834,12 +1742,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             user_id = message.from_user.id
             verification_key = f"{bot_username}_{user_id}"
             
-            logger.info(f"[验证检查] Bot: @{bot_username}, 用户: {user_id}, 已验证: {is_verified(bot_username, user_id)}")
+            user_verified = await is_verified(bot_username, user_id)
+            logger.info(f"[验证检查] Bot: @{bot_username}, 用户: {user_id}, 已验证: {user_verified}")
             
             # 如果用户未验证
-            if not is_verified(bot_username, user_id):
+            if not user_verified:
                 # 检查是否有待验证的验证码（优先从数据库读取）
-                expected_captcha = db.get_pending_verification(bot_username, user_id)
+                expected_captcha = await db.aio.get_pending_verification(bot_username, user_id)
                 
                 # 如果数据库中没有，检查内存
                 if not expected_captcha and verification_key in pending_verifications:
@@ -857,10 +1766,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         user_username = message.from_user.username or ""
                         
                         # 添加到已验证用户（包含用户信息）
-                        add_verified_user(bot_username, user_id, user_name, user_username)
+                        await add_verified_user(bot_username, user_id, user_name, user_username)
                         
                         # 💾 从数据库和内存中删除待验证记录
-                        db.remove_pending_verification(bot_username, user_id)
+                        await db.aio.remove_pending_verification(bot_username, user_id)
                         pending_verifications.pop(verification_key, None)
                         
                         # 🔧 为 owner 设置命令菜单（如果之前没设置成功）
@@ -872,6 +1781,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                     BotCommand("b", "拉黑用户"),
                                     BotCommand("ub", "解除拉黑"),
                                     BotCommand("bl", "查看黑名单"),
+                                    BotCommand("vl", "查看已验证用户"),
                                     BotCommand("uv", "取消用户验证")
                                 ]
                                 await context.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=owner_id))
@@ -880,7 +1790,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                 logger.warning(f"设置命令菜单失败: {cmd_err}")
                         
                         # 使用优先级欢迎语：用户自定义 > 管理员全局 > 系统默认
-                        welcome_msg = get_welcome_message(bot_username)
+                        welcome_msg = await get_welcome_message(bot_username)
                         await message.reply_text(welcome_msg)
                         
                         # 通知Bot的主人（owner）
@@ -904,6 +1814,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                 text=notification_text,
                                 parse_mode="HTML"
                             )
+                            header_sessions.reset(bot_username)
                         except Exception as e:
                             logger.error(f"通知Bot主人失败: {e}")
                         
@@ -922,7 +1833,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     captcha_data = generate_captcha()
                     
                     # 💾 保存到数据库和内存
-                    db.add_pending_verification(bot_username, user_id, captcha_data['answer'])
+                    await db.aio.add_pending_verification(bot_username, user_id, captcha_data['answer'])
                     pending_verifications[verification_key] = captcha_data['answer']
                     logger.info(f"[验证码] 类型: {captcha_data['type']}, 答案: {captcha_data['answer']}")
                     
@@ -942,17 +1853,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     else:
                         message_text = f"🔐 验证\n\n你还未通过验证。\n\n📝 {captcha_data['question']}\n\n💡 请输入答案或 /start 换题"
                     
-                    await message.reply_text(message_text, parse_mode="HTML")
+                    with send_priority(PRIORITY_HIGH):
+                        await message.reply_text(message_text, parse_mode="HTML")
                     return
 
         # ---------- 黑名单拦截 ----------
         if message.chat.type == "private" and chat_id != owner_id:
-            if is_blacklisted(bot_username, chat_id):
+            if await is_blacklisted(bot_username, chat_id):
                 # 被拉黑用户发消息，静默忽略或返回提示
                 await reply_and_auto_delete(message, "⚠️ 你已被管理员拉黑，消息无法发送。", delay=5)
                 logger.info(f"拦截黑名单用户 {chat_id} 的消息 (@{bot_username})")
                 return
 
+        # 同一用户之前的相册还在合并等待中时，先等它发出，保证消息顺序
+        if message.chat.type == "private" and chat_id != owner_id and (is_edit or not message.media_group_id):
+            await album_collector.drain(bot_username, chat_id)
+
         # ---------- 直连模式 ----------
         if mode == "direct":
             # 普通用户发私聊 -> 转给主人
@@ -961,7 +1877,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                 
                 if is_edit:
                     # 如果是编辑消息，尝试编辑之前发送的消息
-                    forward_msg_id = msg_map[bot_username]["user_to_forward"].get(user_msg_key)
+                    forward_msg_id = await lookup_mapping(bot_username, "user_forward", user_msg_key)
                     if forward_msg_id:
                         try:
                             # 编辑消息 (只能编辑文本)
@@ -971,10 +1887,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                 display_name = message.from_user.full_name or '未知'
                                 user_header = f"👤 {display_name} ({username})" if username else f"👤 {display_name}"
                                 
+                                # 保持与原转发相同的格式：原来没有表头的，编辑后也不加
+                                plain_msg_id = await lookup_mapping(bot_username, "plain_forward", user_msg_key)
+                                body = f"{message.text} [✏️已编辑]"
                                 await context.bot.edit_message_text(
                                     chat_id=owner_id,
                                     message_id=forward_msg_id,
-                                    text=f"{user_header}\n\n{message.text} [✏️已编辑]"
+                                    text=body if plain_msg_id == forward_msg_id else f"{user_header}\n\n{body}"
                                 )
                                 logger.info(f"用户 {chat_id} 编辑消息成功")
                                 await reply_and_auto_delete(message, "✅ 编辑同步成功", delay=3)
@@ -984,6 +1903,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                     chat_id=owner_id,
                                     text=f"✏️ 用户 {message.from_user.full_name or '未知'} (ID: {chat_id}) 编辑了消息\n(非文本消息无法同步编辑)"
                                 )
+                                header_sessions.reset(bot_username)
                                 await reply_and_auto_delete(message, "⚠️ 非文本消息无法同步编辑", delay=3)
                         except Exception as e:
                             logger.error(f"编辑消息失败: {e}")
@@ -992,6 +1912,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                 chat_id=owner_id,
                                 text=f"✏️ 用户 {message.from_user.full_name or '未知'} (ID: {chat_id}) 编辑了消息，但无法同步编辑"
                             )
+                            header_sessions.reset(bot_username)
                             await reply_and_auto_delete(message, f"⚠️ 编辑同步失败", delay=3)
                         return
                 else:
@@ -1002,56 +1923,70 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     user_header = f"👤 {display_name} ({username})" if username else f"👤 {display_name}"
                     
                     if message.text:
-                        # 文本消息：发送可编辑的消息
-                        sent_msg = await context.bot.send_message(
-                            chat_id=owner_id,
-                            text=f"{user_header}\n\n{message.text}"
-                        )
+                        # 文本消息：发送可编辑的消息（同一用户连续发送时不重复表头）
+                        sent_with_header = True
+
+                        def send_text(with_header):
+                            nonlocal sent_with_header
+                            sent_with_header = with_header
+                            return context.bot.send_message(
+                                chat_id=owner_id,
+                                text=f"{user_header}\n\n{message.text}" if with_header else message.text
+                            )
+
+                        sent_msg = await header_sessions.send(bot_username, chat_id, send_text)
                         # 💾 保存到数据库和内存
-                        msg_map[bot_username]["direct"][str(sent_msg.message_id)] = chat_id
-                        db.set_mapping(bot_username, "direct", str(sent_msg.message_id), str(chat_id), chat_id)
-                        
-                        msg_map[bot_username]["user_to_forward"][user_msg_key] = sent_msg.message_id
-                        db.set_mapping(bot_username, "user_forward", user_msg_key, str(sent_msg.message_id), chat_id)
-                        
-                        msg_map[bot_username]["forward_to_user"][str(sent_msg.message_id)] = user_msg_key
-                        db.set_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
-                    else:
-                        # 非文本消息：先发送用户信息，再转发原消息
-                        await context.bot.send_message(
-                            chat_id=owner_id,
-                            text=user_header
+                        remember_mapping(bot_username, "direct", str(sent_msg.message_id), chat_id, chat_id)
+                        remember_mapping(bot_username, "user_forward", user_msg_key, sent_msg.message_id, chat_id)
+                        remember_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
+                        if not sent_with_header:
+                            # 编辑时按同样的格式（不带表头）重新生成
+                            remember_mapping(bot_username, "plain_forward", user_msg_key, sent_msg.message_id, chat_id)
+                    elif message.media_group_id:
+                        # 相册：收齐后一条表头 + 一次发送整组（回执也在发送后给出）
+                        album_collector.add(
+                            bot_username, message,
+                            partial(flush_album_direct, context.bot, bot_username, owner_id, user_header)
                         )
-                        fwd_msg = await context.bot.forward_message(
-                            chat_id=owner_id,
-                            from_chat_id=chat_id,
-                            message_id=message.message_id
+                        return
+                    else:
+                        # 非文本消息：需要时先发送用户信息，再转发原消息
+                        fwd_msg = await header_sessions.send(
+                            bot_username, chat_id,
+                            lambda with_header: context.bot.forward_message(
+                                chat_id=owner_id,
+                                from_chat_id=chat_id,
+                                message_id=message.message_id
+                            ),
+                            lambda: context.bot.send_message(
+                                chat_id=owner_id,
+                                text=user_header
+                            ),
                         )
                         # 💾 保存到数据库和内存
-                        msg_map[bot_username]["direct"][str(fwd_msg.message_id)] = chat_id
-                        db.set_mapping(bot_username, "direct", str(fwd_msg.message_id), str(chat_id), chat_id)
+                        remember_mapping(bot_username, "direct", str(fwd_msg.message_id), chat_id, chat_id)
                     
                     await reply_and_auto_delete(message, "✅ 已成功发送", delay=3)
                 return
 
             # 主人在私聊里回复 -> 回用户
             if message.chat.type == "private" and chat_id == owner_id and message.reply_to_message:
-                direct_map = msg_map[bot_username]["direct"]
-                target_user = direct_map.get(str(message.reply_to_message.message_id))
+                target_user = await lookup_mapping(bot_username, "direct", str(message.reply_to_message.message_id))
                 
                 if target_user:
                     owner_msg_key = f"{owner_id}_{message.message_id}"
                     
                     if is_edit:
                         # 主人编辑了回复，尝试编辑发送给用户的消息
-                        user_msg_id = msg_map[bot_username]["owner_to_user"].get(owner_msg_key)
+                        user_msg_id = await lookup_mapping(bot_username, "owner_user", owner_msg_key)
                         if user_msg_id:
                             try:
                                 if message.text:
                                     await context.bot.edit_message_text(
                                         chat_id=target_user,
                                         message_id=user_msg_id,
-                                        text=message.text
+                                        text=message.text,
+                                        rate_limit_args=PRIORITY_HIGH
                                     )
                                     logger.info(f"主人编辑回复成功")
                                     await reply_and_auto_delete(message, "✅ 编辑同步成功", delay=2)
@@ -1066,11 +2001,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                         sent_msg = await context.bot.copy_message(
                             chat_id=target_user,
                             from_chat_id=owner_id,
-                            message_id=message.message_id
+                            message_id=message.message_id,
+                            rate_limit_args=PRIORITY_HIGH
                         )
                         # 💾 保存映射关系到数据库和内存
-                        msg_map[bot_username]["owner_to_user"][owner_msg_key] = sent_msg.message_id
-                        db.set_mapping(bot_username, "owner_user", owner_msg_key, str(sent_msg.message_id), int(target_user))
+                        remember_mapping(bot_username, "owner_user", owner_msg_key, sent_msg.message_id, int(target_user))
                         await reply_and_auto_delete(message, "✅ 回复已送达", delay=2)
                 else:
                     if not is_edit:
@@ -1087,31 +2022,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     await reply_and_auto_delete(message, "⚠️ 主人未设置话题群，暂无法转发。", delay=5)
                 return
 
-            topics = msg_map[bot_username]["topics"]
-
             # 普通用户发私聊 -> 转到对应话题
             if message.chat.type == "private" and chat_id != owner_id:
                 logger.info(f"[话题模式] 收到用户 {chat_id} 的私聊消息，准备转发到群 {forum_group_id}")
-                uid_key = str(chat_id)
-                topic_id = topics.get(uid_key)
+                topic_id = await get_user_topic(bot_username, chat_id)
                 user_msg_key = f"{chat_id}_{message.message_id}"
 
                 # 若无映射，先创建话题
                 if not topic_id:
-                    display_name = (
-                        message.from_user.full_name
-                        or (f"@{message.from_user.username}" if message.from_user.username else None)
-                        or "匿名用户"
-                    )
                     try:
-                        topic = await context.bot.create_forum_topic(
-                            chat_id=forum_group_id,
-                            name=f"{display_name}"
-                        )
-                        topic_id = topic.message_thread_id
-                        # 💾 保存到数据库和内存
-                        topics[uid_key] = topic_id
-                        db.set_mapping(bot_username, "topic", uid_key, str(topic_id), chat_id)
+                        topic_id = await create_user_topic(context.bot, bot_username, forum_group_id, message.from_user)
                     except Exception as e:
                         logger.error(f"创建话题失败: {e}")
                         await reply_and_auto_delete(message, "❌ 创建话题失败，请联系管理员。", delay=5)
@@ -1121,7 +2041,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                 try:
                     if is_edit:
                         # 如果是编辑消息，尝试编辑之前发送的消息
-                        forward_msg_id = msg_map[bot_username]["user_to_forward"].get(user_msg_key)
+                        forward_msg_id = await lookup_mapping(bot_username, "user_forward", user_msg_key)
                         if forward_msg_id:
                             try:
                                 if message.text:
@@ -1164,11 +2084,15 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                                 text=message.text
                             )
                             # 💾 保存映射关系到数据库和内存
-                            msg_map[bot_username]["user_to_forward"][user_msg_key] = sent_msg.message_id
-                            db.set_mapping(bot_username, "user_forward", user_msg_key, str(sent_msg.message_id), chat_id)
-                            
-                            msg_map[bot_username]["forward_to_user"][str(sent_msg.message_id)] = user_msg_key
-                            db.set_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
+                            remember_mapping(bot_username, "user_forward", user_msg_key, sent_msg.message_id, chat_id)
+                            remember_mapping(bot_username, "forward_user", str(sent_msg.message_id), user_msg_key, chat_id)
+                        elif message.media_group_id:
+                            # 相册：收齐后一次发送整组到话题（回执也在发送后给出）
+                            album_collector.add(
+                                bot_username, message,
+                                partial(flush_album_forum, context.bot, bot_username, forum_group_id, topic_id)
+                            )
+                            return
                         else:
                             # 非文本消息：直接转发(话题模式)
                             await context.bot.forward_message(
@@ -1185,19 +2109,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                     low = str(e).lower()
                     if ("message thread not found" in low) or ("topic not found" in low):
                         try:
-                            display_name = (
-                                message.from_user.full_name
-                                or (f"@{message.from_user.username}" if message.from_user.username else None)
-                                or "匿名用户"
-                            )
-                            topic = await context.bot.create_forum_topic(
-                                chat_id=forum_group_id,
-                                name=f"{display_name}"
-                            )
-                            topic_id = topic.message_thread_id
-                            # 💾 保存到数据库和内存
-                            topics[uid_key] = topic_id
-                            db.set_mapping(bot_username, "topic", uid_key, str(topic_id), chat_id)
+                            topic_id = await create_user_topic(context.bot, bot_username, forum_group_id, message.from_user)
 
                             await context.bot.forward_message(
                                 chat_id=forum_group_id,
@@ -1219,32 +2131,29 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
             if message.chat.id == forum_group_id and getattr(message, "is_topic_message", False):
                 topic_id = message.message_thread_id
                 logger.info(f"[话题模式] 收到群消息，topic_id: {topic_id}, 查找对应用户")
-                target_uid = None
-                for uid_str, t_id in topics.items():
-                    if t_id == topic_id:
-                        target_uid = int(uid_str)
-                        break
+                target_uid = await find_topic_user(bot_username, topic_id)
                 if target_uid:
                     try:
                         owner_msg_key = f"{forum_group_id}_{message.message_id}"
                         
                         if is_edit:
                             # 主人编辑了消息，尝试编辑发送给用户的消息
-                            user_msg_id = msg_map[bot_username]["owner_to_user"].get(owner_msg_key)
+                            user_msg_id = await lookup_mapping(bot_username, "owner_user", owner_msg_key)
                             if user_msg_id:
                                 try:
                                     if message.text:
                                         await context.bot.edit_message_text(
                                             chat_id=target_uid,
                                             message_id=user_msg_id,
-                                            text=message.text
+                                            text=message.text,
+                                            rate_limit_args=PRIORITY_HIGH
                                         )
                                         logger.info(f"[话题模式] 主人编辑回复成功")
                                         # 话题模式下主人在群里编辑，给一个简单的反馈(不使用reply_and_auto_delete，因为可能没有reply_to_message)
                                         try:
-                                            sent = await message.reply_text("✅ 编辑同步成功")
-                                            await asyncio.sleep(2)
-                                            await sent.delete()
+                                            with send_priority(PRIORITY_LOW):
+                                                sent = await message.reply_text("✅ 编辑同步成功")
+                                            schedule_delete(sent, 2)
                                         except:
                                             pass
                                     else:
@@ -1257,11 +2166,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, own
                             sent_msg = await context.bot.copy_message(
                                 chat_id=target_uid,
                                 from_chat_id=forum_group_id,
-                                message_id=message.message_id
+                                message_id=message.message_id,
+                                rate_limit_args=PRIORITY_HIGH
                             )
                             # 💾 保存映射关系到数据库和内存
-                            msg_map[bot_username]["owner_to_user"][owner_msg_key] = sent_msg.message_id
-                            db.set_mapping(bot_username, "owner_user", owner_msg_key, str(sent_msg.message_id), target_uid)
+                            remember_mapping(bot_username, "owner_user", owner_msg_key, sent_msg.message_id, target_uid)
                             logger.info(f"[话题模式] 回复发送成功")
                     except Exception as e:
                         logger.error(f"群->用户 复制失败: {e}")
@@ -1290,7 +2199,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.pop("waiting_broadcast", None)
         
         # 获取所有托管机器人的用户（owner）
-        all_owners = list(bots_data.keys())
+        all_owners = bots_data.owners()
         
         if not all_owners:
             await update.message.reply_text("⚠️ 暂无托管用户")
@@ -1314,7 +2223,8 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # 使用管理机器人发送消息
                 await context.bot.send_message(
                     chat_id=owner_id_int,
-                    text=f"📢 系统广播\n\n{broadcast_msg}"
+                    text=f"📢 系统广播\n\n{broadcast_msg}",
+                    rate_limit_args=PRIORITY_LOW
                 )
                 success_count += 1
             except Exception as e:
@@ -1371,8 +2281,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome_text = update.message.text.strip()
         
         # 验证权限
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await update.message.reply_text("⚠️ 找不到这个 Bot")
             context.user_data.pop("action", None)
@@ -1380,10 +2289,9 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # 保存欢迎语到数据库
-        if db.update_bot_welcome(bot_username, welcome_text):
+        if await db.aio.update_bot_welcome(bot_username, welcome_text):
             # 更新内存中的数据
-            target_bot["welcome_msg"] = welcome_text
-            load_bots()
+            bots_data.update(bot_username, welcome_msg=welcome_text)
             
             await update.message.reply_text(
                 f"✅ 已为 @{bot_username} 设置自定义欢迎语\n\n"
@@ -1415,7 +2323,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome_text = update.message.text.strip()
         
         # 保存全局欢迎语
-        if db.set_global_welcome(welcome_text):
+        if await db.aio.set_global_welcome(welcome_text):
             await update.message.reply_text(
                 f"✅ 已设置全局欢迎语\n\n"
                 f"━━━━━━━━━━━━━━\n"
@@ -1466,21 +2374,19 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # 写入该 bot 的 forum_group_id
-        for b in bots_data.get(owner_id, {}).get("bots", []):
-            if b["bot_username"] == bot_username:
-                b["forum_group_id"] = gid
-                
-                # 💾 保存到数据库
-                db.update_bot_forum_id(bot_username, gid)
-                save_bots()
-                
-                await update.message.reply_text(f"✅ 已为 @{bot_username} 设置话题群ID：<code>{gid}</code>", parse_mode="HTML")
-                # 宿主通知
-                now = datetime.now().strftime("%Y-%m-%d %H:%M")
-                user_username = update.message.from_user.username
-                user_display = f"@{user_username}" if user_username else f"用户ID: {owner_id}"
-                await send_admin_log(f"🛠 {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置话题群ID为 {gid} · {now}")
-                break
+        if bots_data.get_owned(owner_id, bot_username):
+            bots_data.update(bot_username, forum_group_id=gid)
+            
+            # 💾 保存到数据库
+            await db.aio.update_bot_forum_id(bot_username, gid)
+            save_bots()
+            
+            await update.message.reply_text(f"✅ 已为 @{bot_username} 设置话题群ID：<code>{gid}</code>", parse_mode="HTML")
+            # 宿主通知
+            now = datetime.now().strftime("%Y-%m-%d %H:%M")
+            user_username = update.message.from_user.username
+            user_display = f"@{user_username}" if user_username else f"用户ID: {owner_id}"
+            await send_admin_log(f"🛠 {user_display} (ID: <code>{owner_id}</code>) 为 @{bot_username} 设置话题群ID为 {gid} · {now}")
         context.user_data.pop("waiting_forum_for", None)
         return
 
@@ -1502,39 +2408,28 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owner_id = str(update.message.chat.id)
     owner_username = update.message.from_user.username or ""
 
-    # 初始化 owner 节点
-    bots_data.setdefault(owner_id, {"username": owner_username, "bots": []})
-
     # 重复检查
-    if any(b["token"] == token for b in bots_data[owner_id]["bots"]):
+    if bots_data.has_token(token):
         await reply_and_auto_delete(update.message, "⚠️ 这个 Bot 已经添加过了。", delay=10)
         return
 
     # 记录 bot（默认直连模式）
-    bots_data[owner_id]["bots"].append({
-        "token": token,
-        "bot_username": bot_username,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M"),
-        "mode": "direct",
-        "forum_group_id": None
-    })
+    bots_data.add(
+        owner_id, bot_username, token,
+        mode="direct",
+        forum_group_id=None,
+        created_at=datetime.now().strftime("%Y-%m-%d %H:%M")
+    )
     
     # 💾 保存到数据库（持久化）
-    db.add_bot(bot_username, token, int(owner_id), welcome_msg='')
+    await db.aio.add_bot(bot_username, token, int(owner_id), welcome_msg='')
     save_bots()
     
     # 🔄 触发静默备份（不推送通知）
     trigger_backup(silent=True)
 
     # 启动子 Bot
-    new_app = Application.builder().token(token).build()
-    new_app.add_handler(CommandHandler("start", subbot_start))
-    # 处理普通消息
-    new_app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-    # 处理编辑消息
-    new_app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-    # 💡 添加回调处理器（处理 /id 命令的按钮）
-    new_app.add_handler(CallbackQueryHandler(callback_handler))
+    new_app = build_subbot_app(token, owner_id, bot_username)
 
     running_apps[bot_username] = new_app
     await new_app.initialize()
@@ -1554,6 +2449,7 @@ async def token_listener(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 BotCommand("b", "拉黑用户"),
                 BotCommand("ub", "解除拉黑"),
                 BotCommand("bl", "查看黑名单"),
+                BotCommand("vl", "查看已验证用户"),
                 BotCommand("uv", "取消用户验证")
             ]
             await new_app.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=owner_id))
@@ -1621,10 +2517,11 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # 获取所有托管机器人的用户（从 bots_data）
         all_users = []
-        for owner_id, owner_data in bots_data.items():
-            if owner_data.get("bots"):
+        for owner_id in bots_data.owners():
+            owned = bots_data.by_owner(owner_id)
+            if owned:
                 # 获取用户信息（从第一个bot获取）
-                bot_usernames = [bot['bot_username'] for bot in owner_data['bots']]
+                bot_usernames = [bot['bot_username'] for bot in owned]
                 all_users.append({
                     'owner_id': owner_id,
                     'bot_usernames': bot_usernames,
@@ -1719,7 +2616,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # 检测所有bot的token有效性
-        all_bots = db.get_all_bots()
+        all_bots = await db.aio.get_all_bots()
         invalid_bots = []
         valid_count = 0
         
@@ -1794,14 +2691,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for bot_username in invalid_bots:
             try:
                 # 从数据库删除
-                db.delete_bot(bot_username)
+                await db.aio.delete_bot(bot_username)
                 
                 # 从内存删除
-                all_bots = db.get_all_bots()
-                for owner_id, owner_data in list(bots_data.items()):
-                    owner_data['bots'] = [b for b in owner_data['bots'] if b['bot_username'] != bot_username]
-                    if not owner_data['bots']:
-                        del bots_data[owner_id]
+                bots_data.remove(bot_username)
+                msg_map.drop_bot(bot_username)
+                header_sessions.forget(bot_username)
                 
                 # 停止运行中的bot
                 if bot_username in running_apps:
@@ -1844,6 +2739,11 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # 黑名单 / 已验证用户列表翻页
+    if data.startswith("blpage_") or data.startswith("vlpage_"):
+        await handle_list_page_callback(query, context)
+        return
+
     # 新增：处理拉黑/解除拉黑/取消验证按钮
     if data.startswith("block_") or data.startswith("unblock_") or data.startswith("unverify_"):
         try:
@@ -1874,7 +2774,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if action == "block":
             try:
-                if add_to_blacklist(bot_username, user_id):
+                if await add_to_blacklist(bot_username, user_id):
                     await query.message.edit_text(f"🚫 已将用户 {user_id} 加入黑名单")
                     logger.info(f"[回调] 成功拉黑用户: {user_id} (Bot: @{bot_username})")
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -1901,7 +2801,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.edit_text(f"❌ 操作失败: {e}")
         elif action == "unblock":
             try:
-                if remove_from_blacklist(bot_username, user_id):
+                if await remove_from_blacklist(bot_username, user_id):
                     await query.message.edit_text(f"✅ 已将用户 {user_id} 从黑名单移除")
                     logger.info(f"[回调] 成功解除拉黑: {user_id} (Bot: @{bot_username})")
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -1928,7 +2828,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.edit_text(f"❌ 操作失败: {e}")
         else:  # unverify
             try:
-                if remove_verified_user(bot_username, user_id):
+                if await remove_verified_user(bot_username, user_id):
                     await query.message.edit_text(f"🔓 已取消用户 {user_id} 的验证\n下次发送消息时需要重新验证")
                     logger.info(f"[回调] 成功取消验证: {user_id} (Bot: @{bot_username})")
                     now = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -1962,7 +2862,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data == "mybots":
         owner_id = str(query.from_user.id)
-        bots = bots_data.get(owner_id, {}).get("bots", [])
+        bots = bots_data.by_owner(owner_id)
         if not bots:
             await reply_and_auto_delete(query.message, "⚠️ 你还没有绑定任何 Bot。", delay=10)
             return
@@ -1984,15 +2884,14 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         bot_username = data.split("_", 1)[1]
         owner_id = str(query.from_user.id)
 
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await reply_and_auto_delete(query.message, "⚠️ 找不到这个 Bot。", delay=10)
             return
 
         mode_label = "私聊" if target_bot.get("mode", "direct") == "direct" else "话题"
         forum_gid = target_bot.get("forum_group_id")
-        blocked_count = db.get_blacklist_count(bot_username)  # 从数据库获取黑名单数量
+        blocked_count = await db.aio.get_blacklist_count(bot_username)  # 从数据库获取黑名单数量
         
         # 获取主人的用户名
         try:
@@ -2002,7 +2901,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             owner_display = "未知"
         
         # 从数据库获取创建时间
-        bot_info_db = db.get_bot(bot_username)
+        bot_info_db = await db.aio.get_bot(bot_username)
         created_at = bot_info_db.get('created_at', '未知') if bot_info_db else '未知'
         if created_at != '未知' and len(created_at) > 16:
             # 格式化时间显示（去掉秒数）
@@ -2034,8 +2933,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("mode_direct_") or data.startswith("mode_forum_"):
         owner_id = str(query.from_user.id)
         _, mode, bot_username = data.split("_", 2)  # mode is 'direct' or 'forum'
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await reply_and_auto_delete(query.message, "⚠️ 找不到这个 Bot。", delay=10)
             return
@@ -2056,10 +2954,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(f"ℹ️ @{bot_username} 当前已经是 {mode_cn}，无需切换。")
             return
 
-        target_bot["mode"] = mode
+        bots_data.update(bot_username, mode=mode)
         
         # 💾 保存到数据库
-        db.update_bot_mode(bot_username, mode)
+        await db.aio.update_bot_mode(bot_username, mode)
         save_bots()
 
         # 显示中文标签 & 推送到 ADMIN_CHANNEL
@@ -2094,20 +2992,19 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         owner_id = str(query.from_user.id)
         
         # 验证权限
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await reply_and_auto_delete(query.message, "⚠️ 找不到这个 Bot。", delay=10)
             return
         
         # 获取当前生效的欢迎语
-        welcome_msg = get_welcome_message(bot_username)
+        welcome_msg = await get_welcome_message(bot_username)
         
         # 判断来源
-        bot_info = db.get_bot(bot_username)
+        bot_info = await db.aio.get_bot(bot_username)
         if bot_info and bot_info.get('welcome_msg'):
             source = "✏️ 自定义欢迎语"
-        elif db.get_global_welcome():
+        elif await db.aio.get_global_welcome():
             source = "🌐 管理员全局欢迎语"
         else:
             source = "📝 系统默认欢迎语"
@@ -2135,8 +3032,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         owner_id = str(query.from_user.id)
         
         # 验证权限
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await reply_and_auto_delete(query.message, "⚠️ 找不到这个 Bot。", delay=10)
             return
@@ -2146,7 +3042,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["bot_username"] = bot_username
         
         # 获取当前欢迎语
-        bot_info = db.get_bot(bot_username)
+        bot_info = await db.aio.get_bot(bot_username)
         current_welcome = bot_info.get('welcome_msg', '') if bot_info else ''
         
         tip_text = (
@@ -2171,7 +3067,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await reply_and_auto_delete(query.message, "⚠️ 无权限访问", delay=5)
             return
         
-        global_welcome = db.get_global_welcome()
+        global_welcome = await db.aio.get_global_welcome()
         
         if global_welcome:
             text = (
@@ -2209,7 +3105,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         context.user_data["action"] = "set_global_welcome"
         
-        global_welcome = db.get_global_welcome()
+        global_welcome = await db.aio.get_global_welcome()
         tip_text = (
             f"✏️ 设置全局欢迎语\n\n"
             f"请输入全局欢迎语内容：\n\n"
@@ -2232,7 +3128,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await reply_and_auto_delete(query.message, "⚠️ 无权限访问", delay=5)
             return
         
-        if db.delete_global_welcome():
+        if await db.aio.delete_global_welcome():
             await query.message.edit_text(
                 "✅ 已清除全局欢迎语\n\n所有机器人将使用系统默认欢迎语（除非已自定义）",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="back_home")]])
@@ -2249,8 +3145,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         owner_id = str(query.from_user.id)
         owner_username = query.from_user.username or ""
 
-        bots = bots_data.get(owner_id, {}).get("bots", [])
-        target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+        target_bot = bots_data.get_owned(owner_id, bot_username)
         if not target_bot:
             await reply_and_auto_delete(query.message, "⚠️ 找不到这个 Bot。", delay=10)
             return
@@ -2261,10 +3156,12 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await app.updater.stop()
                 await app.stop()
                 await app.shutdown()
-            bots.remove(target_bot)
+            bots_data.remove(bot_username)
+            msg_map.drop_bot(bot_username)
+            header_sessions.forget(bot_username)
             
             # 💾 从数据库删除
-            db.delete_bot(bot_username)
+            await db.aio.delete_bot(bot_username)
             save_bots()
             
             # 🔄 触发静默备份（不推送通知）
@@ -2287,6 +3184,93 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await reply_and_auto_delete(query.message, f"❌ 删除失败: {e}", delay=10)
         return
 
+# ================== 后台维护 ==================
+async def delete_in_chunks(func_name: str, *args) -> int:
+    """分批调用数据库清理函数，每批单独一个事务，批与批之间让出数据库线程"""
+    chunk = db.MAINTENANCE_CHUNK_ROWS
+    total = 0
+    while True:
+        deleted = await getattr(db.aio, func_name)(*args, limit=chunk)
+        total += deleted
+        if deleted < chunk:
+            return total
+        await asyncio.sleep(0)
+
+async def run_maintenance():
+    """执行一轮维护：清理过期的消息映射和待验证记录，然后回收空闲页"""
+    jobs = [
+        ("消息映射", "cleanup_old_mappings", MAPPING_RETENTION_DAYS),
+        ("待验证记录", "cleanup_old_pending_verifications", PENDING_RETENTION_HOURS),
+    ]
+    for name, func_name, retention in jobs:
+        started = time.monotonic()
+        try:
+            deleted = await delete_in_chunks(func_name, retention)
+            logger.info(f"🧹 维护任务 [{name}]：删除 {deleted} 行，耗时 {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logger.error(f"❌ 维护任务 [{name}] 失败: {e}")
+    try:
+        await reclaim_free_pages()
+    except Exception as e:
+        logger.error(f"❌ 增量回收失败: {e}")
+    await repair_counters_if_due()
+    log_lock_contention()
+
+async def repair_counters_if_due():
+    """距离上次校正超过 COUNTER_REPAIR_INTERVAL 时，按实际数据重新计算统计计数"""
+    global last_counter_repair
+    if COUNTER_REPAIR_INTERVAL <= 0:
+        return
+    if last_counter_repair and time.monotonic() - last_counter_repair < COUNTER_REPAIR_INTERVAL:
+        return
+    started = time.monotonic()
+    try:
+        repaired = await db.aio.repair_counters()
+        last_counter_repair = time.monotonic()
+        logger.info(f"🔢 计数校正：修正 {repaired} 项，耗时 {last_counter_repair - started:.2f}s")
+    except Exception as e:
+        logger.error(f"❌ 计数校正失败: {e}")
+
+def log_lock_contention(top: int = 5):
+    """输出等待时间最长的几个数据库写锁（累计值，自进程启动起）"""
+    stats = db.aio.get_lock_stats()
+    contended = sorted(
+        ((name, s) for name, s in stats.items() if s['contended']),
+        key=lambda item: item[1]['total_wait_ms'], reverse=True
+    )
+    for name, s in contended[:top]:
+        logger.info(
+            f"🔒 写锁 {name}：{s['contended']}/{s['acquisitions']} 次需要等待，"
+            f"累计 {s['total_wait_ms']}ms，最长 {s['max_wait_ms']}ms"
+        )
+
+async def reclaim_free_pages():
+    """在数据库空闲时分批回收空闲页（PRAGMA incremental_vacuum），并报告前后的文件大小"""
+    before = await db.aio.get_storage_stats()
+    if not before.get('freelist_count'):
+        return
+    started = time.monotonic()
+    remaining = before['freelist_count']
+    while remaining > 0 and time.monotonic() - started < VACUUM_MAX_SECONDS:
+        # 只在空闲时回收，避免和正常消息抢写锁
+        if db.aio.seconds_since_last_activity() < VACUUM_IDLE_SECONDS:
+            await asyncio.sleep(VACUUM_IDLE_SECONDS)
+            continue
+        remaining = await db.aio.incremental_vacuum(VACUUM_PAGES)
+    await db.aio.checkpoint_wal()
+    after = await db.aio.get_storage_stats()
+    logger.info(
+        f"🗜️ 增量回收：文件 {before['file_size_kb']}KB → {after.get('file_size_kb')}KB，"
+        f"空闲页 {before['freelist_count']} → {after.get('freelist_count')}，"
+        f"耗时 {time.monotonic() - started:.2f}s"
+    )
+
+async def maintenance_loop():
+    """后台维护循环：启动后先执行一次，之后每隔 MAINTENANCE_INTERVAL 秒执行一次"""
+    while True:
+        await run_maintenance()
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+
 # ================== 主入口 ==================
 async def run_all_bots():
     if not MANAGER_TOKEN:
@@ -2294,60 +3278,54 @@ async def run_all_bots():
         return
 
     # 初始化数据库
-    db.init_database()
+    await db.aio.init_database()
     
     # 从数据库加载配置
-    load_bots()
-    load_map()
+    all_bots = await db.aio.get_all_bots()
+    load_bots(all_bots)
 
     # 启动子 bot（恢复）
-    for owner_id, info in bots_data.items():
-        for b in info.get("bots", []):
-            token = b["token"]; bot_username = b["bot_username"]
-            try:
-                app = Application.builder().token(token).build()
-                app.add_handler(CommandHandler("start", subbot_start))
-                # 处理普通消息
-                app.add_handler(MessageHandler(filters.ALL, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-                # 处理编辑消息 - 使用 filters.UpdateType.EDITED_MESSAGE
-                app.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE, partial(handle_message, owner_id=int(owner_id), bot_username=bot_username)))
-                # 💡 添加回调处理器（处理 /id 命令的按钮）
-                app.add_handler(CallbackQueryHandler(callback_handler))
-                running_apps[bot_username] = app
-                await app.initialize()
-                await app.start()
+    for b in bots_data:
+        owner_id = b["owner"]
+        token = b["token"]; bot_username = b["bot_username"]
+        try:
+            app = build_subbot_app(token, owner_id, bot_username)
+            running_apps[bot_username] = app
+            await app.initialize()
+            await app.start()
                 
-                # 设置子机器人的命令菜单（仅对绑定用户显示）
-                try:
-                    # 先清除所有默认命令（全局）
-                    await app.bot.delete_my_commands()
-                    logger.info(f"✅ 已清除 @{bot_username} 的全局命令菜单")
+            # 设置子机器人的命令菜单（仅对绑定用户显示）
+            try:
+                # 先清除所有默认命令（全局）
+                await app.bot.delete_my_commands()
+                logger.info(f"✅ 已清除 @{bot_username} 的全局命令菜单")
                     
-                    # 尝试为 owner 设置命令菜单（如果bot和owner还没对话会失败，这是正常的）
-                    try:
-                        commands = [
-                            BotCommand("start", "开始使用"),
-                            BotCommand("id", "查看用户"),
-                            BotCommand("b", "拉黑用户"),
-                            BotCommand("ub", "解除拉黑"),
-                            BotCommand("bl", "查看黑名单"),
-                            BotCommand("uv", "取消用户验证")
-                        ]
-                        await app.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=int(owner_id)))
-                        logger.info(f"✅ 已为 @{bot_username} 的拥有者（ID: {owner_id}）设置专属命令菜单")
-                    except Exception as scope_err:
-                        # Bot还没和owner对话过，等用户首次/start后会自动设置
-                        logger.info(f"ℹ️  @{bot_username} 暂未与拥有者建立对话，将在首次对话时设置命令菜单")
-                except Exception as cmd_err:
-                    logger.error(f"❌ 设置命令菜单失败 @{bot_username}: {cmd_err}")
+                # 尝试为 owner 设置命令菜单（如果bot和owner还没对话会失败，这是正常的）
+                try:
+                    commands = [
+                        BotCommand("start", "开始使用"),
+                        BotCommand("id", "查看用户"),
+                        BotCommand("b", "拉黑用户"),
+                        BotCommand("ub", "解除拉黑"),
+                        BotCommand("bl", "查看黑名单"),
+                        BotCommand("vl", "查看已验证用户"),
+                        BotCommand("uv", "取消用户验证")
+                    ]
+                    await app.bot.set_my_commands(commands, scope=BotCommandScopeChat(chat_id=int(owner_id)))
+                    logger.info(f"✅ 已为 @{bot_username} 的拥有者（ID: {owner_id}）设置专属命令菜单")
+                except Exception as scope_err:
+                    # Bot还没和owner对话过，等用户首次/start后会自动设置
+                    logger.info(f"ℹ️  @{bot_username} 暂未与拥有者建立对话，将在首次对话时设置命令菜单")
+            except Exception as cmd_err:
+                logger.error(f"❌ 设置命令菜单失败 @{bot_username}: {cmd_err}")
                 
-                await app.updater.start_polling()
-                logger.info(f"启动子Bot: @{bot_username}")
-            except Exception as e:
-                logger.error(f"子Bot启动失败: @{bot_username} {e}")
+            await app.updater.start_polling()
+            logger.info(f"启动子Bot: @{bot_username}")
+        except Exception as e:
+            logger.error(f"子Bot启动失败: @{bot_username} {e}")
 
     # 管理 Bot
-    manager_app = Application.builder().token(MANAGER_TOKEN).build()
+    manager_app = Application.builder().token(MANAGER_TOKEN).rate_limiter(PriorityRateLimiter()).build()
     manager_app.add_handler(CommandHandler("start", manager_start))
     # 添加欢迎语设置相关的命令处理器
     async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2368,8 +3346,7 @@ async def run_all_bots():
             owner_id = str(update.message.chat.id)
             
             # 验证权限
-            bots = bots_data.get(owner_id, {}).get("bots", [])
-            target_bot = next((b for b in bots if b["bot_username"] == bot_username), None)
+            target_bot = bots_data.get_owned(owner_id, bot_username)
             if not target_bot:
                 await update.message.reply_text("⚠️ 找不到这个 Bot")
                 context.user_data.pop("action", None)
@@ -2377,13 +3354,12 @@ async def run_all_bots():
                 return
             
             # 清除自定义欢迎语
-            if db.update_bot_welcome(bot_username, ""):
+            if await db.aio.update_bot_welcome(bot_username, ""):
                 # 更新内存
-                target_bot["welcome_msg"] = ""
-                load_bots()
+                bots_data.update(bot_username, welcome_msg="")
                 await update.message.reply_text(
                     f"✅ 已清除 @{bot_username} 的自定义欢迎语\n\n"
-                    f"现在将使用{'管理员全局欢迎语' if db.get_global_welcome() else '系统默认欢迎语'}"
+                    f"现在将使用{'管理员全局欢迎语' if await db.aio.get_global_welcome() else '系统默认欢迎语'}"
                 )
             else:
                 await update.message.reply_text("❌ 清除失败")
@@ -2407,7 +3383,25 @@ async def run_all_bots():
         except Exception as e:
             logger.error(f"启动通知失败: {e}")
 
-    await asyncio.Event().wait()
+    # 自动删除：接管上次退出前未删除的提示消息
+    await deletion_scheduler.restore()
+    deletion_scheduler.start()
+
+    # 后台维护任务（保留引用，避免任务被垃圾回收）
+    maintenance_task = None
+    if MAINTENANCE_INTERVAL > 0:
+        maintenance_task = asyncio.create_task(maintenance_loop())
+        logger.info(f"🧹 后台维护已启用，间隔 {MAINTENANCE_INTERVAL}s")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # 退出前保存未执行的自动删除、写回缓冲中的映射并释放存储后端资源（连接池等）
+        await deletion_scheduler.close()
+        await db.aio.close()
 
 if __name__ == "__main__":
-    asyncio.run(run_all_bots())
+    try:
+        asyncio.run(run_all_bots())
+    finally:
+        db.shutdown()
@@ -6,6 +6,7 @@ SERVICE_NAME="tg_multi_bot"
 SCRIPT_NAME="host_bot.py"
 SCRIPT_URL="https://raw.githubusercontent.com/ryty1/TG_Talk/main/host_bot.py"
 DATABASE_URL="https://raw.githubusercontent.com/ryty1/TG_Talk/main/database.py"
+STORAGE_PG_URL="https://raw.githubusercontent.com/ryty1/TG_Talk/main/storage_pg.py"
 
 function check_and_install() {
   PKG=$1
@@ -164,10 +165,22 @@ if [ ! -d ".git" ]; then
   git remote set-url origin "https://$GH_TOKEN@github.com/$GH_USERNAME/$GH_REPO.git"
 fi
 
-# 复制数据库文件
+# 复制数据库文件（优先使用程序生成的一致性快照）
 echo "📦 备份数据文件..."
-if [ -f "$APP_DIR/bot_data.db" ]; then
+rm -f bot_data.shard*.db
+if [ -n "$BACKUP_SNAPSHOT" ] && [ -f "$BACKUP_SNAPSHOT" ]; then
+  gunzip -c "$BACKUP_SNAPSHOT" > bot_data.db && echo "  ✅ bot_data.db（一致性快照）"
+  # 分片快照与主库快照同一时间戳：bot_data.shardXofN-<时间戳>.db.gz
+  SNAPSHOT_TS=$(basename "$BACKUP_SNAPSHOT" .db.gz)
+  SNAPSHOT_TS=${SNAPSHOT_TS#bot_data-}
+  for SHARD_SNAPSHOT in "$(dirname "$BACKUP_SNAPSHOT")"/bot_data.shard*-"$SNAPSHOT_TS".db.gz; do
+    [ -f "$SHARD_SNAPSHOT" ] || continue
+    SHARD_NAME=$(basename "$SHARD_SNAPSHOT" "-$SNAPSHOT_TS.db.gz").db
+    gunzip -c "$SHARD_SNAPSHOT" > "$SHARD_NAME" && echo "  ✅ $SHARD_NAME（一致性快照）"
+  done
+elif [ -f "$APP_DIR/bot_data.db" ]; then
   cp -f "$APP_DIR/bot_data.db" . 2>/dev/null && echo "  ✅ bot_data.db（数据库）"
+  cp -f "$APP_DIR"/bot_data.shard*.db . 2>/dev/null || true
 else
   echo "  ⚠️ 未找到数据库文件 bot_data.db"
 fi
@@ -180,6 +193,7 @@ cp -f "$APP_DIR/.env" . 2>/dev/null || echo "# Empty" > .env
 echo "📜 备份脚本文件..."
 cp -f "$APP_DIR/host_bot.py" . 2>/dev/null || touch host_bot.py
 cp -f "$APP_DIR/database.py" . 2>/dev/null && echo "  ✅ database.py"
+cp -f "$APP_DIR/storage_pg.py" . 2>/dev/null && echo "  ✅ storage_pg.py"
 
 # 创建备份信息文件
 cat <<EOF > backup_info.txt
@@ -189,7 +203,7 @@ Python版本: $(python3 --version 2>&1)
 备份内容:
   - 数据库文件: bot_data.db
   - 配置文件: .env
-  - 脚本文件: host_bot.py, database.py
+  - 脚本文件: host_bot.py, database.py, storage_pg.py
 EOF
 
 # 提交到 GitHub
@@ -297,12 +311,14 @@ EOF
           mkdir -p "$BACKUP_OLD_DIR"
           echo "💾 备份当前数据到: $BACKUP_OLD_DIR"
           cp -f "$APP_DIR/bot_data.db" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+          cp -f "$APP_DIR"/bot_data.shard*.db "$BACKUP_OLD_DIR/" 2>/dev/null || true
           cp -f "$APP_DIR/.env" "$BACKUP_OLD_DIR/" 2>/dev/null || true
         fi
         
-        # 恢复数据库文件
+        # 恢复数据库文件（含分片文件）
         if [ -f "$TEMP_CHECK_DIR/bot_data.db" ]; then
           cp -f "$TEMP_CHECK_DIR/bot_data.db" "$APP_DIR/"
+          cp -f "$TEMP_CHECK_DIR"/bot_data.shard*.db "$APP_DIR/" 2>/dev/null || true
           echo "  ✅ 已恢复 bot_data.db"
         fi
         
@@ -320,6 +336,10 @@ EOF
           if [[ "$RESTORE_DB_SCRIPT" =~ ^[Yy]$ ]]; then
             cp -f "$TEMP_CHECK_DIR/database.py" "$APP_DIR/"
             echo "  ✅ 已恢复 database.py"
+            if [ -f "$TEMP_CHECK_DIR/storage_pg.py" ]; then
+              cp -f "$TEMP_CHECK_DIR/storage_pg.py" "$APP_DIR/"
+              echo "  ✅ 已恢复 storage_pg.py"
+            fi
           fi
         fi
         
@@ -434,7 +454,7 @@ echo "============================"
 echo ""
 echo "1) 仅恢复数据文件 (bot_data.db)"
 echo "2) 恢复数据库 + 配置文件 (.env)"
-echo "3) 恢复数据库 + 脚本文件 (host_bot.py, database.py)"
+echo "3) 恢复数据库 + 脚本文件 (host_bot.py, database.py, storage_pg.py)"
 echo "4) 恢复全部 (数据 + 配置 + 脚本)"
 echo "5) 自定义选择"
 echo "0) 取消操作"
@@ -476,7 +496,7 @@ case "$RESTORE_OPTION" in
     RESTORE_ENV=false
     [[ "$ans_env" =~ ^[Yy]$ ]] && RESTORE_ENV=true
     
-    read -p "恢复脚本文件 (host_bot.py, database.py)？[y/N]: " ans_script
+    read -p "恢复脚本文件 (host_bot.py, database.py, storage_pg.py)？[y/N]: " ans_script
     RESTORE_SCRIPT=false
     [[ "$ans_script" =~ ^[Yy]$ ]] && RESTORE_SCRIPT=true
     ;;
@@ -491,7 +511,7 @@ echo ""
 echo "将要恢复的内容："
 $RESTORE_DATA && echo "  ✅ 数据库文件 (bot_data.db)"
 $RESTORE_ENV && echo "  ✅ 配置文件 (.env)"
-$RESTORE_SCRIPT && echo "  ✅ 脚本文件 (host_bot.py, database.py)"
+$RESTORE_SCRIPT && echo "  ✅ 脚本文件 (host_bot.py, database.py, storage_pg.py)"
 echo ""
 read -p "确认恢复？[y/N]: " CONFIRM
 
@@ -511,9 +531,11 @@ mkdir -p "$BACKUP_OLD_DIR"
 
 echo "💾 备份当前数据到: $BACKUP_OLD_DIR"
 cp -f "$APP_DIR/bot_data.db" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+cp -f "$APP_DIR"/bot_data.shard*.db "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/.env" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/host_bot.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 cp -f "$APP_DIR/database.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
+cp -f "$APP_DIR/storage_pg.py" "$BACKUP_OLD_DIR/" 2>/dev/null || true
 
 # 恢复文件
 echo ""
@@ -526,6 +548,7 @@ if [ "$RESTORE_DATA" = true ]; then
   
   if [ -f "$BACKUP_DIR/bot_data.db" ]; then
     cp -f "$BACKUP_DIR/bot_data.db" "$APP_DIR/"
+    cp -f "$BACKUP_DIR"/bot_data.shard*.db "$APP_DIR/" 2>/dev/null || true
     echo "  ✅ bot_data.db"
     RESTORED_COUNT=$((RESTORED_COUNT + 1))
   else
@@ -563,6 +586,12 @@ if [ "$RESTORE_SCRIPT" = true ]; then
     echo "  ✅ database.py"
     RESTORED_COUNT=$((RESTORED_COUNT + 1))
   fi
+  
+  if [ -f "$BACKUP_DIR/storage_pg.py" ]; then
+    cp -f "$BACKUP_DIR/storage_pg.py" "$APP_DIR/"
+    echo "  ✅ storage_pg.py"
+    RESTORED_COUNT=$((RESTORED_COUNT + 1))
+  fi
 fi
 
 echo ""
@@ -646,6 +675,15 @@ function install_bot() {
     echo "    ❌ database.py 下载失败，请手动上传到 $APP_DIR"
     exit 1
   fi
+  
+  # 下载 storage_pg.py（PostgreSQL 存储后端，TG_BOT_STORAGE=postgres 时使用）
+  echo "  • 下载 storage_pg.py ..."
+  if curl -sL -o "storage_pg.py" "$STORAGE_PG_URL"; then
+    echo "    ✅ storage_pg.py"
+  else
+    echo "    ❌ storage_pg.py 下载失败，请手动上传到 $APP_DIR"
+    exit 1
+  fi
 
   echo "🐍 创建虚拟环境..."
   # 清理可能存在的失败虚拟环境
@@ -696,6 +734,14 @@ function install_bot() {
     echo "✅ 已安装 python-dotenv，跳过"
   fi
 
+  ASYNCPG_VERSION=$(pip show asyncpg 2>/dev/null | grep Version | awk '{print $2}' || true)
+  if [[ "$ASYNCPG_VERSION" != 0.32.* ]]; then
+    echo "📦 安装 asyncpg==0.32.* （PostgreSQL 存储后端）..."
+    pip install -q "asyncpg==0.32.*"
+  else
+    echo "✅ 已安装 asyncpg==$ASYNCPG_VERSION，跳过"
+  fi
+
   # ------------------ 环境变量 ------------------
   echo "⚙️ 生成环境变量 (.env)..."
   # 输入宿主 Bot Token
@@ -0,0 +1,898 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL 存储后端（asyncpg 连接池）
+
+设置 TG_BOT_STORAGE=postgres 启用，多个宿主进程可以共享同一个数据库。
+表结构与 SQLite 版本一致（消息映射同样使用整数编码），返回值格式与 database.py 相同。
+
+与 SQLite 后端的差异：
+- 不做进程内的成员/欢迎语缓存（其他进程的修改无法及时失效），peek_* 总是返回 None
+- 消息映射仍然写后合并，按批用 executemany 在一个事务内提交
+- 空间回收、WAL、备份由 PostgreSQL 自身（autovacuum、pg_dump）负责
+
+本地测试：
+    TG_BOT_PG_DSN=postgresql://postgres@localhost/tgbot_test python storage_pg.py
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # 仅在选择 PostgreSQL 后端时需要
+    asyncpg = None
+
+from database import (
+    MAP_TYPE_CODES,
+    MAPPING_FLUSH_INTERVAL_MS,
+    MAPPING_FLUSH_MAX_ROWS,
+    StorageBackend,
+    _decode_ref,
+    _encode_ref,
+)
+
+logger = logging.getLogger(__name__)
+
+# ================== 配置 ==================
+PG_DSN = os.environ.get('TG_BOT_PG_DSN', 'postgresql://localhost/tgbot')
+PG_POOL_MIN = int(os.environ.get('TG_BOT_PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.environ.get('TG_BOT_PG_POOL_MAX', '10'))
+
+# 迁移时持有的 advisory lock，避免多个进程同时建表
+PG_MIGRATION_LOCK_ID = 0x7467626F74
+
+# 提交失败后重试写回映射的间隔（秒）
+MAPPING_RETRY_SECONDS = 1.0
+
+# SQLite 的 CURRENT_TIMESTAMP 是 UTC，这里保持一致
+UTC_NOW = "(now() AT TIME ZONE 'utc')"
+
+
+# ================== 表结构迁移 ==================
+# (版本号, 说明, SQL 语句列表)，版本号与 database.MIGRATIONS 对应，只能在末尾追加
+PG_MIGRATIONS = [
+    (1, '基础表结构', [
+        f'''
+        CREATE TABLE IF NOT EXISTS bots (
+            id BIGSERIAL PRIMARY KEY,
+            bot_username TEXT UNIQUE NOT NULL,
+            token TEXT NOT NULL,
+            owner BIGINT NOT NULL,
+            welcome_msg TEXT DEFAULT '',
+            mode TEXT DEFAULT 'direct',
+            forum_group_id BIGINT,
+            created_at TIMESTAMP DEFAULT {UTC_NOW},
+            updated_at TIMESTAMP DEFAULT {UTC_NOW}
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS verified_users (
+            id BIGSERIAL PRIMARY KEY,
+            bot_username TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            user_name TEXT DEFAULT '',
+            user_username TEXT DEFAULT '',
+            verified_at TIMESTAMP DEFAULT {UTC_NOW},
+            UNIQUE (bot_username, user_id)
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS blacklist (
+            id BIGSERIAL PRIMARY KEY,
+            bot_username TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            reason TEXT DEFAULT '',
+            blocked_at TIMESTAMP DEFAULT {UTC_NOW},
+            UNIQUE (bot_username, user_id)
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS global_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT {UTC_NOW}
+        )
+        ''',
+        f'''
+        CREATE TABLE IF NOT EXISTS pending_verifications (
+            id BIGSERIAL PRIMARY KEY,
+            bot_username TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            captcha_answer TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT {UTC_NOW},
+            UNIQUE (bot_username, user_id)
+        )
+        ''',
+    ]),
+    (2, '紧凑消息映射表', [
+        '''
+        CREATE TABLE IF NOT EXISTS message_map (
+            bot_id BIGINT NOT NULL,
+            map_type SMALLINT NOT NULL,
+            key_chat BIGINT NOT NULL,
+            key_msg BIGINT NOT NULL,
+            value_chat BIGINT NOT NULL,
+            value_msg BIGINT NOT NULL,
+            user_id BIGINT,
+            updated_at BIGINT NOT NULL,
+            PRIMARY KEY (bot_id, map_type, key_chat, key_msg)
+        )
+        ''',
+    ]),
+    (3, '查询索引', [
+        'CREATE INDEX IF NOT EXISTS idx_message_map_cleanup ON message_map (updated_at)',
+        f'''
+        CREATE INDEX IF NOT EXISTS idx_message_map_topic_user
+        ON message_map (bot_id, value_msg) WHERE map_type = {MAP_TYPE_CODES['topic']}
+        ''',
+    ]),
+    # PostgreSQL 的按索引 COUNT 足够快，不维护计数表，仅占用版本号保持对应
+    (4, '行数计数器', []),
+    (5, '分页索引', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_verified_users_page
+        ON verified_users (bot_username, verified_at, user_id) INCLUDE (user_name, user_username)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_blacklist_page ON blacklist (bot_username, blocked_at, user_id)',
+    ]),
+    (6, '定时删除队列', [
+        '''
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            bot_username TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            due_at BIGINT NOT NULL,
+            PRIMARY KEY (bot_username, chat_id, message_id)
+        )
+        ''',
+    ]),
+]
+
+# bot_id 由 bots 表解析：Bot 已删除时 SELECT 为空，这一行自然被丢弃
+# INSERT ... SELECT 中的参数无法从目标列推断类型，需要显式转换
+MAPPING_UPSERT_SQL = '''
+    INSERT INTO message_map
+    (bot_id, map_type, key_chat, key_msg, value_chat, value_msg, user_id, updated_at)
+    SELECT id, $2::smallint, $3::bigint, $4::bigint, $5::bigint, $6::bigint, $7::bigint, $8::bigint
+    FROM bots WHERE bot_username = $1
+    ON CONFLICT (bot_id, map_type, key_chat, key_msg) DO UPDATE SET
+        value_chat = EXCLUDED.value_chat,
+        value_msg = EXCLUDED.value_msg,
+        user_id = EXCLUDED.user_id,
+        updated_at = EXCLUDED.updated_at
+'''
+
+
+def _affected(status: str) -> int:
+    """从命令状态（如 'DELETE 3'、'INSERT 0 1'）中取出影响的行数"""
+    try:
+        return int(status.rsplit(' ', 1)[-1])
+    except (AttributeError, ValueError):
+        return 0
+
+
+def _ts(value: Optional[datetime]) -> Optional[str]:
+    """时间戳格式与 SQLite 返回的字符串保持一致"""
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+
+def _ts_exact(value: Optional[datetime]) -> Optional[str]:
+    """保留微秒的时间戳字符串，用作分页游标（截断到秒会让同一秒内的行被跳过）"""
+    return value.isoformat(sep=' ') if value else None
+
+
+def _mapping_args(bot_username: str, map_type: str, key: str, value: str, user_id: Optional[int], now: int) -> tuple:
+    key_chat, key_msg = _encode_ref(key)
+    value_chat, value_msg = _encode_ref(value)
+    return (bot_username, MAP_TYPE_CODES[map_type], key_chat, key_msg, value_chat, value_msg, user_id, now)
+
+
+class PostgresStorage(StorageBackend):
+    """PostgreSQL 后端，连接池在 init_database() 中创建"""
+    name = 'postgres'
+
+    def __init__(self, dsn: str = None, min_size: int = None, max_size: int = None):
+        if asyncpg is None:
+            raise RuntimeError("使用 PostgreSQL 存储需要安装 asyncpg：pip install asyncpg")
+        self.dsn = dsn or PG_DSN
+        self.min_size = PG_POOL_MIN if min_size is None else min_size
+        self.max_size = PG_POOL_MAX if max_size is None else max_size
+        self._pool = None
+        # 写后缓冲：(bot_username, map_type, key) -> (value, user_id, updated_at)
+        self._pending: Dict[tuple, tuple] = {}
+        self._inflight: Dict[tuple, tuple] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_handle = None
+        self._flush_tasks = set()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            raise RuntimeError("PostgreSQL 连接池尚未初始化，请先调用 init_database()")
+        return self._pool
+
+    # ---- 生命周期 ----
+    async def init_database(self):
+        """创建连接池并执行未完成的迁移"""
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+            logger.info(f"🐘 PostgreSQL 连接池已创建 (min={self.min_size}, max={self.max_size})")
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', PG_MIGRATION_LOCK_ID)
+                await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+                current = await conn.fetchval('SELECT MAX(version) FROM schema_version') or 0
+                for version, description, statements in PG_MIGRATIONS:
+                    if version <= current:
+                        continue
+                    logger.info(f"🔧 执行数据库迁移 v{version}: {description}")
+                    for sql in statements:
+                        await conn.execute(sql)
+                    await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', version)
+                    current = version
+        logger.info(f"✅ PostgreSQL 数据库初始化完成 (schema v{current})")
+
+    async def close(self):
+        """写回缓冲中的映射并关闭连接池"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pool is None:
+            return
+        await self.flush_mappings()
+        await self._pool.close()
+        self._pool = None
+
+    # ---- Bot 配置 ----
+    async def add_bot(self, bot_username: str, token: str, owner: int, welcome_msg: str = '') -> bool:
+        try:
+            await self.pool.execute('''
+                INSERT INTO bots (bot_username, token, owner, welcome_msg)
+                VALUES ($1, $2, $3, $4)
+            ''', bot_username, token, owner, welcome_msg)
+            logger.info(f"✅ 数据库操作成功 - 添加 Bot: {bot_username} (Owner: {owner})")
+            return True
+        except asyncpg.UniqueViolationError:
+            logger.warning(f"⚠️ Bot 已存在: {bot_username}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ 添加 Bot 失败: {e}")
+            return False
+
+    async def get_bot(self, bot_username: str) -> Optional[Dict]:
+        try:
+            row = await self.pool.fetchrow('SELECT * FROM bots WHERE bot_username = $1', bot_username)
+            if row:
+                return {
+                    'bot_username': row['bot_username'],
+                    'token': row['token'],
+                    'owner': row['owner'],
+                    'welcome_msg': row['welcome_msg'] or '',
+                    'created_at': _ts(row['created_at'])
+                }
+            return None
+        except Exception as e:
+            logger.error(f"❌ 查询 Bot 失败: {e}")
+            return None
+
+    async def get_all_bots(self) -> Dict[str, Dict]:
+        try:
+            rows = await self.pool.fetch('SELECT * FROM bots ORDER BY created_at')
+            bots = {}
+            for row in rows:
+                bots[row['bot_username']] = {
+                    'token': row['token'],
+                    'owner': row['owner'],
+                    'welcome_msg': row['welcome_msg'] or '',
+                    'mode': row['mode'] or 'direct',
+                    'forum_group_id': row['forum_group_id']
+                }
+            logger.info(f"✅ 成功读取 {len(bots)} 个 Bot")
+            return bots
+        except Exception as e:
+            logger.error(f"❌ 查询所有 Bot 失败: {e}")
+            return {}
+
+    async def get_bots_by_owner(self, owner: int) -> List[Dict]:
+        try:
+            rows = await self.pool.fetch('SELECT * FROM bots WHERE owner = $1 ORDER BY created_at', owner)
+            return [{
+                'bot_username': row['bot_username'],
+                'token': row['token'],
+                'welcome_msg': row['welcome_msg'] or ''
+            } for row in rows]
+        except Exception as e:
+            logger.error(f"❌ 查询用户 Bot 失败: {e}")
+            return []
+
+    async def _update_bot(self, bot_username: str, column: str, value) -> bool:
+        status = await self.pool.execute(f'''
+            UPDATE bots SET {column} = $1, updated_at = {UTC_NOW}
+            WHERE bot_username = $2
+        ''', value, bot_username)
+        return _affected(status) > 0
+
+    async def update_bot_welcome(self, bot_username: str, welcome_msg: str) -> bool:
+        try:
+            if await self._update_bot(bot_username, 'welcome_msg', welcome_msg):
+                logger.info(f"✅ 更新欢迎语: {bot_username}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 更新欢迎语失败: {e}")
+            return False
+
+    async def update_bot_mode(self, bot_username: str, mode: str) -> bool:
+        try:
+            if await self._update_bot(bot_username, 'mode', mode):
+                logger.info(f"✅ 更新模式: {bot_username} -> {mode}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 更新模式失败: {e}")
+            return False
+
+    async def update_bot_forum_id(self, bot_username: str, forum_group_id: int) -> bool:
+        try:
+            if await self._update_bot(bot_username, 'forum_group_id', forum_group_id):
+                logger.info(f"✅ 更新话题群ID: {bot_username} -> {forum_group_id}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 更新话题群ID失败: {e}")
+            return False
+
+    async def delete_bot(self, bot_username: str) -> bool:
+        try:
+            # 持有 _flush_lock：丢弃缓冲和 DELETE 之间不会有批次把映射写回
+            async with self._flush_lock, self.pool.acquire() as conn:
+                self._discard_pending(lambda k: k[0] == bot_username)
+                async with conn.transaction():
+                    await conn.execute('DELETE FROM verified_users WHERE bot_username = $1', bot_username)
+                    await conn.execute('''
+                        DELETE FROM message_map
+                        WHERE bot_id = (SELECT id FROM bots WHERE bot_username = $1)
+                    ''', bot_username)
+                    status = await conn.execute('DELETE FROM bots WHERE bot_username = $1', bot_username)
+                    await conn.execute('DELETE FROM pending_deletions WHERE bot_username = $1', bot_username)
+            if _affected(status) > 0:
+                logger.info(f"✅ 删除 Bot: {bot_username}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 删除 Bot 失败: {e}")
+            return False
+
+    # ---- 已验证用户 ----
+    async def is_verified(self, bot_username: str, user_id: int) -> bool:
+        try:
+            return await self.pool.fetchval('''
+                SELECT 1 FROM verified_users WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id) is not None
+        except Exception as e:
+            logger.error(f"❌ 检查验证状态失败: {e}")
+            return False
+
+    async def add_verified_user(self, bot_username: str, user_id: int, user_name: str = '', user_username: str = '') -> bool:
+        try:
+            await self.pool.execute(f'''
+                INSERT INTO verified_users (bot_username, user_id, user_name, user_username)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (bot_username, user_id) DO UPDATE SET
+                    user_name = EXCLUDED.user_name,
+                    user_username = EXCLUDED.user_username,
+                    verified_at = {UTC_NOW}
+            ''', bot_username, user_id, user_name, user_username)
+            logger.info(f"✅ 添加验证用户: {bot_username} - {user_id}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ 添加验证用户失败: {e}")
+            return False
+
+    async def remove_verified_user(self, bot_username: str, user_id: int) -> bool:
+        try:
+            status = await self.pool.execute('''
+                DELETE FROM verified_users WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id)
+            if _affected(status) > 0:
+                logger.info(f"✅ 移除验证用户: {bot_username} - {user_id}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 移除验证用户失败: {e}")
+            return False
+
+    async def get_verified_users(self, bot_username: str) -> List[Dict]:
+        try:
+            rows = await self.pool.fetch('''
+                SELECT user_id, user_name, user_username, verified_at
+                FROM verified_users
+                WHERE bot_username = $1
+                ORDER BY verified_at DESC
+            ''', bot_username)
+            return [{
+                'user_id': row['user_id'],
+                'user_name': row['user_name'],
+                'user_username': row['user_username'],
+                'verified_at': _ts(row['verified_at'])
+            } for row in rows]
+        except Exception as e:
+            logger.error(f"❌ 查询验证用户失败: {e}")
+            return []
+
+    async def _keyset_page(self, bot_username: str, table: str, ts_column: str, columns: str,
+                           limit: int, cursor: Optional[Tuple[str, int]], backward: bool) -> Tuple[list, bool]:
+        """与 database._keyset_page 相同的游标分页；游标中的时间戳保留微秒"""
+        where = 'bot_username = $1'
+        params = [bot_username]
+        if cursor is not None:
+            where += f" AND ({ts_column}, user_id) {'>' if backward else '<'} ($2::timestamp, $3::bigint)"
+            params.extend((datetime.fromisoformat(cursor[0]), cursor[1]))
+        order = 'ASC' if backward else 'DESC'
+        rows = await self.pool.fetch(f'''
+            SELECT {columns} FROM {table}
+            WHERE {where}
+            ORDER BY {ts_column} {order}, user_id {order}
+            LIMIT {int(limit) + 1}
+        ''', *params)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def get_verified_users_page(self, bot_username: str, limit: int = 20,
+                                      cursor: Optional[Tuple[str, int]] = None,
+                                      backward: bool = False) -> Tuple[List[Dict], bool]:
+        try:
+            rows, has_more = await self._keyset_page(
+                bot_username, 'verified_users', 'verified_at',
+                'user_id, user_name, user_username, verified_at', limit, cursor, backward
+            )
+            return [{
+                'user_id': row['user_id'],
+                'user_name': row['user_name'],
+                'user_username': row['user_username'],
+                'verified_at': _ts_exact(row['verified_at'])
+            } for row in rows], has_more
+        except Exception as e:
+            logger.error(f"❌ 分页查询验证用户失败: {e}")
+            return [], False
+
+    async def get_verified_count(self, bot_username: str) -> int:
+        try:
+            return await self.pool.fetchval(
+                'SELECT COUNT(*) FROM verified_users WHERE bot_username = $1', bot_username)
+        except Exception as e:
+            logger.error(f"❌ 查询验证用户数失败: {e}")
+            return 0
+
+    # ---- 黑名单 ----
+    async def is_blacklisted(self, bot_username: str, user_id: int) -> bool:
+        try:
+            return await self.pool.fetchval('''
+                SELECT 1 FROM blacklist WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id) is not None
+        except Exception as e:
+            logger.error(f"❌ 检查黑名单失败: {e}")
+            return False
+
+    async def add_to_blacklist(self, bot_username: str, user_id: int, reason: str = '') -> bool:
+        try:
+            await self.pool.execute(f'''
+                INSERT INTO blacklist (bot_username, user_id, reason)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (bot_username, user_id) DO UPDATE SET
+                    reason = EXCLUDED.reason,
+                    blocked_at = {UTC_NOW}
+            ''', bot_username, user_id, reason)
+            logger.info(f"✅ 添加黑名单: {bot_username} - {user_id}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ 添加黑名单失败: {e}")
+            return False
+
+    async def remove_from_blacklist(self, bot_username: str, user_id: int) -> bool:
+        try:
+            status = await self.pool.execute('''
+                DELETE FROM blacklist WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id)
+            if _affected(status) > 0:
+                logger.info(f"✅ 移除黑名单: {bot_username} - {user_id}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 移除黑名单失败: {e}")
+            return False
+
+    async def get_blacklist(self, bot_username: str) -> List[int]:
+        try:
+            rows = await self.pool.fetch('''
+                SELECT user_id FROM blacklist WHERE bot_username = $1 ORDER BY blocked_at DESC
+            ''', bot_username)
+            return [row['user_id'] for row in rows]
+        except Exception as e:
+            logger.error(f"❌ 查询黑名单失败: {e}")
+            return []
+
+    async def get_blacklist_page(self, bot_username: str, limit: int = 20,
+                                 cursor: Optional[Tuple[str, int]] = None,
+                                 backward: bool = False) -> Tuple[List[Dict], bool]:
+        try:
+            rows, has_more = await self._keyset_page(
+                bot_username, 'blacklist', 'blocked_at', 'user_id, blocked_at', limit, cursor, backward
+            )
+            return [{'user_id': row['user_id'], 'blocked_at': _ts_exact(row['blocked_at'])} for row in rows], has_more
+        except Exception as e:
+            logger.error(f"❌ 分页查询黑名单失败: {e}")
+            return [], False
+
+    async def get_blacklist_count(self, bot_username: str) -> int:
+        try:
+            return await self.pool.fetchval(
+                'SELECT COUNT(*) FROM blacklist WHERE bot_username = $1', bot_username)
+        except Exception as e:
+            logger.error(f"❌ 查询黑名单数量失败: {e}")
+            return 0
+
+    # ---- 消息映射 ----
+    def queue_mapping(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None):
+        """写入缓冲（必须在事件循环线程中调用），稍后批量提交"""
+        self._pending[(bot_username, map_type, str(key))] = (str(value), user_id, int(time.time()))
+        if len(self._pending) >= MAPPING_FLUSH_MAX_ROWS:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(MAPPING_FLUSH_INTERVAL_MS / 1000)
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        task = asyncio.ensure_future(self.flush_mappings())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    def _discard_pending(self, predicate):
+        """
+        丢弃尚未提交的映射写入（调用方须持有 _flush_lock）
+        
+        flush_mappings 在 _flush_lock 内取出并提交批次，删除映射时在同一把锁内
+        丢弃缓冲并执行 DELETE，正在提交的批次不会把刚删除的映射写回。
+        """
+        for k in [k for k in self._pending if predicate(k)]:
+            del self._pending[k]
+
+    async def flush_mappings(self) -> int:
+        """把缓冲中的映射在一个事务内批量提交，返回提交的行数"""
+        async with self._flush_lock:
+            if not self._pending or self._pool is None:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+
+            rows = []
+            for (bot_username, map_type, key), (value, user_id, now) in batch.items():
+                try:
+                    rows.append(_mapping_args(bot_username, map_type, key, value, user_id, now))
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"⚠️ 跳过无法编码的映射 {bot_username}/{map_type}/{key}: {e}")
+
+            try:
+                async with self._pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.executemany(MAPPING_UPSERT_SQL, rows)
+                return len(rows)
+            except Exception as e:
+                logger.error(f"❌ 批量写入映射失败（{len(rows)} 条，稍后重试）: {e}")
+                # 放回缓冲，期间的新写入优先
+                for k, v in batch.items():
+                    self._pending.setdefault(k, v)
+                if self._flush_handle is None:
+                    self._schedule_flush(MAPPING_RETRY_SECONDS)
+                return 0
+            finally:
+                self._inflight = {}
+
+    async def set_mapping(self, bot_username: str, map_type: str, key: str, value: str, user_id: int = None) -> bool:
+        try:
+            status = await self.pool.execute(
+                MAPPING_UPSERT_SQL, *_mapping_args(bot_username, map_type, key, value, user_id, int(time.time())))
+            return _affected(status) > 0
+        except Exception as e:
+            logger.error(f"❌ 设置映射失败: {e}")
+            return False
+
+    async def get_mapping(self, bot_username: str, map_type: str, key: str) -> Optional[str]:
+        # 尚未提交的写入优先
+        k = (bot_username, map_type, str(key))
+        entry = self._pending.get(k) or self._inflight.get(k)
+        if entry is not None:
+            return entry[0]
+
+        try:
+            key_chat, key_msg = _encode_ref(key)
+            row = await self.pool.fetchrow('''
+                SELECT m.value_chat, m.value_msg FROM message_map m
+                JOIN bots b ON b.id = m.bot_id
+                WHERE b.bot_username = $1 AND m.map_type = $2 AND m.key_chat = $3 AND m.key_msg = $4
+            ''', bot_username, MAP_TYPE_CODES[map_type], key_chat, key_msg)
+            return _decode_ref(row[0], row[1]) if row else None
+        except Exception as e:
+            logger.error(f"❌ 查询映射失败: {e}")
+            return None
+
+    async def get_topic_user(self, bot_username: str, topic_id: int) -> Optional[int]:
+        try:
+            # map_type 必须是字面量，查询规划器才能使用部分索引
+            return await self.pool.fetchval(f'''
+                SELECT m.key_msg FROM message_map m
+                JOIN bots b ON b.id = m.bot_id
+                WHERE b.bot_username = $1 AND m.map_type = {MAP_TYPE_CODES['topic']} AND m.value_msg = $2
+                LIMIT 1
+            ''', bot_username, topic_id)
+        except Exception as e:
+            logger.error(f"❌ 反查话题用户失败: {e}")
+            return None
+
+    async def delete_mapping(self, bot_username: str, map_type: str, key: str) -> bool:
+        item_key = (bot_username, map_type, str(key))
+        try:
+            key_chat, key_msg = _encode_ref(key)
+            async with self._flush_lock:
+                self._discard_pending(lambda k: k == item_key)
+                status = await self.pool.execute('''
+                    DELETE FROM message_map
+                    WHERE bot_id = (SELECT id FROM bots WHERE bot_username = $1)
+                      AND map_type = $2 AND key_chat = $3 AND key_msg = $4
+                ''', bot_username, MAP_TYPE_CODES[map_type], key_chat, key_msg)
+            return _affected(status) > 0
+        except Exception as e:
+            logger.error(f"❌ 删除映射失败: {e}")
+            return False
+
+    async def clear_bot_mappings(self, bot_username: str) -> int:
+        try:
+            async with self._flush_lock:
+                self._discard_pending(lambda k: k[0] == bot_username)
+                status = await self.pool.execute('''
+                    DELETE FROM message_map WHERE bot_id = (SELECT id FROM bots WHERE bot_username = $1)
+                ''', bot_username)
+            deleted = _affected(status)
+            logger.info(f"✅ 清空 {bot_username} 的映射: {deleted} 条")
+            return deleted
+        except Exception as e:
+            logger.error(f"❌ 清空映射失败: {e}")
+            return 0
+
+    async def _delete_in_chunks(self, sql: str, args: tuple, limit: Optional[int]) -> int:
+        """按块删除（每块一个事务）；指定 limit 时只删除一块"""
+        chunk = limit or 5000
+        total = 0
+        while True:
+            deleted = _affected(await self.pool.execute(sql, *args, chunk))
+            total += deleted
+            if limit is not None or deleted < chunk:
+                return total
+
+    async def cleanup_old_mappings(self, days: int = 7, limit: Optional[int] = None) -> int:
+        """清理旧的消息映射（话题映射长期有效，不清理）"""
+        try:
+            cutoff = int(time.time()) - days * 86400
+            deleted = await self._delete_in_chunks(f'''
+                DELETE FROM message_map WHERE ctid IN (
+                    SELECT ctid FROM message_map
+                    WHERE updated_at < $1 AND map_type != {MAP_TYPE_CODES['topic']}
+                    LIMIT $2
+                )
+            ''', (cutoff,), limit)
+            if deleted > 0 and limit is None:
+                logger.info(f"🧹 清理了 {deleted} 条过期映射")
+            return deleted
+        except Exception as e:
+            logger.error(f"❌ 清理映射失败: {e}")
+            return 0
+
+    # ---- 待验证用户 ----
+    async def add_pending_verification(self, bot_username: str, user_id: int, captcha_answer: str) -> bool:
+        try:
+            await self.pool.execute(f'''
+                INSERT INTO pending_verifications (bot_username, user_id, captcha_answer)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (bot_username, user_id) DO UPDATE SET
+                    captcha_answer = EXCLUDED.captcha_answer,
+                    created_at = {UTC_NOW}
+            ''', bot_username, user_id, captcha_answer)
+            return True
+        except Exception as e:
+            logger.error(f"❌ 添加待验证用户失败: {e}")
+            return False
+
+    async def get_pending_verification(self, bot_username: str, user_id: int) -> Optional[str]:
+        try:
+            return await self.pool.fetchval('''
+                SELECT captcha_answer FROM pending_verifications
+                WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id)
+        except Exception as e:
+            logger.error(f"❌ 查询待验证用户失败: {e}")
+            return None
+
+    async def remove_pending_verification(self, bot_username: str, user_id: int) -> bool:
+        try:
+            status = await self.pool.execute('''
+                DELETE FROM pending_verifications WHERE bot_username = $1 AND user_id = $2
+            ''', bot_username, user_id)
+            return _affected(status) > 0
+        except Exception as e:
+            logger.error(f"❌ 删除待验证用户失败: {e}")
+            return False
+
+    async def cleanup_old_pending_verifications(self, hours: int = 24, limit: Optional[int] = None) -> int:
+        try:
+            deleted = await self._delete_in_chunks(f'''
+                DELETE FROM pending_verifications WHERE id IN (
+                    SELECT id FROM pending_verifications
+                    WHERE created_at < {UTC_NOW} - make_interval(hours => $1)
+                    LIMIT $2
+                )
+            ''', (hours,), limit)
+            if deleted > 0 and limit is None:
+                logger.info(f"🧹 清理了 {deleted} 条过期的待验证记录")
+            return deleted
+        except Exception as e:
+            logger.error(f"❌ 清理待验证记录失败: {e}")
+            return 0
+
+    # ---- 全局设置 ----
+    async def get_global_setting(self, key: str) -> Optional[str]:
+        try:
+            return await self.pool.fetchval('SELECT value FROM global_settings WHERE key = $1', key)
+        except Exception as e:
+            logger.error(f"❌ 查询全局配置失败: {e}")
+            return None
+
+    async def set_global_setting(self, key: str, value: str) -> bool:
+        try:
+            await self.pool.execute(f'''
+                INSERT INTO global_settings (key, value) VALUES ($1, $2)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = {UTC_NOW}
+            ''', key, value)
+            logger.info(f"✅ 设置全局配置: {key}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ 设置全局配置失败: {e}")
+            return False
+
+    async def delete_global_setting(self, key: str) -> bool:
+        try:
+            status = await self.pool.execute('DELETE FROM global_settings WHERE key = $1', key)
+            if _affected(status) > 0:
+                logger.info(f"✅ 删除全局配置: {key}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"❌ 删除全局配置失败: {e}")
+            return False
+
+    async def get_global_welcome(self) -> Optional[str]:
+        return await self.get_global_setting('global_welcome_msg')
+
+    async def set_global_welcome(self, welcome_msg: str) -> bool:
+        return await self.set_global_setting('global_welcome_msg', welcome_msg)
+
+    async def delete_global_welcome(self) -> bool:
+        return await self.delete_global_setting('global_welcome_msg')
+
+    async def resolve_welcome_message(self, bot_username: str) -> str:
+        """自定义欢迎语 → 全局欢迎语，一次查询完成；都未设置时返回空字符串"""
+        try:
+            text = await self.pool.fetchval('''
+                SELECT COALESCE(
+                    NULLIF((SELECT welcome_msg FROM bots WHERE bot_username = $1), ''),
+                    (SELECT value FROM global_settings WHERE key = 'global_welcome_msg'),
+                    ''
+                )
+            ''', bot_username)
+            return text or ''
+        except Exception as e:
+            logger.error(f"❌ 查询欢迎语失败: {e}")
+            return ''
+
+    # ---- 定时删除队列 ----
+    async def add_pending_deletions(self, rows: List[Tuple[str, int, int, int]]) -> int:
+        if not rows:
+            return 0
+        try:
+            await self.pool.executemany('''
+                INSERT INTO pending_deletions (bot_username, chat_id, message_id, due_at)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (bot_username, chat_id, message_id) DO UPDATE SET due_at = EXCLUDED.due_at
+            ''', rows)
+            return len(rows)
+        except Exception as e:
+            logger.error(f"❌ 登记定时删除失败: {e}")
+            return 0
+
+    async def remove_pending_deletions(self, keys: List[Tuple[str, int, int]]) -> int:
+        if not keys:
+            return 0
+        try:
+            await self.pool.executemany('''
+                DELETE FROM pending_deletions
+                WHERE bot_username = $1 AND chat_id = $2 AND message_id = $3
+            ''', keys)
+            return len(keys)
+        except Exception as e:
+            logger.error(f"❌ 移除定时删除失败: {e}")
+            return 0
+
+    async def get_pending_deletions(self) -> List[Dict]:
+        try:
+            rows = await self.pool.fetch('''
+                SELECT bot_username, chat_id, message_id, due_at FROM pending_deletions ORDER BY due_at
+            ''')
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"❌ 查询定时删除失败: {e}")
+            return []
+
+    async def get_database_stats(self) -> Dict:
+        try:
+            row = await self.pool.fetchrow('''
+                SELECT
+                    (SELECT COUNT(*) FROM bots) AS total_bots,
+                    (SELECT COUNT(*) FROM verified_users) AS total_verified_users,
+                    (SELECT COUNT(*) FROM blacklist) AS total_blacklisted_users,
+                    (SELECT COUNT(*) FROM message_map) AS total_message_mappings,
+                    pg_database_size(current_database()) AS db_size
+            ''')
+            stats = dict(row)
+            stats['db_size_kb'] = round(stats.pop('db_size') / 1024, 2)
+            return stats
+        except Exception as e:
+            logger.error(f"❌ 获取统计信息失败: {e}")
+            return {}
+
+
+# ================== 本地测试 ==================
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    async def _smoke_test():
+        storage = PostgresStorage()
+        await storage.init_database()
+        bot = '_pg_smoke_test_bot'
+        try:
+            await storage.delete_bot(bot)
+            assert await storage.add_bot(bot, 'token', 1)
+            assert await storage.add_verified_user(bot, 42, 'test')
+            assert await storage.is_verified(bot, 42)
+            assert await storage.add_to_blacklist(bot, 7)
+            assert await storage.get_blacklist(bot) == [7]
+
+            for i in range(1000):
+                storage.queue_mapping(bot, 'direct', f'-100_{i}', str(i), 42)
+            assert await storage.get_mapping(bot, 'direct', '-100_5') == '5'
+            print('flushed:', await storage.flush_mappings())
+            assert await storage.get_mapping(bot, 'direct', '-100_999') == '999'
+
+            await storage.set_mapping(bot, 'topic', '42', '9001', 42)
+            assert await storage.get_topic_user(bot, 9001) == 42
+            assert await storage.resolve_welcome_message(bot) == (await storage.get_global_welcome() or '')
+            print('stats:', await storage.get_database_stats())
+        finally:
+            await storage.delete_bot(bot)
+            await storage.remove_from_blacklist(bot, 7)
+            await storage.close()
+        print('✅ PostgreSQL 后端测试通过')
+
+    asyncio.run(_smoke_test())